@@ -0,0 +1,162 @@
+"""Online snapshots of the bot's SQLite database.
+
+Snapshots are taken with the SQLite backup API while the bot keeps running,
+gzip-compressed, and rotated so only the newest BACKUP_KEEP are kept.
+
+    python backups.py create
+    python backups.py list
+    python backups.py verify [FILE]     # newest snapshot by default
+"""
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import database as db
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "14"))
+# Pages copied per backup step, and the pause between steps.  Writers only
+# wait for the step in progress, never for the whole copy.
+BACKUP_STEP_PAGES = int(os.environ.get("BACKUP_STEP_PAGES", "256"))
+BACKUP_STEP_PAUSE = float(os.environ.get("BACKUP_STEP_PAUSE", "0.05"))
+
+SNAPSHOT_PREFIX = "school-"
+SNAPSHOT_SUFFIX = ".db.gz"
+
+log = logging.getLogger(__name__)
+
+
+def list_backups(backup_dir: str = BACKUP_DIR) -> List[str]:
+    """Snapshot paths, oldest first."""
+    try:
+        names = os.listdir(backup_dir)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(backup_dir, n) for n in sorted(names)
+            if n.startswith(SNAPSHOT_PREFIX) and n.endswith(SNAPSHOT_SUFFIX)]
+
+
+def last_backup_age(backup_dir: str = BACKUP_DIR) -> Optional[float]:
+    """Seconds since the newest snapshot was written, None if there is none."""
+    snapshots = list_backups(backup_dir)
+    if not snapshots:
+        return None
+    return time.time() - os.path.getmtime(snapshots[-1])
+
+
+def create_backup(backup_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP,
+                  pages: int = BACKUP_STEP_PAGES, pause: float = BACKUP_STEP_PAUSE) -> str:
+    """Copy the live database into a new compressed snapshot; returns its path."""
+    if db.DB_PATH == db.MEMORY:
+        raise RuntimeError("the database is in memory; there is nothing on disk to back up")
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(backup_dir, f"{SNAPSHOT_PREFIX}{stamp}{SNAPSHOT_SUFFIX}")
+    fd, raw = tempfile.mkstemp(suffix=".db", dir=backup_dir)
+    os.close(fd)
+    started = time.monotonic()
+
+    def throttle(status, remaining, total):
+        if remaining:
+            time.sleep(pause)
+
+    try:
+        src = sqlite3.connect(db.DB_PATH, timeout=10)
+        dst = sqlite3.connect(raw)
+        try:
+            # Pin one read snapshot for the whole copy.  Otherwise every commit
+            # from another connection restarts the backup from page 1, and a
+            # busy bot could keep it from ever finishing.  In WAL mode this
+            # does not block writers.
+            src.execute("BEGIN")
+            src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            src.backup(dst, pages=pages, progress=throttle)
+            src.rollback()
+        finally:
+            dst.close()
+            src.close()
+        with open(raw, "rb") as fin, gzip.open(path + ".part", "wb") as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+        os.replace(path + ".part", path)
+    finally:
+        for leftover in (raw, path + ".part"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    log.info("Backup %s written in %.1fs (%d bytes)",
+             path, time.monotonic() - started, os.path.getsize(path))
+    if keep > 0:
+        for old in list_backups(backup_dir)[:-keep]:
+            os.remove(old)
+            log.info("Backup %s rotated out", old)
+    return path
+
+
+def verify_backup(path: Optional[str] = None,
+                  backup_dir: str = BACKUP_DIR) -> Tuple[bool, str]:
+    """Restore a snapshot to a scratch file and run PRAGMA integrity_check.
+
+    Returns (ok, report).  ``path`` defaults to the newest snapshot.
+    """
+    if path is None:
+        snapshots = list_backups(backup_dir)
+        if not snapshots:
+            return False, f"no snapshots in {backup_dir}"
+        path = snapshots[-1]
+    fd, raw = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        try:
+            with gzip.open(path, "rb") as fin, open(raw, "wb") as fout:
+                shutil.copyfileobj(fin, fout, 1 << 20)
+        except (OSError, EOFError) as e:
+            return False, f"{os.path.basename(path)}: cannot decompress ({e})"
+        conn = sqlite3.connect(f"file:{raw}?mode=ro", uri=True)
+        try:
+            problems = [r[0] for r in conn.execute("PRAGMA integrity_check")]
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            students = conn.execute("SELECT COUNT(*) FROM students").fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            return False, f"{os.path.basename(path)}: {e}"
+        finally:
+            conn.close()
+    finally:
+        os.remove(raw)
+    ok = problems == ["ok"]
+    report = (f"{os.path.basename(path)}: "
+              f"{'integrity ok' if ok else '; '.join(problems[:5])}, "
+              f"schema v{version}, {students} students")
+    return ok, report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--dir", default=BACKUP_DIR)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("create")
+    sub.add_parser("list")
+    verify = sub.add_parser("verify")
+    verify.add_argument("file", nargs="?")
+    args = ap.parse_args()
+
+    if args.cmd == "create":
+        print(create_backup(args.dir))
+    elif args.cmd == "list":
+        for path in list_backups(args.dir):
+            print(f"{path}  {os.path.getsize(path)}")
+    else:
+        ok, report = verify_backup(args.file, args.dir)
+        print(report)
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
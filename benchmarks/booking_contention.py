@@ -0,0 +1,152 @@
+"""Multi-threaded booking contention benchmark.
+
+Many students hit "📅 Schedule" at the same moment and race for the same
+handful of slots.  Every thread books against a throwaway database, then the
+run checks the invariants (no slot booked twice, no negative balance, every
+debit matched by a booked slot) and prints throughput and latency.
+
+    python benchmarks/booking_contention.py --threads 32 --slots 200
+
+``--impl legacy`` runs the previous SELECT-then-UPDATE transaction for
+comparison.  ``--memory`` runs against the in-memory storage backend, which
+shows how much of the latency is disk I/O.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def _legacy_book_slot(db, slot_id: int, student_id: int) -> bool:
+    """The pre-optimisation book_slot, kept here as the baseline."""
+    with db._conn() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT lessons_balance FROM students WHERE id=?", (student_id,))
+            row = c.fetchone()
+            if not row or row[0] <= 0:
+                conn.rollback()
+                return False
+            c.execute(
+                "UPDATE schedule SET student_id=? WHERE id=? AND student_id IS NULL",
+                (student_id, slot_id))
+            if c.rowcount != 1:
+                conn.rollback()
+                return False
+            c.execute(
+                "UPDATE students SET lessons_balance = lessons_balance - 1 WHERE id=?",
+                (student_id,))
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def _seed(db, store, n_students: int, n_slots: int, lessons: int):
+    teacher_id = store.teachers.add("Bench", "")
+    for i in range(n_slots):
+        store.slots.add(teacher_id, "01.01.2030", f"{i // 60:02d}:{i % 60:02d}", "")
+    for i in range(n_students):
+        store.students.add(10_000 + i, f"student{i}", f"s{i}@example.com", "bench", lessons)
+    with db._conn() as conn:
+        slot_ids = [r[0] for r in conn.execute("SELECT id FROM schedule")]
+        student_ids = [r[0] for r in conn.execute("SELECT id FROM students")]
+    return slot_ids, student_ids
+
+
+def _check_invariants(db, lessons: int):
+    with db._conn() as conn:
+        negative = conn.execute(
+            "SELECT COUNT(*) FROM students WHERE lessons_balance < 0").fetchone()[0]
+        mismatched = conn.execute(f"""
+            SELECT COUNT(*) FROM students s
+            WHERE {lessons} - s.lessons_balance !=
+                  (SELECT COUNT(*) FROM schedule sc WHERE sc.student_id = s.id)
+        """).fetchone()[0]
+    return negative, mismatched
+
+
+def run(threads: int, slots: int, lessons: int, impl: str, seed: int, memory: bool):
+    import database as db
+    from storage import open_storage
+    store = open_storage(db.MEMORY if memory else
+                         os.path.join(tempfile.mkdtemp(prefix="bench_booking_"), "bench.db"))
+
+    slot_ids, student_ids = _seed(db, store, threads, slots, lessons)
+    book = store.slots.book if impl == "fast" else (lambda s, st: _legacy_book_slot(db, s, st))
+
+    barrier = threading.Barrier(threads)
+    latencies, booked, attempts, errors = [], [0], [0], [0]
+    lock = threading.Lock()
+
+    def worker(student_id: int, rnd: random.Random):
+        order = slot_ids[:]
+        rnd.shuffle(order)
+        local_lat, local_ok, local_try, local_err = [], 0, 0, 0
+        barrier.wait()
+        for slot_id in order:
+            t0 = time.perf_counter()
+            try:
+                ok = book(slot_id, student_id)
+            except sqlite3.OperationalError:
+                ok = False
+                local_err += 1
+            local_lat.append(time.perf_counter() - t0)
+            local_try += 1
+            if ok:
+                local_ok += 1
+                if local_ok == lessons:
+                    break
+        with lock:
+            latencies.extend(local_lat)
+            booked[0] += local_ok
+            attempts[0] += local_try
+            errors[0] += local_err
+
+    pool = [threading.Thread(target=worker, args=(sid, random.Random(seed + i)))
+            for i, sid in enumerate(student_ids)]
+    t0 = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    negative, mismatched = _check_invariants(db, lessons)
+
+    print(f"impl={impl} storage={'memory' if memory else 'file'} "
+          f"threads={threads} slots={slots} lessons/student={lessons}")
+    print(f"  attempts:     {attempts[0]}  ({attempts[0] / elapsed:,.0f}/s)")
+    print(f"  bookings:     {booked[0]}  ({booked[0] / elapsed:,.0f}/s)")
+    print(f"  lock errors:  {errors[0]}")
+    print(f"  latency ms:   p50={p(0.50):.2f} p95={p(0.95):.2f} p99={p(0.99):.2f}")
+    print(f"  elapsed:      {elapsed:.2f}s")
+    print(f"  invariants:   negative_balances={negative} mismatched_debits={mismatched}")
+    return negative == 0 and mismatched == 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--threads", type=int, default=32)
+    ap.add_argument("--slots", type=int, default=200)
+    ap.add_argument("--lessons", type=int, default=8)
+    ap.add_argument("--impl", choices=("fast", "legacy"), default="fast")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--memory", action="store_true", help="use the in-memory storage backend")
+    args = ap.parse_args()
+    ok = run(args.threads, args.slots, args.lessons, args.impl, args.seed, args.memory)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
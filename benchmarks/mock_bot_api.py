@@ -0,0 +1,336 @@
+"""Local stand-in for the Telegram Bot API, for load-testing bot.py end to end.
+
+Synthetic users play a script against the real bot over HTTP.  Each user
+sends its next update only after the bot has answered the previous one
+(plus a short think time), so next-step prompts see their replies in order.
+Invoices are paid automatically: sendInvoice is followed by a
+pre_checkout_query and, once the bot approves it, a successful_payment.
+Every outbound call is counted (and optionally recorded), and 429s, 5xx
+errors and latency can be injected.
+
+    python benchmarks/mock_bot_api.py --users 200 --script signup --rate 50
+    BOTAPI_BASE_URL=http://127.0.0.1:8081 TOKEN=1:mock STRIPE_PROVIDER_TOKEN=test \\
+        DB_PATH=:memory: python bot.py
+
+The run ends when every user has finished its script (or after
+``--duration``) and prints throughput, reply latency and error counts.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+FIRST_BUTTON = object()   # step: tap the first button of the last reply keyboard
+
+# Texts mirror the buttons in bot.py.
+SCRIPTS = {
+    "browse": ["/start", "📅 Schedule", "📚 My Lessons", "👤 My Account"],
+    "signup": ["/start", "📝 Sign Up", "Load Test {n}", "load{n}@example.com",
+               FIRST_BUTTON, FIRST_BUTTON],
+}
+USER_ID_BASE = 900_000_000
+
+
+class _User:
+    def __init__(self, n: int, steps: list):
+        self.n = n
+        self.id = USER_ID_BASE + n
+        self.steps = list(steps)
+        self.pos = 0
+        self.sent_at = None      # when the step awaiting a reply was delivered
+        self.ready_at = 0.0      # earliest time for the next step
+        self.keyboard = []       # reply-keyboard button texts of the last message
+
+    @property
+    def done(self) -> bool:
+        return self.pos >= len(self.steps) and self.sent_at is None
+
+
+class MockBotApi:
+    def __init__(self, users: int, script: str, rate: float, think: float,
+                 step_timeout: float, error_429: float, error_5xx: float,
+                 latency: float, jitter: float, record=None, seed: int = 1):
+        self.users = {u.id: u for u in (_User(n, SCRIPTS[script]) for n in range(users))}
+        self.rate = rate
+        self.think = think
+        self.step_timeout = step_timeout
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.latency = latency
+        self.jitter = jitter
+        self.record = record
+        self._record_lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.cond = threading.Condition()
+        self.queue: deque = deque()   # update bodies not yet delivered
+        self.inflight = []            # (update_id, body) delivered, not acknowledged
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.calls: Counter = Counter()
+        self.injected: Counter = Counter()
+        self.counts: Counter = Counter()
+        self.latencies = []
+        self.pending_queries = {}     # callback / pre-checkout query id -> user id
+        self.started = time.monotonic()
+
+    # ---- update stream ----
+
+    def _message(self, user: _User, **fields) -> dict:
+        self.next_message_id += 1
+        sender = {"id": user.id, "is_bot": False, "first_name": f"Load{user.n}"}
+        return {"message": {"message_id": self.next_message_id, "date": int(time.time()),
+                            "chat": {"id": user.id, "type": "private"}, "from": sender,
+                            **fields}}
+
+    def _next_update(self, user: _User):
+        step = user.steps[user.pos]
+        user.pos += 1
+        if step is FIRST_BUTTON:
+            if not user.keyboard:
+                self.counts["no_button"] += 1
+                return None
+            return self._message(user, text=user.keyboard[0])
+        if isinstance(step, tuple):
+            kind, payload, total = step
+            if kind == "pre_checkout":
+                query_id = f"pcq{user.id}-{user.pos}"
+                self.pending_queries[query_id] = user.id
+                return {"pre_checkout_query": {
+                    "id": query_id, "currency": "EUR", "total_amount": total,
+                    "invoice_payload": payload,
+                    "from": {"id": user.id, "is_bot": False, "first_name": f"Load{user.n}"}}}
+            return self._message(user, successful_payment={
+                "currency": "EUR", "total_amount": total, "invoice_payload": payload,
+                "telegram_payment_charge_id": f"tg{user.id}",
+                "provider_payment_charge_id": f"mock{user.id}"})
+        return self._message(user, text=step.format(n=user.n))
+
+    def release_loop(self, stop: threading.Event):
+        """Queue each idle user's next step, at most ``rate`` updates/s overall."""
+        interval = 1 / self.rate if self.rate > 0 else 0
+        next_release = time.monotonic()
+        while not stop.is_set():
+            now = time.monotonic()
+            released = False
+            with self.cond:
+                for user in self.users.values():
+                    if user.sent_at is not None and now - user.sent_at > self.step_timeout:
+                        self.counts["timeouts"] += 1
+                        user.sent_at = None
+                    if user.sent_at is not None or user.pos >= len(user.steps) or user.ready_at > now:
+                        continue
+                    if now < next_release:
+                        break
+                    update = self._next_update(user)
+                    if update is None:
+                        continue
+                    user.sent_at = now
+                    self.queue.append(update)
+                    next_release = max(next_release, now - 1) + interval
+                    released = True
+                if released:
+                    self.cond.notify_all()
+            stop.wait(0.005)
+
+    def get_updates(self, offset: int, limit: int, timeout: float) -> list:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            # Anything below the offset is acknowledged; the rest is redelivered.
+            self.inflight = [(i, u) for i, u in self.inflight if i >= offset]
+            self.next_update_id = max(self.next_update_id, offset)
+            while not self.inflight and not self.queue:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.cond.wait(remaining)
+            while self.queue and len(self.inflight) < limit:
+                self.inflight.append((self.next_update_id, self.queue.popleft()))
+                self.next_update_id += 1
+                self.counts["updates"] += 1
+            return [{"update_id": i, **u} for i, u in self.inflight]
+
+    # ---- outbound calls ----
+
+    def _replied(self, user_id: int, markup=None):
+        user = self.users.get(user_id)
+        if user is None:
+            return
+        if markup:
+            keyboard = json.loads(markup).get("keyboard") if isinstance(markup, str) else None
+            if keyboard is not None:
+                user.keyboard = [b["text"] if isinstance(b, dict) else b
+                                 for row in keyboard for b in row]
+        if user.sent_at is not None:
+            self.latencies.append(time.monotonic() - user.sent_at)
+            user.sent_at = None
+            user.ready_at = time.monotonic() + self.think
+
+    def handle_call(self, method: str, params: dict):
+        """(http status, response body) for one Bot API call."""
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, self.get_updates(int(params.get("offset", 0)),
+                                         int(params.get("limit", 100)),
+                                         float(params.get("timeout", 0)))
+        if method == "getMe":
+            return 200, {"id": 1, "is_bot": True, "first_name": "Mock", "username": "mock_bot"}
+        if self.latency or self.jitter:
+            time.sleep((self.latency + self.random.uniform(0, self.jitter)) / 1000)
+        roll = self.random.random()
+        if roll < self.error_429:
+            self.injected["429"] += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": "Too Many Requests: retry after 1",
+                         "parameters": {"retry_after": 1}}
+        if roll < self.error_429 + self.error_5xx:
+            self.injected["502"] += 1
+            return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+
+        chat_id = int(params["chat_id"]) if str(params.get("chat_id", "")).lstrip("-").isdigit() else None
+        with self.cond:
+            if method == "sendInvoice" and chat_id in self.users:
+                user = self.users[chat_id]
+                total = sum(p["amount"] for p in json.loads(params.get("prices", "[]")))
+                user.steps[user.pos:user.pos] = [("pre_checkout", params.get("payload", ""), total),
+                                                 ("paid", params.get("payload", ""), total)]
+            if method in ("answerCallbackQuery", "answerPreCheckoutQuery"):
+                query_id = params.get("callback_query_id") or params.get("pre_checkout_query_id")
+                self._replied(self.pending_queries.pop(query_id, None))
+            elif chat_id is not None:
+                self._replied(chat_id, params.get("reply_markup"))
+            self.next_message_id += 1
+            message_id = self.next_message_id
+        if method.startswith("send") or method.startswith("edit"):
+            return 200, {"message_id": message_id, "date": int(time.time()),
+                         "chat": {"id": chat_id or 0, "type": "private"},
+                         "text": params.get("text", "")}
+        return 200, True
+
+    # ---- reporting ----
+
+    def finished(self) -> bool:
+        with self.cond:
+            return all(u.done for u in self.users.values())
+
+    def report(self, final: bool = False) -> str:
+        elapsed = time.monotonic() - self.started
+        with self.cond:
+            lat = sorted(self.latencies)
+            calls = dict(self.calls)
+            done = sum(u.done for u in self.users.values())
+
+        def p(q):
+            return lat[min(len(lat) - 1, int(q * len(lat)))] * 1000 if lat else 0.0
+
+        sent = sum(n for m, n in calls.items() if m not in ("getUpdates", "getMe"))
+        lines = [f"{'final' if final else 'progress'} after {elapsed:.1f}s: "
+                 f"{done}/{len(self.users)} users done",
+                 f"  updates delivered: {self.counts['updates']}  ({self.counts['updates'] / elapsed:,.1f}/s)",
+                 f"  bot calls:         {sent}  ({sent / elapsed:,.1f}/s)",
+                 f"  reply latency ms:  p50={p(0.50):.0f} p95={p(0.95):.0f} p99={p(0.99):.0f}",
+                 f"  injected errors:   {dict(self.injected) or '-'}",
+                 f"  step timeouts:     {self.counts['timeouts']}  missing buttons: {self.counts['no_button']}"]
+        if final:
+            lines.append("  calls by method:   " + ", ".join(
+                f"{m}={n}" for m, n in sorted(calls.items(), key=lambda kv: -kv[1])))
+        return "\n".join(lines)
+
+
+def _handler(api: MockBotApi):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive, like api.telegram.org
+        # One write per response; split header/body writes hit Nagle + delayed ACK (~40 ms).
+        disable_nagle_algorithm = True
+        wbufsize = 1 << 16
+
+        def log_message(self, *args):
+            pass
+
+        def _serve(self):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            content_type = self.headers.get("Content-Type", "")
+            if body and content_type.startswith("application/x-www-form-urlencoded"):
+                params.update(parse_qsl(body.decode()))
+            elif body and content_type.startswith("application/json"):
+                params.update(json.loads(body))
+            method = url.path.rsplit("/", 1)[-1]
+            status, result = api.handle_call(method, params)
+            payload = result if status != 200 else {"ok": True, "result": result}
+            if api.record:
+                line = json.dumps({"t": round(time.monotonic() - api.started, 4), "method": method,
+                                   "status": status, "params": params}, ensure_ascii=False)
+                with api._record_lock:
+                    api.record.write(line + "\n")
+            out = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        do_GET = do_POST = _serve
+
+    return Handler
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--script", choices=sorted(SCRIPTS), default="browse")
+    ap.add_argument("--rate", type=float, default=50, help="max updates/s released, 0 = unlimited")
+    ap.add_argument("--think-ms", type=float, default=200, help="pause after a reply before the next step")
+    ap.add_argument("--step-timeout", type=float, default=15, help="seconds to wait for a reply")
+    ap.add_argument("--error-429", type=float, default=0.0, help="fraction of calls answered with 429")
+    ap.add_argument("--error-5xx", type=float, default=0.0, help="fraction of calls answered with 502")
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="added to every outbound call")
+    ap.add_argument("--jitter-ms", type=float, default=0.0, help="random extra latency, 0..N ms")
+    ap.add_argument("--duration", type=float, default=0, help="stop after N seconds, 0 = when done")
+    ap.add_argument("--report-every", type=float, default=5)
+    ap.add_argument("--record", help="write every call as a JSON line to this file")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    record = open(args.record, "w", encoding="utf-8") if args.record else None
+    api = MockBotApi(args.users, args.script, args.rate, args.think_ms / 1000,
+                     args.step_timeout, args.error_429, args.error_5xx,
+                     args.latency_ms, args.jitter_ms, record, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), _handler(api))
+    server.daemon_threads = True
+    stop = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=api.release_loop, args=(stop,), daemon=True).start()
+    print(f"Mock Bot API on http://{args.host}:{args.port} "
+          f"({args.users} users, script={args.script}); set BOTAPI_BASE_URL to this address",
+          flush=True)
+    next_report = time.monotonic() + args.report_every
+    try:
+        while not api.finished():
+            if args.duration and time.monotonic() - api.started >= args.duration:
+                break
+            if time.monotonic() >= next_report:
+                print(api.report(), flush=True)
+                next_report += args.report_every
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    print(api.report(final=True), flush=True)
+    if record:
+        record.close()
+    # Keep answering briefly so the bot's in-flight long poll returns cleanly.
+    time.sleep(0.5)
+    server.shutdown()
+    sys.exit(0 if api.finished() else 1)
+
+
+if __name__ == "__main__":
+    main()
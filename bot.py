@@ -1,26 +1,34 @@
 import os
+import signal
+import socket
 import logging
 import threading
 import time as _time
-from datetime import datetime, timedelta
+from datetime import datetime
+from html import escape
 
 import telebot
 from telebot import types
+from telebot.apihelper import ApiTelegramException
+from telebot.handler_backends import BaseMiddleware, CancelUpdate, FileHandlerBackend
 from telebot.types import LabeledPrice
 
+import backups
+import botapi
+from callbackdata import Codec, Table, action_of
+from dedup import Deduplicator, PENDING
+from ratelimit import FloodGuard
+from timezones import render_slot, utc_now, period_bounds, local_parts, SCHOOL_TZ
+
 from database import (
-    save_reg_state, get_reg_state, clear_reg_state,
-    add_student, get_student, get_student_by_id, get_all_students,
-    update_lessons_balance, toggle_student_status, update_student_timezone,
-    repurchase_tariff,
-    get_free_slots, book_slot, get_student_slots, get_slot_by_id,
-    add_slot, delete_slot, cancel_booking, cancel_booking_by_student,
-    get_all_bookings, get_bookings_by_date, mark_lesson_done,
-    get_upcoming_unreminded, mark_reminded,
-    create_payment, complete_payment,
-    add_teacher, get_active_teachers, remove_teacher, get_teacher_by_id,
-    get_statistics,
+    Notice, enqueue_notifications, claim_outbox_batch, mark_outbox_sent, mark_outbox_failed,
+    release_outbox_rows, collapse_digest,
+    create_broadcast, set_broadcast_status, get_running_broadcast, get_broadcast_batch,
+    mark_broadcast_recipient, finish_broadcast, get_broadcast_progress,
+    acquire_lease, release_lease, get_last_update_id, claim_updates, get_outbox_stats,
+    init_db, set_wal_autocheckpoint, checkpoint_wal, wal_size,
 )
+from storage import Storage
 
 # ---------------------------------------------------------------------------
 #  Logging
@@ -41,7 +49,87 @@ if not TOKEN:
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "7415299809"))
 STRIPE_PROVIDER_TOKEN = os.environ.get("STRIPE_PROVIDER_TOKEN", "")
 
-bot = telebot.TeleBot(TOKEN, parse_mode="HTML")
+# Only the process holding the lease runs background jobs; a standby takes
+# over once the leader has missed renewals for LEADER_LEASE_TTL seconds.
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEADER_LEASE_TTL = float(os.environ.get("LEADER_LEASE_TTL", "15"))
+REMINDER_INTERVAL = float(os.environ.get("REMINDER_INTERVAL", "300"))
+# Booked lessons from before today (school timezone) can be moved to the
+# history in one batch by /close_day, or every CLOSE_DAY_INTERVAL seconds by
+# the leader (0 = off; e.g. 86400 for a nightly run).
+CLOSE_DAY_INTERVAL = float(os.environ.get("CLOSE_DAY_INTERVAL", "0"))
+
+OUTBOX_BATCH = int(os.environ.get("OUTBOX_BATCH", "20"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_MAX_BACKOFF = 600
+
+# Routine admin events (cancellations, renewals, sign-ups, empty balances) are
+# merged into one message per window; 0 sends each one immediately.  Payment
+# confirmation requests always go out immediately.
+ADMIN_DIGEST_WINDOW = float(os.environ.get("ADMIN_DIGEST_WINDOW", "0"))
+DIGEST_CATEGORIES = {
+    "signup":       "🎉 New students",
+    "renewal":      "💰 Renewals",
+    "cancel":       "ℹ️ Cancellations",
+    "zero_balance": "⚠️ Out of lessons",
+}
+DIGEST_MAX_LINES = 15
+# Whole lines only; the rest leaves room for the "…and N more" lines within
+# Telegram's 4096 characters.
+DIGEST_MAX_CHARS = 3800
+
+# Broadcasts are paced well under Telegram's ~30 msg/s global limit so that
+# normal replies and the outbox keep flowing while a broadcast runs.
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "10"))
+BROADCAST_BATCH = 100
+
+# Commits no longer checkpoint the WAL; a background thread does it every
+# WAL_CHECKPOINT_INTERVAL seconds (0 = leave it to SQLite) and truncates the
+# file once it grows past WAL_TRUNCATE_MB.
+WAL_CHECKPOINT_INTERVAL = float(os.environ.get("WAL_CHECKPOINT_INTERVAL", "30"))
+WAL_TRUNCATE_MB = float(os.environ.get("WAL_TRUNCATE_MB", "64"))
+
+# The leader writes a compressed snapshot (see backups.py) once the newest
+# one is older than BACKUP_INTERVAL seconds; 0 disables scheduled backups.
+BACKUP_INTERVAL = float(os.environ.get("BACKUP_INTERVAL", "86400"))
+
+# Flood protection: every non-admin update spends a token from the user's
+# bucket and from the bucket of the command it triggers (rate/s, burst).
+# Replies to a pending next-step prompt are not throttled.
+FLOOD_USER_LIMIT = (float(os.environ.get("FLOOD_USER_RATE", "1")),
+                    float(os.environ.get("FLOOD_USER_BURST", "10")))
+FLOOD_COMMAND_LIMITS = {
+    "📅 Schedule":   (0.2, 3),
+    "📚 My Lessons": (0.5, 3),
+    "👤 My Account": (0.5, 3),
+    "🛒 Buy Lessons": (0.2, 2),
+    "📝 Sign Up":    (0.2, 2),
+}
+FLOOD_DEFAULT_LIMIT = (1.0, 5)
+
+# A repeated inline-button press within this many seconds is answered with
+# the first press's result instead of running again.
+CALLBACK_DEDUP_TTL = float(os.environ.get("CALLBACK_DEDUP_TTL", "5"))
+
+# How many recent update ids are remembered in SQLite to skip redeliveries.
+UPDATE_WINDOW = int(os.environ.get("UPDATE_WINDOW", "1000"))
+
+# On SIGTERM (or Ctrl+C) the bot stops taking updates and has up to
+# SHUTDOWN_TIMEOUT seconds to finish running handlers, flush the outbox and
+# checkpoint the WAL.  Pending next-step prompts are saved to STEP_SAVE_FILE
+# and restored by the next start.
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "20"))
+STEP_SAVE_FILE = os.environ.get("STEP_SAVE_FILE", "./.handler-saves/step.save")
+
+# Threads running update handlers; the Bot API connection pool is sized to match.
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "2"))
+
+bot = telebot.TeleBot(TOKEN, parse_mode="HTML", use_class_middlewares=True,
+                      num_threads=WORKER_THREADS)
+# Handler workers plus polling, outbox, broadcast and the main thread.
+bot_api = botapi.BotApiSession(pool_size=WORKER_THREADS + 4)
+store = Storage()
 
 TARIFFS = {
     "🥉 Start — 8 lessons":     {"lessons": 8,  "price_eur": 80,  "price_cents": 8000},
@@ -63,6 +151,112 @@ TIMEZONES = {
 
 CANCEL_TEXTS = {"❌ Cancel", "⬅️ Back"}
 
+LEDGER_REASONS = {
+    "opening": "📂 Opening balance",
+    "signup":  "🎉 Sign-up purchase",
+    "renewal": "💰 Renewal purchase",
+    "booking": "📅 Booking",
+    "cancel":  "↩️ Cancellation",
+    "admin":   "🛠 Admin adjustment",
+}
+
+
+# ---------------------------------------------------------------------------
+#  Update de-duplication
+# ---------------------------------------------------------------------------
+
+# Every update id is recorded in SQLite before its handlers run, and ids seen
+# before are dropped, so updates redelivered after a restart (processed but
+# not yet acknowledged to Telegram) cannot book or credit twice.  The trade-off
+# is at-most-once: an update that was claimed when the process died is not
+# retried.
+_dispatch_updates = bot.process_new_updates
+replayed_updates = 0
+
+# Set once shutdown starts.  Background loops wait on it instead of sleeping;
+# ingress checks it under _ingress_lock, so every claimed update is queued
+# before the drain starts.
+_shutdown = threading.Event()
+_ingress_lock = threading.Lock()
+
+
+def _process_new_updates(updates):
+    global replayed_updates
+    if not updates:
+        return
+    with _ingress_lock:
+        if _shutdown.is_set():
+            return   # left unacknowledged for the next process
+        fresh = set(claim_updates([u.update_id for u in updates], UPDATE_WINDOW))
+        # Acknowledge the whole batch, replays included, on the next getUpdates.
+        bot.last_update_id = max(bot.last_update_id, max(u.update_id for u in updates))
+        if len(fresh) < len(updates):
+            replayed_updates += len(updates) - len(fresh)
+            log.info("Skipped %d already processed update(s)", len(updates) - len(fresh))
+        _dispatch_updates([u for u in updates if u.update_id in fresh])
+
+
+bot.process_new_updates = _process_new_updates
+
+
+def _notify_next_handlers(new_messages):
+    """Route replies to pending next-step prompts.  Replaces telebot's version,
+    which pops from the batch while iterating it, so the message after a
+    next-step reply skipped its own check and fell through to the catch-all."""
+    for message in list(new_messages):
+        handlers = bot.next_step_backend.get_handlers(message.chat.id)
+        if handlers:
+            for handler in handlers:
+                bot._exec_task(handler["callback"], message, *handler["args"], **handler["kwargs"])
+            new_messages.remove(message)
+
+
+bot._notify_next_handlers = _notify_next_handlers
+
+
+# ---------------------------------------------------------------------------
+#  Flood protection
+# ---------------------------------------------------------------------------
+
+def _command_key(update) -> str:
+    """Bucket name for an update; kept to a small fixed set."""
+    if isinstance(update, types.CallbackQuery):
+        return "cb:" + action_of(update.data)
+    text = update.text or ""
+    if text.startswith("/"):
+        return text.split(maxsplit=1)[0].split("@", 1)[0]
+    return text if text in FLOOD_COMMAND_LIMITS else "text"
+
+
+class FloodMiddleware(BaseMiddleware):
+    def __init__(self, guard: FloodGuard):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+        self.guard = guard
+
+    def pre_process(self, update, data):
+        user_id = update.from_user.id if update.from_user else None
+        if user_id is None or user_id == ADMIN_ID:
+            return None
+        if getattr(update, "content_type", None) == "successful_payment":
+            return None
+        if self.guard.allow(user_id, _command_key(update)):
+            return None
+        if isinstance(update, types.CallbackQuery):
+            try:
+                bot.answer_callback_query(update.id, "⏳ Too many taps — please slow down.")
+            except Exception:
+                pass
+        return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+
+flood_guard = FloodGuard(FLOOD_USER_LIMIT, FLOOD_COMMAND_LIMITS, FLOOD_DEFAULT_LIMIT)
+bot.setup_middleware(FloodMiddleware(flood_guard))
+callback_dedup = Deduplicator(CALLBACK_DEDUP_TTL)
+
 
 # ---------------------------------------------------------------------------
 #  Helpers
@@ -81,9 +275,12 @@ def safe_send(chat_id, text, **kwargs):
 
 
 def main_menu(telegram_id: int):
-    student = get_student(telegram_id)
+    return _menu_markup(store.students.exists(telegram_id))
+
+
+def _menu_markup(registered: bool):
     mk = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    if student:
+    if registered:
         mk.row(types.KeyboardButton("📅 Schedule"), types.KeyboardButton("📚 My Lessons"))
         mk.row(types.KeyboardButton("👤 My Account"))
         mk.row(types.KeyboardButton("🛒 Buy Lessons"))
@@ -98,7 +295,8 @@ def admin_markup():
     mk.row(types.KeyboardButton("🗑 Delete Slot"), types.KeyboardButton("👥 Students"))
     mk.row(types.KeyboardButton("📅 All Bookings"), types.KeyboardButton("📅 Bookings by Date"))
     mk.row(types.KeyboardButton("👩‍🏫 Teachers"), types.KeyboardButton("📊 Statistics"))
-    mk.row(types.KeyboardButton("🔙 Exit Admin"))
+    mk.row(types.KeyboardButton("📣 Broadcast"), types.KeyboardButton("🔎 Search"))
+    mk.row(types.KeyboardButton("📈 Analytics"), types.KeyboardButton("🔙 Exit Admin"))
     return mk
 
 
@@ -114,15 +312,31 @@ def back_cancel_markup():
     return mk
 
 
+def _admin_event(category: str, text: str) -> Notice:
+    """Admin notice that is folded into the digest when digest mode is on."""
+    return Notice(ADMIN_ID, text, category=category if ADMIN_DIGEST_WINDOW > 0 else None)
+
+
+def _zero_balance_notice(student) -> Notice:
+    return _admin_event("zero_balance",
+                        f"⚠️ Student ran out of lessons!\n\n"
+                        f"👤 {student[2]}\n📧 {student[3]}\n"
+                        f"📚 Plan: {student[4]}\nBalance: 0")
+
+
 def _notify_admin_zero_balance(student):
-    safe_send(ADMIN_ID,
-              f"⚠️ Student ran out of lessons!\n\n"
-              f"👤 {student[2]}\n📧 {student[3]}\n"
-              f"📚 Plan: {student[4]}\nBalance: 0")
+    enqueue_notifications(_zero_balance_notice(student))
 
 
-def _parse_slot_dt(date_str: str, time_str: str) -> datetime:
-    return datetime.strptime(f"{date_str} {time_str}", "%d.%m.%Y %H:%M")
+CANCEL_WINDOW = 24 * 3600
+LESSON_HOURS = 1
+AGENDA_MAX_LINES = 60
+
+
+def _slot_label(slot, tz: str) -> str:
+    """Button label of a (id, teacher, date, time, zoom, starts_at) row in the student's zone."""
+    date, time_str = render_slot(slot[2], slot[3], slot[5], tz)
+    return f"📅 {date} {time_str} — {slot[1]}"
 
 
 # ---------------------------------------------------------------------------
@@ -131,18 +345,18 @@ def _parse_slot_dt(date_str: str, time_str: str) -> datetime:
 
 @bot.message_handler(commands=["start"])
 def cmd_start(message):
-    clear_reg_state(message.chat.id)
-    student = get_student(message.chat.id)
+    store.registration.clear(message.chat.id)
+    student = store.students.card(message.chat.id)
     if student:
         safe_send(message.chat.id,
-                  f"Welcome back, {student[2]}! 👋",
-                  reply_markup=main_menu(message.chat.id))
+                  f"Welcome back, {student.name}! 👋",
+                  reply_markup=_menu_markup(True))
     else:
         safe_send(message.chat.id,
                   "Welcome to our English Language School! 🎓\n\n"
                   "Here you can sign up for a course, manage your lessons, "
                   "and receive reminders.",
-                  reply_markup=main_menu(message.chat.id))
+                  reply_markup=_menu_markup(False))
 
 
 # ===================================================================
@@ -151,11 +365,11 @@ def cmd_start(message):
 
 @bot.message_handler(func=lambda m: m.text == "📝 Sign Up")
 def reg_start(message):
-    if get_student(message.chat.id):
+    if store.students.get(message.chat.id):
         safe_send(message.chat.id, "You are already registered!",
                   reply_markup=main_menu(message.chat.id))
         return
-    save_reg_state(message.chat.id, "name")
+    store.registration.save(message.chat.id, "name")
     msg = safe_send(message.chat.id, "Let's get started! What is your name?",
                     reply_markup=cancel_markup())
     if msg:
@@ -164,11 +378,11 @@ def reg_start(message):
 
 def reg_process_name(message):
     if is_cancel(message.text):
-        clear_reg_state(message.chat.id)
+        store.registration.clear(message.chat.id)
         safe_send(message.chat.id, "Registration cancelled.",
                   reply_markup=main_menu(message.chat.id))
         return
-    save_reg_state(message.chat.id, "email", name=message.text.strip())
+    store.registration.save(message.chat.id, "email", name=message.text.strip())
     msg = safe_send(message.chat.id, "Enter your email:", reply_markup=cancel_markup())
     if msg:
         bot.register_next_step_handler(msg, reg_process_email)
@@ -176,7 +390,7 @@ def reg_process_name(message):
 
 def reg_process_email(message):
     if is_cancel(message.text):
-        clear_reg_state(message.chat.id)
+        store.registration.clear(message.chat.id)
         safe_send(message.chat.id, "Registration cancelled.",
                   reply_markup=main_menu(message.chat.id))
         return
@@ -186,7 +400,7 @@ def reg_process_email(message):
         if msg:
             bot.register_next_step_handler(msg, reg_process_email)
         return
-    save_reg_state(message.chat.id, "timezone", email=message.text.strip())
+    store.registration.save(message.chat.id, "timezone", email=message.text.strip())
     _show_timezone_menu(message)
 
 
@@ -209,12 +423,12 @@ _user_tz_cache: dict = {}
 
 def reg_process_timezone(message):
     if message.text == "❌ Cancel":
-        clear_reg_state(message.chat.id)
+        store.registration.clear(message.chat.id)
         safe_send(message.chat.id, "Registration cancelled.",
                   reply_markup=main_menu(message.chat.id))
         return
     if message.text == "⬅️ Back":
-        save_reg_state(message.chat.id, "email")
+        store.registration.save(message.chat.id, "email")
         msg = safe_send(message.chat.id, "Enter your email:", reply_markup=cancel_markup())
         if msg:
             bot.register_next_step_handler(msg, reg_process_email)
@@ -225,7 +439,7 @@ def reg_process_timezone(message):
             bot.register_next_step_handler(msg, reg_process_timezone)
         return
     _user_tz_cache[message.chat.id] = TIMEZONES[message.text]
-    save_reg_state(message.chat.id, "tariff")
+    store.registration.save(message.chat.id, "tariff")
     _show_tariff_menu(message)
 
 
@@ -241,7 +455,7 @@ def _show_tariff_menu(message):
 
 def reg_process_tariff(message):
     if message.text == "❌ Cancel":
-        clear_reg_state(message.chat.id)
+        store.registration.clear(message.chat.id)
         _user_tz_cache.pop(message.chat.id, None)
         safe_send(message.chat.id, "Registration cancelled.",
                   reply_markup=main_menu(message.chat.id))
@@ -254,7 +468,7 @@ def reg_process_tariff(message):
         if msg:
             bot.register_next_step_handler(msg, reg_process_tariff)
         return
-    save_reg_state(message.chat.id, "payment", tariff=message.text)
+    store.registration.save(message.chat.id, "payment", tariff=message.text)
     _send_invoice(message.chat.id, message.text, is_repurchase=False)
 
 
@@ -269,7 +483,7 @@ def _send_invoice(chat_id: int, tariff_name: str, is_repurchase: bool = False):
         _fallback_manual_payment(chat_id, tariff_name, is_repurchase)
         return
 
-    payment_id = create_payment(chat_id, tariff_name, tariff["price_cents"])
+    payment_id = store.payments.create(chat_id, tariff_name, tariff["price_cents"])
     prices = [LabeledPrice(label=tariff_name, amount=tariff["price_cents"])]
 
     try:
@@ -292,15 +506,15 @@ def _send_invoice(chat_id: int, tariff_name: str, is_repurchase: bool = False):
 
 def _fallback_manual_payment(chat_id: int, tariff_name: str, is_repurchase: bool):
     tariff = TARIFFS[tariff_name]
-    state = get_reg_state(chat_id)
+    state = store.registration.get(chat_id)
 
     mk = types.InlineKeyboardMarkup()
     mk.add(types.InlineKeyboardButton(
         "✅ Confirm Payment",
-        callback_data=f"confirmpay_{chat_id}_{tariff_name}|{'repurchase' if is_repurchase else 'new'}"))
+        callback_data=_cb("cp", chat_id, tariff_name, "repurchase" if is_repurchase else "new")))
 
     if is_repurchase:
-        student = get_student(chat_id)
+        student = store.students.get(chat_id)
         admin_text = (f"💳 Payment request (renewal)\n\n"
                       f"👤 {student[2]}\n📚 {tariff_name}\n💰 {tariff['price_eur']}€")
     else:
@@ -309,7 +523,7 @@ def _fallback_manual_payment(chat_id: int, tariff_name: str, is_repurchase: bool
                       f"📧 {state['email'] if state else '?'}\n"
                       f"📚 {tariff_name}\n💰 {tariff['price_eur']}€")
 
-    safe_send(ADMIN_ID, admin_text, reply_markup=mk)
+    enqueue_notifications(Notice(ADMIN_ID, admin_text, mk.to_json()))
     safe_send(chat_id,
               f"📩 Payment request sent!\n\n"
               f"📚 {tariff_name}\n💰 {tariff['price_eur']}€\n\n"
@@ -338,38 +552,39 @@ def handle_successful_payment(message):
         tariff_name = parts[1]
         flow = parts[2] if len(parts) > 2 else "new"
 
-        complete_payment(payment_id, charge_id)
+        store.payments.complete(payment_id, charge_id)
         tariff = TARIFFS.get(tariff_name)
         if not tariff:
             safe_send(chat_id, "❌ Plan error. Please contact the administrator.")
             return
 
         if flow == "repurchase":
-            repurchase_tariff(chat_id, tariff_name, tariff["lessons"])
-            student = get_student(chat_id)
+            student = store.students.get(chat_id)
+            balance = store.students.repurchase(
+                chat_id, tariff_name, tariff["lessons"],
+                notify=lambda _: [_admin_event("renewal",
+                                               f"💰 Renewal paid!\n👤 {student[2]}\n"
+                                               f"📚 {tariff_name}\n💳 {charge_id}")])
             safe_send(chat_id,
                       f"✅ Payment successful! Lessons added.\n\n"
-                      f"📚 {tariff_name}\nBalance: {student[5]} lessons",
+                      f"📚 {tariff_name}\nBalance: {balance} lessons",
                       reply_markup=main_menu(chat_id))
-            safe_send(ADMIN_ID,
-                      f"💰 Renewal paid!\n👤 {student[2]}\n"
-                      f"📚 {tariff_name}\n💳 {charge_id}")
         else:
-            state = get_reg_state(chat_id)
+            state = store.registration.get(chat_id)
             tz = _user_tz_cache.pop(chat_id, "Europe/Paris")
             name = state["name"] if state else "—"
             email = state["email"] if state else "—"
-            add_student(chat_id, name, email, tariff_name, tariff["lessons"], tz)
-            clear_reg_state(chat_id)
+            store.students.add(chat_id, name, email, tariff_name, tariff["lessons"], tz,
+                               notify=[_admin_event("signup",
+                                                    f"🎉 New student (paid)!\n👤 {name}\n📧 {email}\n"
+                                                    f"📚 {tariff_name}\n💳 {charge_id}")])
+            store.registration.clear(chat_id)
 
             safe_send(chat_id,
                       f"✅ Welcome, {name}!\n\n"
                       f"Plan: {tariff_name}\nLessons: {tariff['lessons']}\n\n"
                       f"Book your first lesson via 📅 Schedule!",
                       reply_markup=main_menu(chat_id))
-            safe_send(ADMIN_ID,
-                      f"🎉 New student (paid)!\n👤 {name}\n📧 {email}\n"
-                      f"📚 {tariff_name}\n💳 {charge_id}")
 
     except Exception:
         log.exception("successful_payment error for %s", chat_id)
@@ -383,7 +598,7 @@ def handle_successful_payment(message):
 
 @bot.message_handler(func=lambda m: m.text == "🛒 Buy Lessons")
 def repurchase_start(message):
-    student = get_student(message.chat.id)
+    student = store.students.get(message.chat.id)
     if not student:
         safe_send(message.chat.id, "Please sign up first: 📝 Sign Up",
                   reply_markup=main_menu(message.chat.id))
@@ -417,28 +632,30 @@ def repurchase_process_tariff(message):
 
 @bot.message_handler(func=lambda m: m.text == "📅 Schedule")
 def show_schedule(message):
-    student = get_student(message.chat.id)
+    student = store.students.card(message.chat.id)
     if not student:
         safe_send(message.chat.id, "Please sign up first.",
-                  reply_markup=main_menu(message.chat.id))
+                  reply_markup=_menu_markup(False))
         return
-    if student[6] != "active":
+    if student.status != "active":
         safe_send(message.chat.id, "Your account is blocked.",
-                  reply_markup=main_menu(message.chat.id))
+                  reply_markup=_menu_markup(True))
         return
 
-    slots = get_free_slots()
+    now = utc_now()
+    slots = [s for s in store.slots.free() if s[5] is None or s[5] > now]
     if not slots:
         safe_send(message.chat.id, "No available slots at the moment.",
-                  reply_markup=main_menu(message.chat.id))
+                  reply_markup=_menu_markup(True))
         return
 
     mk = types.ReplyKeyboardMarkup(resize_keyboard=True)
     for s in slots:
-        mk.add(types.KeyboardButton(f"📅 {s[2]} {s[3]} — {s[1]}"))
+        mk.add(types.KeyboardButton(_slot_label(s, student.timezone)))
     mk.add(types.KeyboardButton("❌ Cancel"))
     msg = safe_send(message.chat.id,
-                    f"Balance: {student[5]} lessons\nSelect a slot:",
+                    f"Balance: {student.balance} lessons\n"
+                    f"Times are in your timezone ({student.timezone}).\nSelect a slot:",
                     reply_markup=mk)
     if msg:
         bot.register_next_step_handler(msg, process_slot_booking)
@@ -449,10 +666,15 @@ def process_slot_booking(message):
         safe_send(message.chat.id, "Cancelled.", reply_markup=main_menu(message.chat.id))
         return
 
-    slots = get_free_slots()
+    student = store.students.get(message.chat.id)
+    if not student:
+        safe_send(message.chat.id, "Error.", reply_markup=main_menu(message.chat.id))
+        return
+
     selected = None
-    for s in slots:
-        if f"📅 {s[2]} {s[3]} — {s[1]}" == message.text:
+    now = utc_now()
+    for s in store.slots.free():
+        if (s[5] is None or s[5] > now) and _slot_label(s, student[7]) == message.text:
             selected = s
             break
     if not selected:
@@ -461,10 +683,6 @@ def process_slot_booking(message):
             bot.register_next_step_handler(msg, process_slot_booking)
         return
 
-    student = get_student(message.chat.id)
-    if not student:
-        safe_send(message.chat.id, "Error.", reply_markup=main_menu(message.chat.id))
-        return
     if student[5] <= 0:
         safe_send(message.chat.id,
                   "❌ No lessons left.\nTap 🛒 Buy Lessons to continue.",
@@ -472,21 +690,22 @@ def process_slot_booking(message):
         _notify_admin_zero_balance(student)
         return
 
-    ok = book_slot(selected[0], student[0])
+    ok = store.slots.book(selected[0], student[0],
+                          notify_if_empty=[_zero_balance_notice(student)])
     if not ok:
         safe_send(message.chat.id, "❌ Slot already taken or insufficient balance.",
                   reply_markup=main_menu(message.chat.id))
         return
 
+    date, time_str = render_slot(selected[2], selected[3], selected[5], student[7])
     safe_send(message.chat.id,
               f"✅ Booked!\n\n"
-              f"📅 {selected[2]}\n🕐 {selected[3]}\n"
+              f"📅 {date}\n🕐 {time_str} ({student[7]})\n"
               f"👩‍🏫 {selected[1]}\n🔗 {selected[4]}",
               reply_markup=main_menu(message.chat.id))
 
-    student = get_student(message.chat.id)
+    student = store.students.get(message.chat.id)
     if student and student[5] == 0:
-        _notify_admin_zero_balance(student)
         safe_send(message.chat.id,
                   "ℹ️ That was your last lesson.\n"
                   "Tap 🛒 Buy Lessons to keep learning!")
@@ -498,33 +717,29 @@ def process_slot_booking(message):
 
 @bot.message_handler(func=lambda m: m.text == "📚 My Lessons")
 def my_lessons(message):
-    student = get_student(message.chat.id)
-    if not student:
+    view = store.students.my_lessons(message.chat.id)
+    if not view:
         safe_send(message.chat.id, "Please sign up first.",
-                  reply_markup=main_menu(message.chat.id))
+                  reply_markup=_menu_markup(False))
         return
-    slots = get_student_slots(student[0])
-
-    text = f"📚 My Lessons\n\nBalance: {student[5]} lessons\n\n"
-    if slots:
-        text += "Upcoming:\n\n"
-        for s in slots:
-            text += f"📅 {s[2]} at {s[3]} — {s[1]}\n🔗 {s[4]}\n\n"
 
+    tz = view.student.timezone
+    text = f"📚 My Lessons\n\nBalance: {view.student.balance} lessons\n\n"
+    if view.lessons:
+        text += f"Upcoming ({tz}):\n\n"
+        now = utc_now()
         mk = types.InlineKeyboardMarkup()
-        for s in slots:
-            try:
-                lesson_dt = _parse_slot_dt(s[2], s[3])
-                if lesson_dt - datetime.now() > timedelta(hours=24):
-                    mk.add(types.InlineKeyboardButton(
-                        f"❌ Cancel {s[2]} {s[3]}",
-                        callback_data=f"stucancel_{s[0]}"))
-            except ValueError:
-                pass
+        for s in view.lessons:
+            date, time_str = render_slot(s.date, s.time, s.starts_at, tz)
+            text += f"📅 {date} at {time_str} — {s.teacher}\n🔗 {s.zoom_link}\n\n"
+            if s.starts_at is not None and s.starts_at - now > CANCEL_WINDOW:
+                mk.add(types.InlineKeyboardButton(
+                    f"❌ Cancel {date} {time_str}",
+                    callback_data=_cb("sc", s.slot_id)))
         safe_send(message.chat.id, text, reply_markup=mk)
     else:
         text += "No bookings yet. Tap 📅 Schedule to book."
-        safe_send(message.chat.id, text, reply_markup=main_menu(message.chat.id))
+        safe_send(message.chat.id, text, reply_markup=_menu_markup(True))
 
 
 # ===================================================================
@@ -533,23 +748,23 @@ def my_lessons(message):
 
 @bot.message_handler(func=lambda m: m.text == "👤 My Account")
 def cabinet(message):
-    student = get_student(message.chat.id)
+    student = store.students.card(message.chat.id)
     if not student:
         safe_send(message.chat.id, "Please sign up first.",
-                  reply_markup=main_menu(message.chat.id))
+                  reply_markup=_menu_markup(False))
         return
-    status = "✅ Active" if student[6] == "active" else "❌ Blocked"
-    tz_label = student[7] or "Europe/Paris"
+    status = "✅ Active" if student.status == "active" else "❌ Blocked"
+    tz_label = student.timezone or "Europe/Paris"
 
     mk = types.InlineKeyboardMarkup()
-    mk.add(types.InlineKeyboardButton("🌍 Change Timezone", callback_data="changetz"))
+    mk.add(types.InlineKeyboardButton("🌍 Change Timezone", callback_data=_cb("tz")))
 
     safe_send(message.chat.id,
               f"👤 <b>My Account</b>\n\n"
-              f"Name: {student[2]}\n"
-              f"Email: {student[3]}\n"
-              f"Plan: {student[4]}\n"
-              f"Balance: {student[5]} lessons\n"
+              f"Name: {student.name}\n"
+              f"Email: {student.email}\n"
+              f"Plan: {student.tariff}\n"
+              f"Balance: {student.balance} lessons\n"
               f"Timezone: {tz_label}\n"
               f"Status: {status}",
               reply_markup=mk)
@@ -567,13 +782,87 @@ def cmd_admin(message):
     safe_send(message.chat.id, "Admin Panel:", reply_markup=admin_markup())
 
 
+# ---- Backups ----
+
+_backup_lock = threading.Lock()
+
+
+def _run_backup(chat_id: int = None):
+    """Snapshot + verify; serialised so the schedule and /backup never overlap."""
+    if not _backup_lock.acquire(blocking=False):
+        if chat_id:
+            safe_send(chat_id, "⏳ A backup is already running.")
+        return
+    try:
+        path = backups.create_backup()
+        ok, report = backups.verify_backup(path)
+        if not ok:
+            log.error("Backup verification failed: %s", report)
+        if chat_id or not ok:
+            safe_send(chat_id or ADMIN_ID, f"{'✅' if ok else '❌'} Backup {report}")
+    except Exception as e:
+        log.exception("Backup failed")
+        safe_send(chat_id or ADMIN_ID, f"❌ Backup failed: {e}")
+    finally:
+        _backup_lock.release()
+
+
+@bot.message_handler(commands=["backup"])
+def cmd_backup(message):
+    if message.chat.id != ADMIN_ID:
+        return
+    safe_send(message.chat.id, "⏳ Backup started…")
+    threading.Thread(target=_run_backup, args=(message.chat.id,), daemon=True).start()
+
+
+@bot.message_handler(commands=["verify_backup"])
+def cmd_verify_backup(message):
+    """/verify_backup [file name] — restore-test a snapshot (newest by default)."""
+    if message.chat.id != ADMIN_ID:
+        return
+    parts = message.text.split(maxsplit=1)
+    path = None
+    if len(parts) > 1:
+        path = os.path.join(backups.BACKUP_DIR, os.path.basename(parts[1].strip()))
+        if not os.path.exists(path):
+            safe_send(message.chat.id, "Snapshot not found. Latest:\n" + "\n".join(
+                os.path.basename(p) for p in backups.list_backups()[-5:]))
+            return
+    safe_send(message.chat.id, "⏳ Verifying…")
+    threading.Thread(target=_run_verify_backup, args=(message.chat.id, path),
+                     daemon=True).start()
+
+
+def _run_verify_backup(chat_id: int, path: str = None):
+    try:
+        ok, report = backups.verify_backup(path)
+    except Exception as e:
+        log.exception("Backup verification failed")
+        ok, report = False, f"Verification failed: {e}"
+    safe_send(chat_id, f"{'✅' if ok else '❌'} {report}")
+
+
+@bot.message_handler(commands=["close_day"])
+def cmd_close_day(message):
+    """/close_day — mark every booked lesson from before today as done."""
+    if message.chat.id != ADMIN_ID:
+        return
+    counts = store.slots.close_day()
+    if not counts:
+        safe_send(message.chat.id, "No lessons from before today to close.")
+        return
+    safe_send(message.chat.id,
+              f"✅ {sum(n for _t, n in counts)} lessons marked as done:\n" +
+              "".join(f"👩‍🏫 {escape(teacher)}: {n}\n" for teacher, n in counts))
+
+
 # ---- Add Slot (picks teacher from DB) ----
 
 @bot.message_handler(func=lambda m: m.text == "➕ Add Slot")
 def admin_add_slot(message):
     if message.chat.id != ADMIN_ID:
         return
-    teachers = get_active_teachers()
+    teachers = store.teachers.active()
     if not teachers:
         safe_send(message.chat.id,
                   "No teachers found. Add a teacher first via 👩‍🏫 Teachers.",
@@ -596,7 +885,7 @@ def _admin_slot_pick_teacher(message):
         return
     try:
         tid = int(message.text.split("#")[1].split(")")[0])
-        teacher = get_teacher_by_id(tid)
+        teacher = store.teachers.get(tid)
         if not teacher:
             raise ValueError("not found")
     except Exception:
@@ -633,7 +922,7 @@ def _admin_process_add_slot(message):
         datetime.strptime(date, "%d.%m.%Y")
         datetime.strptime(time_str, "%H:%M")
         zoom_link = zoom if zoom else teacher[2]  # fallback to teacher's default zoom
-        sid = add_slot(teacher[1], date, time_str, zoom_link)
+        sid = store.slots.add(teacher[0], date, time_str, zoom_link)
         safe_send(message.chat.id,
                   f"✅ Slot #{sid}\n👩‍🏫 {teacher[1]}\n📅 {date} {time_str}\n🔗 {zoom_link}",
                   reply_markup=admin_markup())
@@ -647,7 +936,7 @@ def _admin_process_add_slot(message):
 def admin_bulk_slots(message):
     if message.chat.id != ADMIN_ID:
         return
-    teachers = get_active_teachers()
+    teachers = store.teachers.active()
     if not teachers:
         safe_send(message.chat.id, "No teachers. Add one first.", reply_markup=admin_markup())
         return
@@ -668,7 +957,7 @@ def _admin_bulk_pick_teacher(message):
         return
     try:
         tid = int(message.text.split("#")[1].split(")")[0])
-        teacher = get_teacher_by_id(tid)
+        teacher = store.teachers.get(tid)
         if not teacher:
             raise ValueError("not found")
     except Exception:
@@ -705,7 +994,7 @@ def _admin_process_bulk(message):
         added = []
         for t in times:
             datetime.strptime(t, "%H:%M")
-            sid = add_slot(teacher[1], date, t, zoom)
+            sid = store.slots.add(teacher[0], date, t, zoom)
             added.append(f"  #{sid} {t}")
         safe_send(message.chat.id,
                   f"✅ {len(added)} slots on {date} ({teacher[1]}):\n" + "\n".join(added),
@@ -720,7 +1009,7 @@ def _admin_process_bulk(message):
 def admin_delete_slot(message):
     if message.chat.id != ADMIN_ID:
         return
-    slots = get_free_slots()
+    slots = store.slots.free()
     if not slots:
         safe_send(message.chat.id, "No free slots to delete.", reply_markup=admin_markup())
         return
@@ -741,7 +1030,7 @@ def _admin_do_delete(message):
         return
     try:
         slot_id = int(message.text.split("#")[1].split(" ")[0])
-        ok = delete_slot(slot_id)
+        ok = store.slots.delete(slot_id)
         txt = f"✅ Slot #{slot_id} deleted." if ok else "❌ Could not delete."
         safe_send(message.chat.id, txt, reply_markup=admin_markup())
     except Exception as e:
@@ -754,24 +1043,78 @@ def _admin_do_delete(message):
 def admin_students(message):
     if message.chat.id != ADMIN_ID:
         return
-    students = get_all_students()
+    students = store.students.all()
     if not students:
         safe_send(message.chat.id, "No students yet.", reply_markup=admin_markup())
         return
     for s in students:
-        mk = types.InlineKeyboardMarkup()
-        mk.row(
-            types.InlineKeyboardButton("➕ Lesson", callback_data=f"addlesson_{s[0]}"),
-            types.InlineKeyboardButton("➖ Done", callback_data=f"rmlesson_{s[0]}"),
-        )
-        mk.add(types.InlineKeyboardButton(
+        _send_student_card(message.chat.id, s)
+
+
+def _send_student_card(chat_id: int, s):
+    """A students row with its admin action buttons."""
+    mk = types.InlineKeyboardMarkup()
+    mk.row(
+        types.InlineKeyboardButton("➕ Lesson", callback_data=_cb("al", s[0])),
+        types.InlineKeyboardButton("➖ Done", callback_data=_cb("rl", s[0])),
+    )
+    mk.row(
+        types.InlineKeyboardButton(
             "🚫 Block" if s[6] == "active" else "✅ Unblock",
-            callback_data=f"block_{s[0]}"))
-        status = "✅" if s[6] == "active" else "❌"
-        safe_send(message.chat.id,
-                  f"👤 {s[2]} (id:{s[0]})\n📧 {s[3]}\n"
-                  f"📚 {s[4]}  Balance: {s[5]}  {status}",
-                  reply_markup=mk)
+            callback_data=_cb("bl", s[0])),
+        types.InlineKeyboardButton("📜 History", callback_data=_cb("hi", s[0])),
+    )
+    status = "✅" if s[6] == "active" else "❌"
+    safe_send(chat_id,
+              f"👤 {escape(s[2])} (id:{s[0]})\n📧 {escape(s[3])}\n"
+              f"📚 {s[4]}  Balance: {s[5]}  {status}",
+              reply_markup=mk)
+
+
+# ---- Search ----
+
+SEARCH_LIMIT = 10
+
+
+@bot.message_handler(commands=["search"])
+@bot.message_handler(func=lambda m: m.text == "🔎 Search")
+def admin_search(message):
+    if message.chat.id != ADMIN_ID:
+        return
+    parts = message.text.split(maxsplit=1)
+    query = parts[1] if parts[0].startswith("/") and len(parts) > 1 else ""
+    if query:
+        _admin_do_search(message.chat.id, query)
+        return
+    msg = safe_send(message.chat.id,
+                    "🔎 Name, email, Telegram id or payment charge id:",
+                    reply_markup=cancel_markup())
+    if msg:
+        bot.register_next_step_handler(msg, _admin_search_step)
+
+
+def _admin_search_step(message):
+    if message.chat.id != ADMIN_ID:
+        return
+    if is_cancel(message.text):
+        safe_send(message.chat.id, "Cancelled.", reply_markup=admin_markup())
+        return
+    _admin_do_search(message.chat.id, message.text or "")
+
+
+def _admin_do_search(chat_id: int, query: str):
+    hits = store.students.search(query, SEARCH_LIMIT + 1)
+    if not hits:
+        safe_send(chat_id, f"🔎 Nothing found for “{escape(query)}”.", reply_markup=admin_markup())
+        return
+    more = len(hits) > SEARCH_LIMIT
+    safe_send(chat_id,
+              f"🔎 {'First ' + str(SEARCH_LIMIT) if more else len(hits)} "
+              f"match{'es' if more or len(hits) > 1 else ''} for “{escape(query)}”"
+              + (" — add more words to narrow it down." if more else ":"),
+              reply_markup=admin_markup())
+    for s in hits[:SEARCH_LIMIT]:
+        _send_student_card(chat_id, s)
 
 
 # ---- All Bookings ----
@@ -780,7 +1123,7 @@ def admin_students(message):
 def admin_all_bookings(message):
     if message.chat.id != ADMIN_ID:
         return
-    bookings = get_all_bookings()
+    bookings = store.slots.bookings()
     if not bookings:
         safe_send(message.chat.id, "No bookings.", reply_markup=admin_markup())
         return
@@ -789,8 +1132,8 @@ def admin_all_bookings(message):
     for b in bookings:
         text += f"[#{b[0]}] {b[1]} — {b[2]} | {b[3]} {b[4]}\n"
         mk.row(
-            types.InlineKeyboardButton(f"❌ Cancel #{b[0]}", callback_data=f"cancelbook_{b[0]}"),
-            types.InlineKeyboardButton(f"✅ Done #{b[0]}", callback_data=f"done_{b[0]}"),
+            types.InlineKeyboardButton(f"❌ Cancel #{b[0]}", callback_data=_cb("cb", b[0])),
+            types.InlineKeyboardButton(f"✅ Done #{b[0]}", callback_data=_cb("dn", b[0])),
         )
     safe_send(message.chat.id, text, reply_markup=mk)
 
@@ -818,7 +1161,7 @@ def _admin_do_bookings_date(message):
     except ValueError:
         safe_send(message.chat.id, "❌ Use DD.MM.YYYY format.", reply_markup=admin_markup())
         return
-    bookings = get_bookings_by_date(date)
+    bookings = store.slots.bookings_by_date(date)
     if not bookings:
         safe_send(message.chat.id, f"No bookings on {date}.", reply_markup=admin_markup())
         return
@@ -827,8 +1170,8 @@ def _admin_do_bookings_date(message):
     for b in bookings:
         text += f"[#{b[0]}] {b[1]} — {b[2]} at {b[4]}\n"
         mk.row(
-            types.InlineKeyboardButton(f"❌ #{b[0]}", callback_data=f"cancelbook_{b[0]}"),
-            types.InlineKeyboardButton(f"✅ #{b[0]}", callback_data=f"done_{b[0]}"),
+            types.InlineKeyboardButton(f"❌ #{b[0]}", callback_data=_cb("cb", b[0])),
+            types.InlineKeyboardButton(f"✅ #{b[0]}", callback_data=_cb("dn", b[0])),
         )
     safe_send(message.chat.id, text, reply_markup=mk)
 
@@ -839,7 +1182,7 @@ def _admin_do_bookings_date(message):
 def admin_teachers(message):
     if message.chat.id != ADMIN_ID:
         return
-    teachers = get_active_teachers()
+    teachers = store.teachers.active()
     text = "👩‍🏫 <b>Teachers</b>\n\n"
     if teachers:
         for t in teachers:
@@ -848,21 +1191,80 @@ def admin_teachers(message):
         text += "No teachers yet.\n"
 
     mk = types.InlineKeyboardMarkup()
-    mk.add(types.InlineKeyboardButton("➕ Add Teacher", callback_data="addteacher"))
+    mk.row(types.InlineKeyboardButton("➕ Add Teacher", callback_data=_cb("at")),
+           types.InlineKeyboardButton("📈 Utilization", callback_data=_cb("ut", 0)))
     if teachers:
         for t in teachers:
-            mk.add(types.InlineKeyboardButton(
-                f"🗑 Remove {t[1]}", callback_data=f"rmteacher_{t[0]}"))
+            mk.row(
+                types.InlineKeyboardButton(f"📋 {t[1]}", callback_data=_cb("ag", t[0], "day")),
+                types.InlineKeyboardButton(f"🗑 Remove {t[1]}", callback_data=_cb("rt", t[0])),
+            )
     safe_send(message.chat.id, text, reply_markup=mk)
 
 
+def _agenda_view(teacher, period: str):
+    start, end = period_bounds(period)
+    rows = store.teachers.agenda(teacher[0], start, end)
+    booked = sum(1 for r in rows if r[4] and not r[5])
+    done = sum(1 for r in rows if r[5])
+    text = (f"📋 <b>{escape(teacher[1])}</b> — {'today' if period == 'day' else 'this week'}\n"
+            f"🟢 Booked: {booked}   ⬜ Free: {len(rows) - booked - done}   ✔️ Done: {done}\n\n")
+    for r in rows[:AGENDA_MAX_LINES]:
+        date, time_str = local_parts(r[3], SCHOOL_TZ)
+        when = time_str if period == "day" else f"{date[:5]} {time_str}"
+        if r[5]:
+            text += f"{when}  ✔️ {escape(r[4] or '—')}\n"
+        elif r[4]:
+            text += f"{when}  🟢 {escape(r[4])}\n"
+        else:
+            text += f"{when}  ⬜ free\n"
+    if len(rows) > AGENDA_MAX_LINES:
+        text += f"…and {len(rows) - AGENDA_MAX_LINES} more\n"
+    if not rows:
+        text += "Nothing scheduled.\n"
+    mk = types.InlineKeyboardMarkup()
+    mk.row(types.InlineKeyboardButton("📅 Today", callback_data=_cb("ag", teacher[0], "day")),
+           types.InlineKeyboardButton("🗓 Week", callback_data=_cb("ag", teacher[0], "week")))
+    return text, mk
+
+
+def _utilization_view(offset: int):
+    start, end = period_bounds("week", offset=offset)
+    rows = store.teachers.utilization(start, end)
+    text = f"📈 <b>Utilization</b> — week of {local_parts(start, SCHOOL_TZ)[0]}\n\n"
+    for _tid, name, offered, booked, done in rows:
+        pct = f"{booked / offered * 100:.0f}%" if offered else "—"
+        text += (f"👩‍🏫 {escape(name)}: {booked * LESSON_HOURS}/{offered * LESSON_HOURS} h  {pct}"
+                 f"  (✔️ {done} done)\n")
+    if not rows:
+        text += "No active teachers.\n"
+    mk = types.InlineKeyboardMarkup()
+    mk.row(types.InlineKeyboardButton("◀️ Previous", callback_data=_cb("ut", offset - 1)),
+           types.InlineKeyboardButton("This week", callback_data=_cb("ut", 0)),
+           types.InlineKeyboardButton("Next ▶️", callback_data=_cb("ut", offset + 1)))
+    return text, mk
+
+
+def _show_view(call, text, mk):
+    """Edit the tapped message in place; fall back to a new message."""
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id,
+                              reply_markup=mk)
+    except ApiTelegramException as e:
+        if "message is not modified" not in str(e):
+            safe_send(call.message.chat.id, text, reply_markup=mk)
+
+
 # ---- Statistics ----
 
 @bot.message_handler(func=lambda m: m.text == "📊 Statistics")
 def admin_statistics(message):
     if message.chat.id != ADMIN_ID:
         return
-    s = get_statistics()
+    s = store.statistics()
+    flood = flood_guard.stats()
+    api = bot_api.stats()
+    top = ", ".join(f"{cmd} ×{n}" for cmd, n in flood["top_dropped"]) or "—"
     safe_send(message.chat.id,
               f"📊 <b>Statistics</b>\n\n"
               f"👥 Total students: {s['total_students']}\n"
@@ -871,10 +1273,107 @@ def admin_statistics(message):
               f"💰 This month: {s['month_revenue_eur']:.2f} €\n"
               f"📚 Lessons conducted: {s['total_lessons_done']}\n"
               f"💳 Paid students: {s['paid_students']}\n"
-              f"📈 Conversion: {s['conversion']}%",
+              f"📈 Conversion: {s['conversion']}%\n"
+              f"🗄 WAL: {wal_size() / 1048576:.1f} MB\n"
+              f"🛡 Flood: {flood['dropped']} dropped / {flood['allowed']} allowed ({top})\n"
+              f"🔁 Repeated taps collapsed: {callback_dedup.collapsed}\n"
+              f"♻️ Replayed updates skipped: {replayed_updates}\n"
+              f"🌐 Bot API: {api['requests']} calls over {api['connections']} connections "
+              f"({api['reused_pct']}% reused), avg {api['avg_ms']} ms",
               reply_markup=admin_markup())
 
 
+# ---- Analytics ----
+
+ANALYTICS_PERIODS = 8     # weeks or months in the trend
+COHORT_MONTHS = 6
+
+
+def _analytics_view(view: str):
+    """Trend or cohort screen, read from the daily rollups (UTC days)."""
+    if view == "cohorts":
+        rows = store.cohort_retention(COHORT_MONTHS)
+        text = "🔁 <b>Repurchase retention</b> — share of each sign-up month renewing in month +N\n\n"
+        for cohort, signed_up, renewed in rows:
+            pcts = " · ".join(f"+{n} {r / signed_up * 100:.0f}%" if signed_up else f"+{n} —"
+                              for n, r in enumerate(renewed))
+            text += f"<b>{cohort[5:]}.{cohort[:4]}</b> ({signed_up}): {pcts}\n"
+        if not rows:
+            text += "No sign-ups yet.\n"
+    else:
+        a = store.analytics(view, ANALYTICS_PERIODS)
+        text = f"📈 <b>Analytics</b> — {'weekly' if view == 'week' else 'monthly'}\n\n"
+        for start, cents, paid, signups, renewals, lessons in a["trend"]:
+            label = f"{start[8:]}.{start[5:7]}" if view == "week" else f"{start[5:7]}.{start[:4]}"
+            text += (f"<b>{label}</b>: {cents / 100:.2f} € ({paid}) · 🆕 {signups} · "
+                     f"🔁 {renewals} · 📚 {lessons}\n")
+        tariffs = ", ".join(f"{escape(t)} ×{n} {c / 100:.2f} €" for t, n, c in a["by_tariff"]) or "—"
+        teachers = ", ".join(f"{escape(name)} {n}" for name, n in a["by_teacher"]) or "—"
+        text += f"\n💰 By plan: {tariffs}\n👩‍🏫 Lessons by teacher: {teachers}"
+    mk = types.InlineKeyboardMarkup()
+    mk.row(types.InlineKeyboardButton("Weekly", callback_data=_cb("an", "week")),
+           types.InlineKeyboardButton("Monthly", callback_data=_cb("an", "month")),
+           types.InlineKeyboardButton("Cohorts", callback_data=_cb("an", "cohorts")))
+    return text, mk
+
+
+@bot.message_handler(commands=["analytics"])
+@bot.message_handler(func=lambda m: m.text == "📈 Analytics")
+def admin_analytics(message):
+    if message.chat.id != ADMIN_ID:
+        return
+    text, mk = _analytics_view("week")
+    safe_send(message.chat.id, text, reply_markup=mk)
+
+
+# ---- Broadcast ----
+
+@bot.message_handler(func=lambda m: m.text == "📣 Broadcast")
+def admin_broadcast(message):
+    if message.chat.id != ADMIN_ID:
+        return
+    msg = safe_send(message.chat.id,
+                    "Enter the message to send to every active student (plain text):",
+                    reply_markup=cancel_markup())
+    if msg:
+        bot.register_next_step_handler(msg, _admin_process_broadcast)
+
+
+def _admin_process_broadcast(message):
+    if message.chat.id != ADMIN_ID:
+        return
+    if is_cancel(message.text):
+        safe_send(message.chat.id, "Cancelled.", reply_markup=admin_markup())
+        return
+    bid, total = create_broadcast(message.text)
+    safe_send(message.chat.id, f"📣 Broadcast #{bid} queued for {total} students.",
+              reply_markup=admin_markup())
+    _send_broadcast_card(message.chat.id, bid)
+
+
+def _broadcast_card(bid: int):
+    p = get_broadcast_progress(bid)
+    text = (f"📣 <b>Broadcast #{bid}</b> — {p['status']}\n\n"
+            f"✅ Sent: {p['sent']} / {p['total']}\n"
+            f"⏳ Pending: {p['pending']}\n"
+            f"🚫 Skipped: {p['skipped']}   ❌ Failed: {p['failed']}")
+    mk = types.InlineKeyboardMarkup()
+    buttons = [types.InlineKeyboardButton("🔄 Refresh", callback_data=_cb("bc", "status", bid))]
+    if p["status"] == "running":
+        buttons.append(types.InlineKeyboardButton("⏸ Pause", callback_data=_cb("bc", "pause", bid)))
+    elif p["status"] == "paused":
+        buttons.append(types.InlineKeyboardButton("▶️ Resume", callback_data=_cb("bc", "resume", bid)))
+    if p["status"] in ("running", "paused"):
+        buttons.append(types.InlineKeyboardButton("⛔ Cancel", callback_data=_cb("bc", "cancel", bid)))
+    mk.row(*buttons)
+    return text, mk
+
+
+def _send_broadcast_card(chat_id: int, bid: int):
+    text, mk = _broadcast_card(bid)
+    safe_send(chat_id, text, reply_markup=mk)
+
+
 # ---- Exit Admin ----
 
 @bot.message_handler(func=lambda m: m.text == "🔙 Exit Admin")
@@ -889,174 +1388,340 @@ def admin_exit(message):
 #        INLINE CALLBACKS
 # ===================================================================
 
+# Every button payload is encoded by callbackdata.Codec; handlers register
+# under a short action code with their argument types, and dispatch is one
+# dict lookup.  Payloads from before the codec are still understood (see
+# _decode_legacy) so buttons in old messages keep working.
+callback_codec = Codec()
+CALLBACK_HANDLERS = {}   # action -> (handler, admin_only)
+
+TARIFF_TABLE = Table(TARIFFS)
+TIMEZONE_TABLE = Table(dict.fromkeys(TIMEZONES.values()))
+PAYMENT_FLOWS = Table(("new", "repurchase"))
+AGENDA_PERIODS = Table(("day", "week"))
+BROADCAST_ACTIONS = Table(("status", "pause", "resume", "cancel"))
+ANALYTICS_VIEWS = Table(("week", "month", "cohorts"))
+
+
+def on_callback(action: str, *fields, admin: bool = False):
+    def register(fn):
+        callback_codec.register(action, *fields)
+        CALLBACK_HANDLERS[action] = (fn, admin)
+        return fn
+    return register
+
+
+def _cb(action: str, *args) -> str:
+    return callback_codec.encode(action, *args)
+
+
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callbacks(call):
+    """Collapse double taps: a press repeated within CALLBACK_DEDUP_TTL (same
+    callback id, or same chat + button) gets the first press's toast and
+    does not touch the database again.  A press whose handler failed is not
+    remembered, so tapping again retries it."""
+    keys = (("id", call.id), ("press", call.message.chat.id, call.data))
+    try:
+        fresh, toast = callback_dedup.run(keys, lambda: _run_callback(call))
+    except _CallbackFailed:
+        return  # already answered; not cached, so a retry runs again
+    if fresh:
+        return
+    text, alert = ("⏳ Still processing…", False) if toast is PENDING else toast
+    try:
+        bot.answer_callback_query(call.id, text, show_alert=alert)
+    except Exception:
+        pass
+
+
+def _answer(call, text: str = None, show_alert: bool = False):
+    """answer_callback_query that remembers the toast for collapsed repeats."""
+    call.toast = (text, show_alert)
+    bot.answer_callback_query(call.id, text, show_alert=show_alert)
+
+
+class _CallbackFailed(Exception):
+    """A handler failed after answering "Error"."""
+
+
+def _run_callback(call):
+    call.toast = (None, False)
+    _handle_callback(call)
+    return call.toast
+
+
+def _decode_legacy(data: str):
+    """(action, args) for payloads written before the codec, e.g. ``done_12``."""
+    prefix, _, rest = data.partition("_")
+    if prefix == "confirmpay":
+        target, _, tail = rest.partition("_")
+        tariff_name, _, flow = tail.partition("|")
+        return "cp", (int(target), tariff_name, flow or "new")
+    if prefix == "setzt":
+        return "st", (rest,)
+    if prefix == "changetz":
+        return "tz", ()
+    if prefix == "addteacher":
+        return "at", ()
+    if prefix == "bcast":
+        action, _, bid = rest.partition("_")
+        return "bc", (action, int(bid))
+    if prefix == "agenda":
+        tid, _, period = rest.partition("_")
+        return "ag", (int(tid), period)
+    simple = {"stucancel": "sc", "rmteacher": "rt", "addlesson": "al", "rmlesson": "rl",
+              "history": "hi", "block": "bl", "cancelbook": "cb", "done": "dn", "util": "ut"}
+    if prefix not in simple:
+        raise ValueError(f"unknown callback data {data!r}")
+    return simple[prefix], (int(rest),)
+
+
+def _handle_callback(call):
     data = call.data
-    chat_id = call.message.chat.id
-
     try:
-        # -- Student: cancel own lesson --
-        if data.startswith("stucancel_"):
-            slot_id = int(data.split("_")[1])
-            student = get_student(call.from_user.id)
-            if not student:
-                bot.answer_callback_query(call.id, "Error")
+        try:
+            action, args = callback_codec.decode(data)
+        except ValueError:
+            try:
+                action, args = _decode_legacy(data)
+            except ValueError:
+                log.warning("Unknown callback data: %r", data)
+                _answer(call, "Error")
                 return
-            slot = get_slot_by_id(slot_id)
-            if slot:
-                try:
-                    lesson_dt = _parse_slot_dt(slot[2], slot[3])
-                    if lesson_dt - datetime.now() < timedelta(hours=24):
-                        bot.answer_callback_query(
-                            call.id,
-                            "❌ Cancellation is only allowed 24+ hours before the lesson",
-                            show_alert=True)
-                        return
-                except ValueError:
-                    pass
-            ok = cancel_booking_by_student(slot_id, student[0])
-            if ok:
-                bot.answer_callback_query(call.id, "✅ Lesson cancelled, balance restored")
-                safe_send(call.from_user.id, "✅ Lesson cancelled. Credit returned.",
-                          reply_markup=main_menu(call.from_user.id))
-                safe_send(ADMIN_ID, f"ℹ️ {student[2]} cancelled lesson (slot #{slot_id})")
-            else:
-                bot.answer_callback_query(call.id, "❌ Could not cancel")
+        handler, admin_only = CALLBACK_HANDLERS[action]
+        if admin_only and call.message.chat.id != ADMIN_ID:
             return
+        handler(call, *args)
+    except Exception:
+        log.exception("Callback error: %s", data)
+        try:
+            _answer(call, "Error")
+        except Exception:
+            pass
+        raise _CallbackFailed from None
 
-        # -- Student: change timezone --
-        if data == "changetz":
-            mk = types.InlineKeyboardMarkup()
-            for label, tz_val in TIMEZONES.items():
-                mk.add(types.InlineKeyboardButton(label, callback_data=f"setzt_{tz_val}"))
-            safe_send(call.from_user.id, "Select your timezone:", reply_markup=mk)
-            bot.answer_callback_query(call.id)
-            return
 
-        if data.startswith("setzt_"):
-            tz = data[6:]
-            update_student_timezone(call.from_user.id, tz)
-            bot.answer_callback_query(call.id, f"✅ Timezone: {tz}")
-            safe_send(call.from_user.id, f"✅ Timezone changed to {tz}",
-                      reply_markup=main_menu(call.from_user.id))
-            return
+# ---- Student ----
 
-        # -- Admin: add teacher (via next_step) --
-        if data == "addteacher":
-            if chat_id != ADMIN_ID:
-                return
-            msg = safe_send(chat_id,
-                            "Enter teacher info:\nName\nZoom link (optional)\n\n"
-                            "Example:\nAnna\nhttps://zoom.us/j/123",
-                            reply_markup=cancel_markup())
-            bot.answer_callback_query(call.id)
-            if msg:
-                bot.register_next_step_handler(msg, _admin_process_add_teacher)
-            return
+@on_callback("sc", int)
+def cb_student_cancel(call, slot_id: int):
+    student = store.students.get(call.from_user.id)
+    if not student:
+        _answer(call, "Error")
+        return
+    slot = store.slots.get(slot_id)
+    if slot and slot[8] is not None and slot[8] - utc_now() < CANCEL_WINDOW:
+        _answer(call,
+                "❌ Cancellation is only allowed 24+ hours before the lesson",
+                show_alert=True)
+        return
+    ok = store.slots.cancel_by_student(
+        slot_id, student[0],
+        notify=[_admin_event("cancel",
+                             f"ℹ️ {student[2]} cancelled lesson (slot #{slot_id})")])
+    if ok:
+        _answer(call, "✅ Lesson cancelled, balance restored")
+        safe_send(call.from_user.id, "✅ Lesson cancelled. Credit returned.",
+                  reply_markup=main_menu(call.from_user.id))
+    else:
+        _answer(call, "❌ Could not cancel")
+
+
+@on_callback("tz")
+def cb_timezone_menu(call):
+    mk = types.InlineKeyboardMarkup()
+    for label, tz_val in TIMEZONES.items():
+        mk.add(types.InlineKeyboardButton(label, callback_data=_cb("st", tz_val)))
+    safe_send(call.from_user.id, "Select your timezone:", reply_markup=mk)
+    _answer(call)
 
-        if data.startswith("rmteacher_"):
-            if chat_id != ADMIN_ID:
-                return
-            tid = int(data.split("_")[1])
-            ok = remove_teacher(tid)
-            if ok:
-                bot.answer_callback_query(call.id, "✅ Teacher removed")
-                safe_send(chat_id, f"✅ Teacher #{tid} removed.")
-            else:
-                bot.answer_callback_query(call.id, "❌ Error")
-            return
 
-        # -- Admin-only callbacks --
-        if chat_id != ADMIN_ID:
+@on_callback("st", TIMEZONE_TABLE)
+def cb_set_timezone(call, tz: str):
+    store.students.set_timezone(call.from_user.id, tz)
+    _answer(call, f"✅ Timezone: {tz}")
+    safe_send(call.from_user.id, f"✅ Timezone changed to {tz}",
+              reply_markup=main_menu(call.from_user.id))
+
+
+# ---- Admin: teachers ----
+
+@on_callback("at", admin=True)
+def cb_add_teacher(call):
+    chat_id = call.message.chat.id
+    msg = safe_send(chat_id,
+                    "Enter teacher info:\nName\nZoom link (optional)\n\n"
+                    "Example:\nAnna\nhttps://zoom.us/j/123",
+                    reply_markup=cancel_markup())
+    _answer(call)
+    if msg:
+        bot.register_next_step_handler(msg, _admin_process_add_teacher)
+
+
+@on_callback("rt", int, admin=True)
+def cb_remove_teacher(call, tid: int):
+    result = store.teachers.remove(tid)
+    if result:
+        freed, booked = result
+        _answer(call, "✅ Teacher removed")
+        safe_send(call.message.chat.id,
+                  f"✅ Teacher #{tid} removed.\n"
+                  f"🗑 {freed} future free slots deleted."
+                  + (f"\n⚠️ {booked} booked lessons remain — cancel or mark them done."
+                     if booked else ""))
+    else:
+        _answer(call, "❌ Error")
+
+
+@on_callback("ag", int, AGENDA_PERIODS, admin=True)
+def cb_agenda(call, tid: int, period: str):
+    teacher = store.teachers.get(tid)
+    if not teacher:
+        _answer(call, "❌ Teacher not found")
+        return
+    _answer(call)
+    text, mk = _agenda_view(teacher, period)
+    if call.message.text and call.message.text.startswith("📋"):
+        _show_view(call, text, mk)
+    else:
+        safe_send(call.message.chat.id, text, reply_markup=mk)
+
+
+@on_callback("ut", int, admin=True)
+def cb_utilization(call, offset: int):
+    _answer(call)
+    text, mk = _utilization_view(offset)
+    if call.message.text and call.message.text.startswith("📈"):
+        _show_view(call, text, mk)
+    else:
+        safe_send(call.message.chat.id, text, reply_markup=mk)
+
+
+@on_callback("an", ANALYTICS_VIEWS, admin=True)
+def cb_analytics(call, view: str):
+    _answer(call)
+    _show_view(call, *_analytics_view(view))
+
+
+# ---- Admin: students ----
+
+@on_callback("al", int, admin=True)
+def cb_add_lesson(call, sid: int):
+    chat_id = call.message.chat.id
+    store.students.adjust_balance(sid, +1, ref=f"admin:{chat_id}")
+    _answer(call, "✅ Lesson added")
+    safe_send(chat_id, f"✅ +1 lesson for student #{sid}")
+
+
+@on_callback("rl", int, admin=True)
+def cb_remove_lesson(call, sid: int):
+    chat_id = call.message.chat.id
+    ok = store.students.adjust_balance(sid, -1, ref=f"admin:{chat_id}")
+    if ok:
+        _answer(call, "➖ Lesson deducted")
+        safe_send(chat_id, f"➖ Lesson deducted from #{sid}")
+        st = store.students.get_by_id(sid)
+        if st and st[5] == 0:
+            safe_send(chat_id, f"⚠️ Student {st[2]} balance is now 0!")
+    else:
+        _answer(call, "❌ Balance already 0")
+
+
+@on_callback("hi", int, admin=True)
+def cb_history(call, sid: int):
+    entries = store.students.balance_history(sid)
+    _answer(call)
+    if not entries:
+        safe_send(call.message.chat.id, f"No balance history for #{sid}.")
+        return
+    text = f"📜 Balance history #{sid}\n\n"
+    for e in entries:
+        text += (f"{e[5]}  {e[1]:+d} → {e[2]}  {LEDGER_REASONS.get(e[3], e[3])}"
+                 + (f" ({e[4]})" if e[4] else "") + "\n")
+    safe_send(call.message.chat.id, text)
+
+
+@on_callback("bl", int, admin=True)
+def cb_block(call, sid: int):
+    new = store.students.toggle_status(sid)
+    label = "🚫 Blocked" if new == "blocked" else "✅ Unblocked"
+    _answer(call, label)
+    safe_send(call.message.chat.id, f"#{sid}: {label}")
+
+
+# ---- Admin: bookings ----
+
+@on_callback("cb", int, admin=True)
+def cb_cancel_booking(call, slot_id: int):
+    if store.slots.cancel(slot_id):
+        _answer(call, "✅ Cancelled")
+        safe_send(call.message.chat.id, f"✅ Booking #{slot_id} cancelled, lesson returned.")
+    else:
+        _answer(call, "❌ Error")
+
+
+@on_callback("dn", int, admin=True)
+def cb_lesson_done(call, slot_id: int):
+    if store.slots.mark_done(slot_id):
+        _answer(call, "✅ Done")
+        safe_send(call.message.chat.id, f"✅ Lesson #{slot_id} marked as done.")
+    else:
+        _answer(call, "❌ Error")
+
+
+# ---- Admin: broadcasts ----
+
+@on_callback("bc", BROADCAST_ACTIONS, int, admin=True)
+def cb_broadcast(call, action: str, bid: int):
+    if action != "status":
+        target = {"pause": "paused", "resume": "running", "cancel": "cancelled"}[action]
+        if not set_broadcast_status(bid, target):
+            _answer(call, "❌ Not possible now")
             return
+    _answer(call)
+    text, mk = _broadcast_card(bid)
+    _show_view(call, text, mk)
 
-        if data.startswith("addlesson_"):
-            sid = int(data.split("_")[1])
-            update_lessons_balance(sid, +1)
-            bot.answer_callback_query(call.id, "✅ Lesson added")
-            safe_send(chat_id, f"✅ +1 lesson for student #{sid}")
-
-        elif data.startswith("rmlesson_"):
-            sid = int(data.split("_")[1])
-            ok = update_lessons_balance(sid, -1)
-            if ok:
-                bot.answer_callback_query(call.id, "➖ Lesson deducted")
-                safe_send(chat_id, f"➖ Lesson deducted from #{sid}")
-                st = get_student_by_id(sid)
-                if st and st[5] == 0:
-                    safe_send(chat_id, f"⚠️ Student {st[2]} balance is now 0!")
-            else:
-                bot.answer_callback_query(call.id, "❌ Balance already 0")
-
-        elif data.startswith("block_"):
-            sid = int(data.split("_")[1])
-            new = toggle_student_status(sid)
-            label = "🚫 Blocked" if new == "blocked" else "✅ Unblocked"
-            bot.answer_callback_query(call.id, label)
-            safe_send(chat_id, f"#{sid}: {label}")
-
-        elif data.startswith("cancelbook_"):
-            slot_id = int(data.split("_")[1])
-            ok = cancel_booking(slot_id)
-            if ok:
-                bot.answer_callback_query(call.id, "✅ Cancelled")
-                safe_send(chat_id, f"✅ Booking #{slot_id} cancelled, lesson returned.")
-            else:
-                bot.answer_callback_query(call.id, "❌ Error")
-
-        elif data.startswith("done_"):
-            slot_id = int(data.split("_")[1])
-            ok = mark_lesson_done(slot_id)
-            if ok:
-                bot.answer_callback_query(call.id, "✅ Done")
-                safe_send(chat_id, f"✅ Lesson #{slot_id} marked as done.")
-            else:
-                bot.answer_callback_query(call.id, "❌ Error")
-
-        elif data.startswith("confirmpay_"):
-            rest = data[len("confirmpay_"):]
-            parts = rest.split("|")
-            target_chat = int(parts[0].rsplit("_", 1)[0])
-            flow = parts[1] if len(parts) > 1 else "new"
-
-            tariff_name = None
-            for t in TARIFFS:
-                if t in call.message.text:
-                    tariff_name = t
-                    break
-            if not tariff_name:
-                bot.answer_callback_query(call.id, "❌ Plan not found")
-                return
 
-            tariff = TARIFFS[tariff_name]
-            if flow == "repurchase":
-                repurchase_tariff(target_chat, tariff_name, tariff["lessons"])
-                student = get_student(target_chat)
-                safe_send(target_chat,
-                          f"✅ Payment confirmed!\n📚 {tariff_name}\n"
-                          f"Balance: {student[5]} lessons",
-                          reply_markup=main_menu(target_chat))
-            else:
-                state = get_reg_state(target_chat)
-                tz = _user_tz_cache.pop(target_chat, "Europe/Paris")
-                name = state["name"] if state else "Student"
-                email = state["email"] if state else "—"
-                add_student(target_chat, name, email, tariff_name, tariff["lessons"], tz)
-                clear_reg_state(target_chat)
-                safe_send(target_chat,
-                          f"✅ Payment confirmed, {name}!\n"
-                          f"Plan: {tariff_name}\nLessons: {tariff['lessons']}",
-                          reply_markup=main_menu(target_chat))
-
-            bot.answer_callback_query(call.id, "✅ Confirmed")
-            safe_send(chat_id, "✅ Payment confirmed.")
+# ---- Admin: manual payment confirmation ----
 
-    except Exception:
-        log.exception("Callback error: %s", data)
-        try:
-            bot.answer_callback_query(call.id, "Error")
-        except Exception:
-            pass
+@on_callback("cp", int, TARIFF_TABLE, PAYMENT_FLOWS, admin=True)
+def cb_confirm_payment(call, target_chat: int, tariff_name: str, flow: str):
+    chat_id = call.message.chat.id
+    tariff = TARIFFS.get(tariff_name)
+    if not tariff:   # legacy payload cut short by the 64-byte limit
+        _answer(call, "❌ Plan not found")
+        return
+    menu = _menu_markup(True).to_json()
+    if flow == "repurchase":
+        balance = store.students.repurchase(
+            target_chat, tariff_name, tariff["lessons"],
+            notify=lambda balance: [Notice(target_chat,
+                                           f"✅ Payment confirmed!\n📚 {tariff_name}\n"
+                                           f"Balance: {balance} lessons", menu)])
+        if balance is None:
+            _answer(call, "❌ Student not found")
+            return
+    else:
+        state = store.registration.get(target_chat)
+        tz = _user_tz_cache.pop(target_chat, "Europe/Paris")
+        name = state["name"] if state else "Student"
+        email = state["email"] if state else "—"
+        store.students.add(target_chat, name, email, tariff_name, tariff["lessons"], tz,
+                           notify=[Notice(target_chat,
+                                          f"✅ Payment confirmed, {name}!\n"
+                                          f"Plan: {tariff_name}\nLessons: {tariff['lessons']}",
+                                          menu)])
+        store.registration.clear(target_chat)
+
+    _answer(call, "✅ Confirmed")
+    safe_send(chat_id, "✅ Payment confirmed.")
+    # Drop the buttons so the request cannot be confirmed a second time.
+    try:
+        bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=None)
+    except ApiTelegramException:
+        pass
 
 
 # ---- Admin: process add teacher (next_step) ----
@@ -1070,7 +1735,7 @@ def _admin_process_add_teacher(message):
     lines = message.text.strip().split("\n")
     name = lines[0].strip()
     zoom = lines[1].strip() if len(lines) > 1 else ""
-    tid = add_teacher(name, zoom)
+    tid = store.teachers.add(name, zoom)
     safe_send(message.chat.id,
               f"✅ Teacher #{tid} added: {name}" + (f"\n🔗 {zoom}" if zoom else ""),
               reply_markup=admin_markup())
@@ -1090,30 +1755,395 @@ def echo(message):
 #        REMINDERS
 # ===================================================================
 
-def _reminder_loop():
+def _send_due_reminders():
+    for flag, hours, label in [
+        ("reminded_24h", 24, "Tomorrow"),
+        ("reminded_2h", 2, "In ~2 hours"),
+    ]:
+        for row in store.slots.upcoming_unreminded(flag, hours * 3600):
+            slot_id, teacher, date, time_str, zoom, tg_id, name, tz, starts_at = row
+            date, time_str = render_slot(date, time_str, starts_at, tz)
+            store.slots.claim_reminder(slot_id, flag,
+                                       Notice(tg_id,
+                                              f"⏰ Reminder! {label} you have a lesson:\n\n"
+                                              f"📅 {date} at {time_str} ({tz})\n"
+                                              f"👩‍🏫 {teacher}\n🔗 {zoom}"))
+
+
+def _render_digest(rows) -> str:
+    by_category: dict = {}
+    for category, text, _created in rows:
+        by_category.setdefault(category, []).append(
+            " · ".join(line for line in text.split("\n") if line.strip()))
+    out = f"🗂 <b>Admin digest</b> — {len(rows)} events\n"
+    full, left_out = False, 0
+    for category, items in by_category.items():
+        section = f"\n<b>{DIGEST_CATEGORIES.get(category, category)} ({len(items)})</b>\n"
+        if full or len(out) + len(section) > DIGEST_MAX_CHARS:
+            full = True
+            left_out += len(items)
+            continue
+        out += section
+        shown = 0
+        for item in items[:DIGEST_MAX_LINES]:
+            line = f"• {escape(item)}\n"
+            if len(out) + len(line) > DIGEST_MAX_CHARS:
+                full = True
+                break
+            out += line
+            shown += 1
+        if len(items) > shown:
+            out += f"…and {len(items) - shown} more\n"
+    if left_out:
+        out += f"\n…and {left_out} more events\n"
+    return out
+
+
+def _flush_admin_digest():
+    merged = collapse_digest(ADMIN_ID, _render_digest)
+    if merged:
+        log.info("Admin digest: merged %s events", merged)
+
+
+def _close_day():
+    counts = store.slots.close_day()
+    if counts:
+        log.info("Closed %d past lessons: %s", sum(n for _t, n in counts),
+                 ", ".join(f"{teacher} {n}" for teacher, n in counts))
+
+
+# Periodic jobs run only by the lease holder: (interval seconds, function).
+LEADER_JOBS = [
+    (REMINDER_INTERVAL, _send_due_reminders),
+    (ADMIN_DIGEST_WINDOW or 60, _flush_admin_digest),
+]
+if CLOSE_DAY_INTERVAL > 0:
+    LEADER_JOBS.append((CLOSE_DAY_INTERVAL, _close_day))
+
+
+def _leader_loop():
+    """Hold the leader lease.  Jobs run in _leader_jobs_loop, so a job that
+    outlasts LEADER_LEASE_TTL cannot let the lease lapse under it."""
+    leader = False
     while True:
+        # On shutdown keep renewing until the running job is done; holding
+        # the job lock also stops a new one from starting.
+        if _shutdown.is_set() and (not leader or _leader_job_lock.acquire(blocking=False)):
+            break
+        try:
+            is_leader = acquire_lease("leader", INSTANCE_ID, LEADER_LEASE_TTL)
+            if is_leader != leader:
+                log.info("%s leadership: %s", INSTANCE_ID,
+                         "acquired" if is_leader else "lost")
+                leader = is_leader
+                (_is_leader.set if leader else _is_leader.clear)()
+        except Exception:
+            log.exception("Leader loop error")
+        if _shutdown.is_set():
+            _time.sleep(min(1.0, LEADER_LEASE_TTL / 3))
+        else:
+            _shutdown.wait(LEADER_LEASE_TTL / 3)
+    if leader:
+        # Hand over now rather than after LEADER_LEASE_TTL.
+        _is_leader.clear()
+        release_lease("leader", INSTANCE_ID)
+        log.info("%s leadership released", INSTANCE_ID)
+
+
+_leader_job_lock = threading.Lock()
+
+
+def _leader_jobs_loop():
+    leader = False
+    last_run = [0.0] * len(LEADER_JOBS)
+    while not _shutdown.is_set():
+        if _is_leader.is_set() != leader:
+            leader, last_run = not leader, [0.0] * len(LEADER_JOBS)
+        for i, (interval, job) in enumerate(LEADER_JOBS if leader else ()):
+            if _time.monotonic() - last_run[i] < interval:
+                continue
+            if not _leader_job_lock.acquire(timeout=1):
+                break
+            try:
+                if _shutdown.is_set() or not _is_leader.is_set():
+                    break
+                last_run[i] = _time.monotonic()
+                job()
+            except Exception:
+                log.exception("Leader job %s failed", job.__name__)
+            finally:
+                _leader_job_lock.release()
+        _shutdown.wait(1)
+
+
+# ===================================================================
+#        OUTBOX SENDER
+# ===================================================================
+
+def _deliver(row):
+    """Send one outbox row; returns Telegram's retry_after on a 429."""
+    outbox_id, chat_id, text, reply_markup, attempts = row
+    backoff = min(OUTBOX_MAX_BACKOFF, 2 ** attempts)
+    try:
+        bot.send_message(chat_id, text, reply_markup=reply_markup)
+    except ApiTelegramException as e:
+        if e.error_code == 429:
+            retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", backoff)
+            mark_outbox_failed(outbox_id, str(e), retry_after)
+            return retry_after
+        elif e.error_code in (400, 403) or attempts >= OUTBOX_MAX_ATTEMPTS:
+            # Blocked by the user / chat gone / malformed: retrying will not help.
+            log.warning("Outbox #%s to %s failed permanently: %s", outbox_id, chat_id, e)
+            mark_outbox_failed(outbox_id, str(e), None)
+        else:
+            mark_outbox_failed(outbox_id, str(e), backoff)
+    except Exception as e:
+        log.warning("Outbox #%s to %s failed (attempt %s): %s", outbox_id, chat_id, attempts, e)
+        mark_outbox_failed(outbox_id, str(e), None if attempts >= OUTBOX_MAX_ATTEMPTS else backoff)
+    else:
+        mark_outbox_sent(outbox_id)
+
+
+def _outbox_loop():
+    while not _shutdown.is_set():
+        try:
+            batch = claim_outbox_batch(OUTBOX_BATCH)
+            for i, row in enumerate(batch):
+                retry_after = _deliver(row)
+                if retry_after is not None:
+                    # Flood limit: the rest of the batch waits it out too.
+                    release_outbox_rows([r[0] for r in batch[i + 1:]], retry_after)
+                    log.warning("Outbox paused for %ss (429)", retry_after)
+                    _shutdown.wait(retry_after)
+                    break
+            else:
+                if len(batch) == OUTBOX_BATCH:
+                    continue
+        except Exception:
+            log.exception("Outbox loop error")
+        _shutdown.wait(OUTBOX_POLL_INTERVAL)
+
+
+# ===================================================================
+#        WAL CHECKPOINTER
+# ===================================================================
+
+def _checkpoint_loop():
+    set_wal_autocheckpoint(0)
+    while not _shutdown.wait(WAL_CHECKPOINT_INTERVAL):
+        try:
+            size = wal_size()
+            mode = "TRUNCATE" if size >= WAL_TRUNCATE_MB * 1048576 else "PASSIVE"
+            busy, frames, done = checkpoint_wal(mode)
+            log.log(logging.INFO if mode == "TRUNCATE" or busy else logging.DEBUG,
+                    "WAL checkpoint (%s): %.1f MB, %d/%d frames copied%s",
+                    mode, size / 1048576, done, frames, ", busy" if busy else "")
+        except Exception:
+            log.exception("WAL checkpoint failed")
+
+
+# ===================================================================
+#        SCHEDULED BACKUPS
+# ===================================================================
+
+def _backup_loop():
+    while not _shutdown.wait(60):
         try:
-            now = datetime.now()
-            for flag, hours, label in [
-                ("reminded_24h", 24, "Tomorrow"),
-                ("reminded_2h", 2, "In ~2 hours"),
-            ]:
-                for row in get_upcoming_unreminded(flag):
-                    slot_id, teacher, date, time_str, zoom, tg_id, name, tz = row
-                    try:
-                        lesson_dt = _parse_slot_dt(date, time_str)
-                    except ValueError:
+            if not _is_leader.is_set():
+                continue
+            age = backups.last_backup_age()
+            if age is None or age >= BACKUP_INTERVAL:
+                _run_backup()
+        except Exception:
+            log.exception("Backup loop error")
+
+
+# ===================================================================
+#        BROADCAST SENDER
+# ===================================================================
+
+_is_leader = threading.Event()
+
+
+# Telegram errors that concern the message itself, not the recipient: the
+# job is paused instead of failing every remaining student.
+BROADCAST_FATAL_ERRORS = ("message is too long", "message text is empty", "can't parse entities")
+
+
+def _broadcast_loop():
+    interval = 1 / BROADCAST_RATE
+    next_send = 0.0
+    failures = 0    # consecutive transient errors, for the backoff
+    while not _shutdown.is_set():
+        try:
+            job = get_running_broadcast() if _is_leader.is_set() else None
+            if not job:
+                _shutdown.wait(5)
+                continue
+            bid, text = job
+            batch = get_broadcast_batch(bid, BROADCAST_BATCH)
+            if not batch:
+                finish_broadcast(bid, [Notice(ADMIN_ID, f"📣 Broadcast #{bid} finished.")])
+                continue
+            for tg_id in batch:
+                # Stop mid-batch if the job was paused/cancelled, leadership
+                # moved or the bot is shutting down.
+                if (_shutdown.is_set() or not _is_leader.is_set()
+                        or get_running_broadcast() != job):
+                    break
+                _time.sleep(max(0.0, next_send - _time.monotonic()))
+                next_send = max(next_send, _time.monotonic()) + interval
+                error = None
+                try:
+                    # Sent as plain text: the admin's message is not markup.
+                    bot.send_message(tg_id, text, parse_mode="")
+                except ApiTelegramException as e:
+                    if e.error_code == 429:
+                        retry = (e.result_json or {}).get("parameters", {}).get("retry_after", 5)
+                        _shutdown.wait(retry)
+                        break  # recipient stays pending
+                    if e.error_code == 400 and any(m in e.description.lower()
+                                                   for m in BROADCAST_FATAL_ERRORS):
+                        log.warning("Broadcast #%s paused: %s", bid, e.description)
+                        if set_broadcast_status(bid, "paused"):
+                            enqueue_notifications(Notice(
+                                ADMIN_ID, f"⏸ Broadcast #{bid} paused: {escape(e.description)}"))
+                        break
+                    if e.error_code in (400, 403):
+                        status = "skipped" if e.error_code == 403 else "failed"
+                        mark_broadcast_recipient(bid, tg_id, status, str(e))
                         continue
-                    diff = lesson_dt - now
-                    if timedelta(0) < diff <= timedelta(hours=hours):
-                        safe_send(tg_id,
-                                  f"⏰ Reminder! {label} you have a lesson:\n\n"
-                                  f"📅 {date} at {time_str}\n"
-                                  f"👩‍🏫 {teacher}\n🔗 {zoom}")
-                        mark_reminded(slot_id, flag)
+                    error = e
+                except Exception as e:
+                    error = e
+                if error is None:
+                    failures = 0
+                    mark_broadcast_recipient(bid, tg_id, "sent")
+                    continue
+                # 5xx or network trouble: the recipient stays pending.
+                failures += 1
+                log.warning("Broadcast #%s: %s (retrying)", bid, error)
+                _shutdown.wait(min(OUTBOX_MAX_BACKOFF, 2 ** failures))
+                break
         except Exception:
-            log.exception("Reminder loop error")
-        _time.sleep(300)
+            log.exception("Broadcast loop error")
+            _shutdown.wait(5)
+
+
+# ===================================================================
+#        STARTUP / SHUTDOWN
+# ===================================================================
+
+_background: list = []
+
+
+def _start_background(target):
+    thread = threading.Thread(target=target, name=target.__name__, daemon=True)
+    thread.start()
+    _background.append(thread)
+
+
+def _on_every_worker(fn, timeout: float) -> bool:
+    """Run ``fn`` once on each handler worker thread, after everything already
+    queued.  False if the workers did not all get there within ``timeout``."""
+    pool = bot.worker_pool
+    if pool is None:
+        fn()
+        return True
+    barrier = threading.Barrier(pool.num_threads + 1)
+
+    def task():
+        try:
+            fn()
+        except Exception:
+            log.exception("Worker task %s failed", fn.__name__)
+        try:
+            # Holding every worker here makes each one take exactly one task.
+            barrier.wait(timeout)
+        except threading.BrokenBarrierError:
+            pass
+
+    for _ in range(pool.num_threads):
+        pool.put(task)
+    try:
+        barrier.wait(timeout)
+        return True
+    except threading.BrokenBarrierError:
+        return False
+
+
+def _warm_worker():
+    store.students.exists(0)   # opens this thread's reader connection
+    bot.get_me()               # and a pooled HTTP connection
+
+
+def _warm_up():
+    """Open connections and fill caches before the first update arrives."""
+    started = _time.monotonic()
+    try:
+        _ = bot.user
+        store.slots.free()
+        store.teachers.utilization(*period_bounds("week"))
+        store.statistics()
+        _on_every_worker(_warm_worker, timeout=15)
+    except Exception as e:
+        log.warning("Warm-up incomplete: %s", e)
+    log.info("Warm-up done in %.0f ms", (_time.monotonic() - started) * 1000)
+
+
+def _flush_outbox(deadline: float) -> int:
+    sent = 0
+    while _time.monotonic() < deadline:
+        batch = claim_outbox_batch(OUTBOX_BATCH)
+        for i, row in enumerate(batch):
+            if _time.monotonic() >= deadline:
+                release_outbox_rows([r[0] for r in batch[i:]], 0)
+                return sent
+            retry_after = _deliver(row)
+            if retry_after is not None:
+                # Rate limited: leave the rest to the next process.
+                release_outbox_rows([r[0] for r in batch[i + 1:]], retry_after)
+                return sent
+            sent += 1
+        if len(batch) < OUTBOX_BATCH:
+            break
+    return sent
+
+
+def _graceful_shutdown():
+    """Stop taking updates, let in-flight work finish within SHUTDOWN_TIMEOUT
+    and leave the database checkpointed."""
+    started = _time.monotonic()
+    deadline = started + SHUTDOWN_TIMEOUT
+
+    def remaining():
+        return max(0.0, deadline - _time.monotonic())
+
+    log.info("Shutting down, draining for up to %.0fs…", SHUTDOWN_TIMEOUT)
+    with _ingress_lock:
+        _shutdown.set()
+    bot.stop_polling()
+    if not _on_every_worker(lambda: None, remaining()):
+        log.warning("Handlers still running at the shutdown deadline")
+    for thread in _background:
+        thread.join(remaining())
+        if thread.is_alive():
+            log.warning("%s still running at the shutdown deadline", thread.name)
+    sent = _flush_outbox(deadline)
+    if isinstance(bot.next_step_backend, FileHandlerBackend):
+        bot.next_step_backend.save_handlers()
+    flood = flood_guard.stats()
+    log.info("Final stats: %d updates allowed, %d dropped by flood control, %d taps collapsed, "
+             "%d replays skipped, %d outbox messages flushed; outbox %s; Bot API %s",
+             flood["allowed"], flood["dropped"], callback_dedup.collapsed,
+             replayed_updates, sent, get_outbox_stats(), bot_api.stats())
+    if not store.in_memory:
+        try:
+            busy, frames, done = checkpoint_wal("TRUNCATE")
+            log.info("WAL checkpoint: %d/%d frames%s", done, frames, ", busy" if busy else "")
+        except Exception:
+            log.exception("Final WAL checkpoint failed")
+    log.info("Shutdown complete in %.1fs", _time.monotonic() - started)
 
 
 # ===================================================================
@@ -1121,12 +2151,33 @@ def _reminder_loop():
 # ===================================================================
 
 def main():
-    log.info("Starting reminder thread…")
-    threading.Thread(target=_reminder_loop, daemon=True).start()
+    bot_api.install()
+    init_db()
+    bot.last_update_id = get_last_update_id()
+    if not store.in_memory:
+        bot.enable_save_next_step_handlers(delay=30, filename=STEP_SAVE_FILE)
+        bot.load_next_step_handlers(STEP_SAVE_FILE)
+    _warm_up()
+    log.info("Starting background threads…")
+    _start_background(_leader_loop)
+    _start_background(_leader_jobs_loop)
+    _start_background(_outbox_loop)
+    _start_background(_broadcast_loop)
+    if WAL_CHECKPOINT_INTERVAL > 0:
+        _start_background(_checkpoint_loop)
+    if BACKUP_INTERVAL > 0 and not store.in_memory:
+        _start_background(_backup_loop)
+    # SIGTERM behaves like Ctrl+C: polling stops and the drain below runs.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     log.info("Bot started. PROVIDER_TOKEN=%s",
              "SET" if STRIPE_PROVIDER_TOKEN else "NOT SET (manual mode)")
-    bot.infinity_polling(timeout=30, long_polling_timeout=20)
+    try:
+        bot.infinity_polling(timeout=30, long_polling_timeout=20)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _graceful_shutdown()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
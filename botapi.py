@@ -0,0 +1,98 @@
+"""Shared keep-alive HTTP session for Bot API calls.
+
+By default telebot gives every thread its own requests.Session and replaces
+it every ten minutes, so a connection is only reused by the thread that
+opened it and each replacement pays for a new TCP + TLS handshake.
+BotApiSession routes every call through one Session whose connection pool is
+sized to the number of threads that talk to the API:
+
+    api = BotApiSession(pool_size=8)
+    api.install()
+    api.stats()     # requests, connections opened, reuse, latency
+
+BOTAPI_BASE_URL points the bot at another server, e.g. a local Bot API
+server or benchmarks/mock_bot_api.py.
+"""
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+
+CONNECT_TIMEOUT = float(os.environ.get("BOTAPI_CONNECT_TIMEOUT", "5"))
+# getUpdates gets long_polling_timeout + 5 instead (telebot computes that).
+READ_TIMEOUT = float(os.environ.get("BOTAPI_READ_TIMEOUT", "15"))
+# Default: https://api.telegram.org
+BASE_URL = os.environ.get("BOTAPI_BASE_URL", "").rstrip("/")
+
+
+class BotApiSession:
+    """One pooled Session shared by all threads.
+
+    The pool does not block: if more threads than ``pool_size`` call at once
+    the extra connections are opened and then dropped, which shows up as
+    ``connections`` growing faster than it should.
+    """
+
+    def __init__(self, pool_size: int, connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT, base_url: str = BASE_URL):
+        self.pool_size = pool_size
+        self.base_url = base_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self._timed = 0
+        self._seconds = 0.0
+
+    def install(self):
+        """Make telebot send every Bot API request through this session."""
+        apihelper.CONNECT_TIMEOUT = self.connect_timeout
+        apihelper.READ_TIMEOUT = self.read_timeout
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+        if self.base_url:
+            apihelper.API_URL = self.base_url + "/bot{0}/{1}"
+            apihelper.FILE_URL = self.base_url + "/file/bot{0}/{1}"
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        started = time.monotonic()
+        try:
+            return self.session.request(method, url, params=params, files=files,
+                                        timeout=timeout, proxies=proxies)
+        except requests.RequestException:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.requests += 1
+                # Long polls would swamp the latency figure.
+                if not url.endswith("/getUpdates"):
+                    self._timed += 1
+                    self._seconds += time.monotonic() - started
+
+    def _pools(self):
+        pools = self.adapter.poolmanager.pools
+        return [p for p in (pools.get(key) for key in pools.keys()) if p is not None]
+
+    def stats(self) -> dict:
+        pools = self._pools()
+        opened = sum(p.num_connections for p in pools)
+        with self._lock:
+            requests_, errors, timed, seconds = self.requests, self.errors, self._timed, self._seconds
+        return {
+            "requests": requests_,
+            "errors": errors,
+            "connections": opened,
+            # The pool queue is padded with None placeholders.
+            "idle": sum(1 for p in pools if p.pool for conn in list(p.pool.queue) if conn),
+            "reused_pct": round(100 * (1 - opened / requests_), 1) if requests_ else 0.0,
+            "avg_ms": round(1000 * seconds / timed, 1) if timed else 0.0,
+        }
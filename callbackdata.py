@@ -0,0 +1,86 @@
+"""Compact, versioned inline-button payloads.
+
+    codec.register("sc", int)
+    codec.encode("sc", 4242)      -> "1:sc:39u"
+    codec.decode("1:sc:39u")      -> ("sc", (4242,))
+
+A payload is ``<version>:<action>[:<arg>...]``.  Each action declares its
+argument types up front: ``int`` values are written in base 36, and values
+from a fixed table (tariff names, time zones, ...) are written as their index
+in that table, so nothing long or free-form ever goes into the 64 bytes
+Telegram allows.
+"""
+from typing import Dict, Hashable, Sequence, Tuple
+
+VERSION = "1"
+MAX_BYTES = 64
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _b36(n: int) -> str:
+    if n < 0:
+        return "-" + _b36(-n)
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _DIGITS[r] + out
+        if not n:
+            return out
+
+
+class Table:
+    """Server-side token table: a value travels as its index."""
+
+    def __init__(self, values: Sequence[Hashable]):
+        self.values = list(values)
+        self._index = {v: i for i, v in enumerate(self.values)}
+
+    def encode(self, value) -> str:
+        return _b36(self._index[value])
+
+    def decode(self, token: str):
+        return self.values[int(token, 36)]
+
+
+class Codec:
+    def __init__(self):
+        self._actions: Dict[str, Tuple] = {}
+
+    def register(self, action: str, *fields):
+        if ":" in action or action in self._actions:
+            raise ValueError(f"bad or duplicate callback action {action!r}")
+        self._actions[action] = fields
+
+    def encode(self, action: str, *args) -> str:
+        fields = self._actions[action]
+        if len(args) != len(fields):
+            raise TypeError(f"{action} takes {len(fields)} arguments, got {len(args)}")
+        parts = [VERSION, action]
+        parts += [_b36(a) if f is int else f.encode(a) for f, a in zip(fields, args)]
+        data = ":".join(parts)
+        if len(data.encode()) > MAX_BYTES:
+            raise ValueError(f"callback data too long: {data!r}")
+        return data
+
+    def decode(self, data: str) -> Tuple[str, tuple]:
+        """(action, args); ValueError for anything that is not a current payload."""
+        parts = (data or "").split(":")
+        if len(parts) < 2 or parts[0] != VERSION or parts[1] not in self._actions:
+            raise ValueError(f"unknown callback data {data!r}")
+        fields = self._actions[parts[1]]
+        if len(parts) - 2 != len(fields):
+            raise ValueError(f"wrong argument count in {data!r}")
+        try:
+            args = tuple(int(p, 36) if f is int else f.decode(p)
+                         for f, p in zip(fields, parts[2:]))
+        except (IndexError, ValueError):
+            raise ValueError(f"bad argument in {data!r}") from None
+        return parts[1], args
+
+
+def action_of(data: str) -> str:
+    """Action code of a payload without decoding it; legacy payloads give
+    their ``prefix_`` part."""
+    if data and data.startswith(VERSION + ":"):
+        return data.split(":", 2)[1]
+    return (data or "").split("_", 1)[0]
@@ -1,135 +1,621 @@
+import os
 import sqlite3
 import logging
+import threading
+import time
 from contextlib import contextmanager
-from typing import Optional, List, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Tuple, NamedTuple, Sequence, Callable
 
-DB_PATH = "school.db"
+from timezones import period_bounds, slot_to_utc, utc_now
+
+# DB_PATH=:memory: keeps everything in a private in-memory database: same SQL
+# and transactions, no disk I/O, gone when the process exits.
+MEMORY = ":memory:"
+DB_PATH = os.environ.get("DB_PATH", "school.db")
 log = logging.getLogger(__name__)
 
 
+class Notice(NamedTuple):
+    """An outgoing Telegram message queued in the outbox.
+
+    Notices with a ``category`` are held back and merged into one digest
+    message per chat by collapse_digest().
+    """
+    chat_id: int
+    text: str
+    reply_markup: Optional[str] = None   # JSON, e.g. markup.to_json()
+    category: Optional[str] = None
+
+
 # ---------------------------------------------------------------------------
 #  Connection helper
 # ---------------------------------------------------------------------------
 
+# Each process keeps one long-lived writer connection, used by one thread at a
+# time, and one query_only reader per thread.  In WAL mode readers never block
+# the writer or each other, so admin reports cannot hold up a booking.
+_writer: Optional[sqlite3.Connection] = None
+_writer_lock = threading.RLock()
+_readers = threading.local()
+
+
 @contextmanager
 def _conn():
-    c = sqlite3.connect(DB_PATH, timeout=10)
-    c.execute("PRAGMA journal_mode=WAL")
-    c.execute("PRAGMA foreign_keys=ON")
+    """The writer connection, held exclusively for the duration of the block."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
+            _writer.execute("PRAGMA journal_mode=WAL")
+            _writer.execute("PRAGMA foreign_keys=ON")
+        try:
+            yield _writer
+        finally:
+            # Whatever the block left open must not leak into the next caller.
+            if _writer.in_transaction:
+                _writer.rollback()
+
+
+@contextmanager
+def _read_conn():
+    """This thread's read-only connection."""
+    if DB_PATH == MEMORY:
+        # An in-memory database exists only on the connection that made it.
+        with _conn() as c:
+            yield c
+        return
+    c = getattr(_readers, "conn", None)
+    if c is None or _readers.path != DB_PATH:
+        c = sqlite3.connect(DB_PATH, timeout=10)
+        c.execute("PRAGMA query_only=ON")
+        _readers.conn, _readers.path = c, DB_PATH
     try:
         yield c
+    finally:
+        if c.in_transaction:
+            c.rollback()
+
+
+def use_database(path: str):
+    """Switch this process to another database (a file path or MEMORY).
+
+    Drops the open connections and the in-process caches that belong to the
+    old one; call init_db() afterwards.
+    """
+    global DB_PATH, _writer, _free_slots
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+        DB_PATH = path
+        _free_slots = _FreeSlotSnapshot()
+    get_teacher_agenda.cache_clear()
+    get_teacher_utilization.cache_clear()
+
+
+def set_wal_autocheckpoint(pages: int):
+    """0 stops commits from checkpointing; see checkpoint_wal()."""
+    with _conn() as conn:
+        conn.execute(f"PRAGMA wal_autocheckpoint={int(pages)}")
+
+
+def checkpoint_wal(mode: str = "PASSIVE") -> Tuple[int, int, int]:
+    """Run a WAL checkpoint on a side connection, so the writer is never the
+    one paying for it.  Returns (busy, wal_frames, checkpointed_frames)."""
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"unknown checkpoint mode {mode!r}")
+    c = sqlite3.connect(DB_PATH, timeout=10)
+    try:
+        return tuple(c.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
     finally:
         c.close()
 
 
+def wal_size() -> int:
+    try:
+        return os.path.getsize(DB_PATH + "-wal")
+    except OSError:
+        return 0
+
+
 # ---------------------------------------------------------------------------
-#  Schema bootstrap + migration
+#  Schema migrations
 # ---------------------------------------------------------------------------
+#
+# Each step moves the schema from version N-1 to N; the applied version lives
+# in PRAGMA user_version.  Steps only ever get appended.  They stay tolerant of
+# tables/columns that already exist, because databases created before the
+# version counter start at 0 with part of the schema in place.
 
 def _table_columns(cursor, table: str) -> set:
     cursor.execute(f"PRAGMA table_info({table})")
     return {row[1] for row in cursor.fetchall()}
 
 
-def init_db():
-    with _conn() as conn:
-        c = conn.cursor()
-
-        # -- students ---------------------------------------------------------
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS students (
-                id              INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id     INTEGER UNIQUE NOT NULL,
-                name            TEXT    NOT NULL,
-                email           TEXT    NOT NULL,
-                tariff          TEXT    NOT NULL,
-                lessons_balance INTEGER NOT NULL DEFAULT 0,
-                status          TEXT    NOT NULL DEFAULT 'active',
-                timezone        TEXT    NOT NULL DEFAULT 'Europe/Paris'
-            )
+def _m001_base(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS students (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id     INTEGER UNIQUE NOT NULL,
+            name            TEXT    NOT NULL,
+            email           TEXT    NOT NULL,
+            tariff          TEXT    NOT NULL,
+            lessons_balance INTEGER NOT NULL DEFAULT 0,
+            status          TEXT    NOT NULL DEFAULT 'active',
+            timezone        TEXT    NOT NULL DEFAULT 'Europe/Paris'
+        )
+    """)
+    if "timezone" not in _table_columns(c, "students"):
+        c.execute("ALTER TABLE students ADD COLUMN timezone TEXT NOT NULL DEFAULT 'Europe/Paris'")
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS teachers (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            name      TEXT    NOT NULL,
+            zoom_link TEXT    NOT NULL DEFAULT '',
+            active    INTEGER NOT NULL DEFAULT 1
+        )
+    """)
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS schedule (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            teacher     TEXT    NOT NULL,
+            date        TEXT    NOT NULL,
+            time        TEXT    NOT NULL,
+            zoom_link   TEXT    NOT NULL DEFAULT '',
+            student_id  INTEGER DEFAULT NULL
+                REFERENCES students(id) ON DELETE SET NULL,
+            reminded_24h INTEGER NOT NULL DEFAULT 0,
+            reminded_2h  INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    sched_cols = _table_columns(c, "schedule")
+    if "reminded_24h" not in sched_cols:
+        c.execute("ALTER TABLE schedule ADD COLUMN reminded_24h INTEGER NOT NULL DEFAULT 0")
+    if "reminded_2h" not in sched_cols:
+        c.execute("ALTER TABLE schedule ADD COLUMN reminded_2h INTEGER NOT NULL DEFAULT 0")
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS registration_state (
+            telegram_id INTEGER PRIMARY KEY,
+            step        TEXT    NOT NULL DEFAULT 'name',
+            name        TEXT,
+            email       TEXT,
+            tariff      TEXT,
+            updated_at  TEXT    NOT NULL DEFAULT (datetime('now'))
+        )
+    """)
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id     INTEGER NOT NULL,
+            tariff          TEXT    NOT NULL,
+            amount_cents    INTEGER NOT NULL,
+            currency        TEXT    NOT NULL DEFAULT 'EUR',
+            stripe_charge_id TEXT,
+            status          TEXT    NOT NULL DEFAULT 'pending',
+            created_at      TEXT    NOT NULL DEFAULT (datetime('now'))
+        )
+    """)
+
+    # History of conducted lessons.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS lessons_done (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id  INTEGER,
+            teacher     TEXT,
+            date        TEXT,
+            time        TEXT,
+            done_at     TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_students_tg      ON students(telegram_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_schedule_date    ON schedule(date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_tg      ON payments(telegram_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_status  ON payments(status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_teachers_active  ON teachers(active)")
+
+
+def _m002_balance_ledger(c):
+    # Append-only audit trail of lesson credits.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id    INTEGER NOT NULL REFERENCES students(id),
+            delta         INTEGER NOT NULL,
+            balance_after INTEGER NOT NULL,
+            reason        TEXT    NOT NULL,
+            ref           TEXT,
+            created_at    TEXT    NOT NULL DEFAULT (datetime('now'))
+        )
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_ledger_no_update
+        BEFORE UPDATE ON balance_ledger
+        BEGIN SELECT RAISE(ABORT, 'balance_ledger is append-only'); END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_ledger_no_delete
+        BEFORE DELETE ON balance_ledger
+        BEGIN SELECT RAISE(ABORT, 'balance_ledger is append-only'); END
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ledger_student   ON balance_ledger(student_id, id)")
+    # Students that predate the ledger get an opening entry so the trail
+    # always sums to the cached balance.
+    c.execute("""
+        INSERT INTO balance_ledger (student_id, delta, balance_after, reason)
+        SELECT id, lessons_balance, lessons_balance, 'opening' FROM students s
+        WHERE NOT EXISTS (SELECT 1 FROM balance_ledger l WHERE l.student_id = s.id)
+    """)
+
+
+def _m003_leases(c):
+    # Cross-process leader election.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name       TEXT PRIMARY KEY,
+            holder     TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+
+
+def _m004_outbox(c):
+    # Notifications, written in the same transaction as the state change.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id         INTEGER NOT NULL,
+            text            TEXT    NOT NULL,
+            reply_markup    TEXT,
+            status          TEXT    NOT NULL DEFAULT 'pending',
+            attempts        INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL    NOT NULL DEFAULT 0,
+            last_error      TEXT,
+            created_at      TEXT    NOT NULL DEFAULT (datetime('now')),
+            sent_at         TEXT,
+            category        TEXT
+        )
+    """)
+    if "category" not in _table_columns(c, "outbox"):
+        c.execute("ALTER TABLE outbox ADD COLUMN category TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due       ON outbox(status, next_attempt_at)")
+
+
+def _m005_broadcasts(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            text        TEXT    NOT NULL,
+            status      TEXT    NOT NULL DEFAULT 'running',
+            total       INTEGER NOT NULL DEFAULT 0,
+            created_at  TEXT    NOT NULL DEFAULT (datetime('now')),
+            finished_at TEXT
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id),
+            telegram_id  INTEGER NOT NULL,
+            status       TEXT    NOT NULL DEFAULT 'pending',
+            error        TEXT,
+            PRIMARY KEY (broadcast_id, telegram_id)
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bcast_status     ON broadcast_recipients(broadcast_id, status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)")
+
+
+def _m006_starts_at(c):
+    # starts_at: UTC epoch seconds of date/time read in the school timezone.
+    for table in ("schedule", "lessons_done"):
+        if "starts_at" not in _table_columns(c, table):
+            c.execute(f"ALTER TABLE {table} ADD COLUMN starts_at INTEGER")
+        backfill = []
+        for row_id, date, time_str in c.execute(
+                f"SELECT id, date, time FROM {table} WHERE starts_at IS NULL").fetchall():
+            try:
+                backfill.append((slot_to_utc(date, time_str), row_id))
+            except (TypeError, ValueError):
+                log.warning("%s #%s has an unparseable date/time: %r %r",
+                            table, row_id, date, time_str)
+        c.executemany(f"UPDATE {table} SET starts_at=? WHERE id=?", backfill)
+    c.execute("DROP INDEX IF EXISTS idx_schedule_free")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_schedule_open    ON schedule(student_id, starts_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_schedule_starts  ON schedule(starts_at)")
+
+
+def _m007_meta(c):
+    # Version counters shared between processes.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('free_slots_version', 0)")
+
+
+def _m008_teacher_id(c):
+    for table in ("schedule", "lessons_done"):
+        if "teacher_id" not in _table_columns(c, table):
+            c.execute(f"ALTER TABLE {table} ADD COLUMN teacher_id INTEGER REFERENCES teachers(id)")
+    # schedule.teacher is the legacy free-text name; teacher_id is the real
+    # link.  Names with no teachers row become inactive teachers so every
+    # slot can be linked.
+    c.execute("""
+        INSERT INTO teachers (name, active)
+        SELECT legacy.name, 0 FROM (
+            SELECT teacher AS name FROM schedule WHERE teacher_id IS NULL
+            UNION
+            SELECT teacher FROM lessons_done WHERE teacher_id IS NULL AND teacher IS NOT NULL
+        ) AS legacy
+        WHERE NOT EXISTS (SELECT 1 FROM teachers t WHERE t.name = legacy.name)
+    """)
+    for table in ("schedule", "lessons_done"):
+        c.execute(f"""
+            UPDATE {table} SET teacher_id = (
+                SELECT t.id FROM teachers t WHERE t.name = {table}.teacher
+                ORDER BY t.active DESC, t.id LIMIT 1)
+            WHERE teacher_id IS NULL
         """)
-        stu_cols = _table_columns(c, "students")
-        if "timezone" not in stu_cols:
-            c.execute("ALTER TABLE students ADD COLUMN timezone TEXT NOT NULL DEFAULT 'Europe/Paris'")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_schedule_teacher ON schedule(teacher_id, starts_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_done_teacher     ON lessons_done(teacher_id, starts_at)")
 
-        # -- teachers ---------------------------------------------------------
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS teachers (
-                id        INTEGER PRIMARY KEY AUTOINCREMENT,
-                name      TEXT    NOT NULL,
-                zoom_link TEXT    NOT NULL DEFAULT '',
-                active    INTEGER NOT NULL DEFAULT 1
-            )
-        """)
 
-        # -- schedule ---------------------------------------------------------
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS schedule (
-                id          INTEGER PRIMARY KEY AUTOINCREMENT,
-                teacher     TEXT    NOT NULL,
-                date        TEXT    NOT NULL,
-                time        TEXT    NOT NULL,
-                zoom_link   TEXT    NOT NULL DEFAULT '',
-                student_id  INTEGER DEFAULT NULL
-                    REFERENCES students(id) ON DELETE SET NULL,
-                reminded_24h INTEGER NOT NULL DEFAULT 0,
-                reminded_2h  INTEGER NOT NULL DEFAULT 0
-            )
-        """)
-        sched_cols = _table_columns(c, "schedule")
-        if "reminded_24h" not in sched_cols:
-            c.execute("ALTER TABLE schedule ADD COLUMN reminded_24h INTEGER NOT NULL DEFAULT 0")
-        if "reminded_2h" not in sched_cols:
-            c.execute("ALTER TABLE schedule ADD COLUMN reminded_2h INTEGER NOT NULL DEFAULT 0")
+def _m009_seen_updates(c):
+    # Telegram update ids already handed to the handlers (ingress de-dup).
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS seen_updates (
+            update_id INTEGER PRIMARY KEY,
+            seen_at   REAL NOT NULL
+        )
+    """)
 
-        # -- registration_state -----------------------------------------------
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS registration_state (
-                telegram_id INTEGER PRIMARY KEY,
-                step        TEXT    NOT NULL DEFAULT 'name',
-                name        TEXT,
-                email       TEXT,
-                tariff      TEXT,
-                updated_at  TEXT    NOT NULL DEFAULT (datetime('now'))
-            )
-        """)
 
-        # -- payments ---------------------------------------------------------
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS payments (
-                id              INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id     INTEGER NOT NULL,
-                tariff          TEXT    NOT NULL,
-                amount_cents    INTEGER NOT NULL,
-                currency        TEXT    NOT NULL DEFAULT 'EUR',
-                stripe_charge_id TEXT,
-                status          TEXT    NOT NULL DEFAULT 'pending',
-                created_at      TEXT    NOT NULL DEFAULT (datetime('now'))
-            )
-        """)
+# Space-separated charge ids of a student's payments, for the search index.
+_CHARGES_OF = """(SELECT group_concat(stripe_charge_id, ' ') FROM payments
+                  WHERE telegram_id = {tg} AND stripe_charge_id IS NOT NULL)"""
 
-        # -- lessons_done (history of conducted lessons) ----------------------
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS lessons_done (
-                id          INTEGER PRIMARY KEY AUTOINCREMENT,
-                student_id  INTEGER,
-                teacher     TEXT,
-                date        TEXT,
-                time        TEXT,
-                done_at     TEXT NOT NULL DEFAULT (datetime('now'))
-            )
+
+def _m010_student_search(c):
+    # Admin search over name, email, Telegram id and payment charge ids; one
+    # row per student (rowid = students.id), kept in sync by triggers.
+    # trigram matches any substring of 3+ characters; SQLite before 3.34
+    # lacks it and gets word-prefix matching instead.
+    columns = "name, email, telegram_id, charges"
+    try:
+        c.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS student_search USING fts5({columns}, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        c.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS student_search USING fts5({columns})")
+    c.execute("DELETE FROM student_search")
+    c.execute(f"""
+        INSERT INTO student_search (rowid, {columns})
+        SELECT s.id, s.name, s.email, s.telegram_id, {_CHARGES_OF.format(tg="s.telegram_id")}
+        FROM students s
+    """)
+    for sql in (
+        f"""CREATE TRIGGER IF NOT EXISTS students_search_insert AFTER INSERT ON students BEGIN
+                INSERT INTO student_search (rowid, {columns})
+                VALUES (new.id, new.name, new.email, new.telegram_id,
+                        {_CHARGES_OF.format(tg="new.telegram_id")});
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS students_search_update
+                AFTER UPDATE OF name, email, telegram_id ON students BEGIN
+                UPDATE student_search SET name = new.name, email = new.email,
+                    telegram_id = new.telegram_id, charges = {_CHARGES_OF.format(tg="new.telegram_id")}
+                WHERE rowid = new.id;
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS students_search_delete AFTER DELETE ON students BEGIN
+                DELETE FROM student_search WHERE rowid = old.id;
+            END""",
+    ):
+        c.execute(sql)
+    for event, row in (("INSERT", "new"), ("UPDATE OF stripe_charge_id, telegram_id", "new"),
+                       ("DELETE", "old")):
+        name = "payments_search_" + event.split()[0].lower()
+        c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON payments BEGIN
+                UPDATE student_search SET charges = {_CHARGES_OF.format(tg=f"{row}.telegram_id")}
+                WHERE rowid = (SELECT id FROM students WHERE telegram_id = {row}.telegram_id);
+            END
         """)
 
-        # -- Indexes ----------------------------------------------------------
-        c.execute("CREATE INDEX IF NOT EXISTS idx_students_tg      ON students(telegram_id)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_schedule_free    ON schedule(student_id, date, time)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_schedule_date    ON schedule(date)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_payments_tg      ON payments(telegram_id)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_payments_status  ON payments(status)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_teachers_active  ON teachers(active)")
 
-        conn.commit()
-        log.info("Database initialised / migrated successfully.")
+def _m011_rollups(c):
+    # Daily aggregates behind the analytics screen.  Triggers keep them current
+    # as payments complete, lessons are marked done and the ledger records
+    # sign-ups and renewals, so reports never scan the raw tables.  Days are
+    # UTC dates, like payments.created_at.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_revenue (
+            day          TEXT    NOT NULL,
+            tariff       TEXT    NOT NULL,
+            payments     INTEGER NOT NULL DEFAULT 0,
+            amount_cents INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, tariff)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_lessons (
+            day        TEXT    NOT NULL,
+            teacher_id INTEGER NOT NULL,      -- 0: no teacher on record
+            lessons    INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, teacher_id)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_students (
+            day      TEXT    PRIMARY KEY,
+            signups  INTEGER NOT NULL DEFAULT 0,
+            renewals INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    # Retention needs distinct students, so the first sign-up day and each
+    # month with a renewal are kept per student; cohort_retention counts them
+    # per (sign-up month, month).
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS student_cohorts (
+            student_id INTEGER PRIMARY KEY,
+            day        TEXT    NOT NULL
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS student_renewal_months (
+            student_id INTEGER NOT NULL,
+            month      TEXT    NOT NULL,
+            PRIMARY KEY (student_id, month)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS cohort_retention (
+            cohort    TEXT    NOT NULL,
+            month     TEXT    NOT NULL,
+            signed_up INTEGER NOT NULL DEFAULT 0,   -- only on the month = cohort row
+            renewed   INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (cohort, month)
+        ) WITHOUT ROWID
+    """)
+
+    lesson_day = "COALESCE(date({row}.starts_at, 'unixepoch'), date({row}.done_at))"
+    # Rebuild from the raw tables, then let the triggers take over.
+    for trigger in ("payment_completed", "lesson_done", "signup", "new_student",
+                    "renewal", "renewal_month"):
+        c.execute(f"DROP TRIGGER IF EXISTS rollup_{trigger}")
+    for table in ("daily_revenue", "daily_lessons", "daily_students",
+                  "student_cohorts", "student_renewal_months", "cohort_retention"):
+        c.execute(f"DELETE FROM {table}")
+    c.execute("""
+        INSERT INTO daily_revenue (day, tariff, payments, amount_cents)
+        SELECT date(created_at), tariff, COUNT(*), SUM(amount_cents) FROM payments
+        WHERE status = 'completed' GROUP BY 1, 2
+    """)
+    c.execute(f"""
+        INSERT INTO daily_lessons (day, teacher_id, lessons)
+        SELECT {lesson_day.format(row="lessons_done")}, COALESCE(teacher_id, 0), COUNT(*)
+        FROM lessons_done GROUP BY 1, 2
+    """)
+    c.execute("""
+        INSERT INTO student_cohorts (student_id, day)
+        SELECT student_id, date(MIN(created_at)) FROM balance_ledger
+        WHERE reason = 'signup' GROUP BY student_id
+    """)
+    c.execute("""
+        INSERT INTO student_renewal_months (student_id, month)
+        SELECT DISTINCT student_id, strftime('%Y-%m', created_at) FROM balance_ledger
+        WHERE reason = 'renewal'
+    """)
+    c.execute("INSERT INTO daily_students (day, signups) SELECT day, COUNT(*) FROM student_cohorts GROUP BY day")
+    c.execute("""
+        INSERT INTO daily_students (day, renewals)
+        SELECT date(created_at), COUNT(*) FROM balance_ledger WHERE reason = 'renewal' GROUP BY 1
+        ON CONFLICT (day) DO UPDATE SET renewals = excluded.renewals
+    """)
+    c.execute("""
+        INSERT INTO cohort_retention (cohort, month, signed_up)
+        SELECT substr(day, 1, 7), substr(day, 1, 7), COUNT(*) FROM student_cohorts GROUP BY 1
+    """)
+    c.execute("""
+        INSERT INTO cohort_retention (cohort, month, renewed)
+        SELECT substr(sc.day, 1, 7), rm.month, COUNT(*)
+        FROM student_renewal_months rm JOIN student_cohorts sc USING (student_id)
+        GROUP BY 1, 2
+        ON CONFLICT (cohort, month) DO UPDATE SET renewed = excluded.renewed
+    """)
+
+    for sql in (
+        """CREATE TRIGGER rollup_payment_completed
+                AFTER UPDATE OF status ON payments
+                WHEN new.status = 'completed' AND old.status IS NOT 'completed' BEGIN
+                INSERT INTO daily_revenue (day, tariff, payments, amount_cents)
+                VALUES (date(new.created_at), new.tariff, 1, new.amount_cents)
+                ON CONFLICT (day, tariff) DO UPDATE SET
+                    payments = payments + 1, amount_cents = amount_cents + excluded.amount_cents;
+            END""",
+        f"""CREATE TRIGGER rollup_lesson_done AFTER INSERT ON lessons_done BEGIN
+                INSERT INTO daily_lessons (day, teacher_id, lessons)
+                VALUES ({lesson_day.format(row="new")}, COALESCE(new.teacher_id, 0), 1)
+                ON CONFLICT (day, teacher_id) DO UPDATE SET lessons = lessons + 1;
+            END""",
+        # A repeated sign-up (same Telegram id) keeps the original cohort.
+        """CREATE TRIGGER rollup_signup AFTER INSERT ON balance_ledger
+                WHEN new.reason = 'signup' BEGIN
+                INSERT INTO student_cohorts (student_id, day)
+                VALUES (new.student_id, date(new.created_at))
+                ON CONFLICT (student_id) DO NOTHING;
+            END""",
+        """CREATE TRIGGER rollup_new_student AFTER INSERT ON student_cohorts BEGIN
+                INSERT INTO daily_students (day, signups) VALUES (new.day, 1)
+                ON CONFLICT (day) DO UPDATE SET signups = signups + 1;
+                INSERT INTO cohort_retention (cohort, month, signed_up)
+                VALUES (substr(new.day, 1, 7), substr(new.day, 1, 7), 1)
+                ON CONFLICT (cohort, month) DO UPDATE SET signed_up = signed_up + 1;
+            END""",
+        """CREATE TRIGGER rollup_renewal AFTER INSERT ON balance_ledger
+                WHEN new.reason = 'renewal' BEGIN
+                INSERT INTO daily_students (day, renewals) VALUES (date(new.created_at), 1)
+                ON CONFLICT (day) DO UPDATE SET renewals = renewals + 1;
+                INSERT INTO student_renewal_months (student_id, month)
+                VALUES (new.student_id, strftime('%Y-%m', new.created_at))
+                ON CONFLICT (student_id, month) DO NOTHING;
+            END""",
+        # Students who signed up before the ledger have no cohort.
+        """CREATE TRIGGER rollup_renewal_month AFTER INSERT ON student_renewal_months
+                WHEN EXISTS (SELECT 1 FROM student_cohorts WHERE student_id = new.student_id) BEGIN
+                INSERT INTO cohort_retention (cohort, month, renewed)
+                SELECT substr(day, 1, 7), new.month, 1 FROM student_cohorts
+                WHERE student_id = new.student_id
+                ON CONFLICT (cohort, month) DO UPDATE SET renewed = renewed + 1;
+            END""",
+    ):
+        c.execute(sql)
+
+
+MIGRATIONS: List[Callable] = [
+    _m001_base,
+    _m002_balance_ledger,
+    _m003_leases,
+    _m004_outbox,
+    _m005_broadcasts,
+    _m006_starts_at,
+    _m007_meta,
+    _m008_teacher_id,
+    _m009_seen_updates,
+    _m010_student_search,
+    _m011_rollups,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version() -> int:
+    with _read_conn() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def init_db():
+    """Bring the schema up to SCHEMA_VERSION.  A current database costs one
+    PRAGMA read; pending steps run in a single write transaction."""
+    with _conn() as conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            # Re-read under the write lock: another process may have migrated.
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            for number in range(version + 1, SCHEMA_VERSION + 1):
+                MIGRATIONS[number - 1](c)
+                c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    if version < SCHEMA_VERSION:
+        log.info("Database schema migrated from version %d to %d.", version, SCHEMA_VERSION)
 
 
 # ---------------------------------------------------------------------------
@@ -153,7 +639,7 @@ def save_reg_state(telegram_id: int, step: str, *,
 
 
 def get_reg_state(telegram_id: int) -> Optional[dict]:
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute("SELECT step, name, email, tariff FROM registration_state WHERE telegram_id=?",
                   (telegram_id,))
@@ -174,63 +660,234 @@ def clear_reg_state(telegram_id: int):
 # ---------------------------------------------------------------------------
 
 def add_student(telegram_id: int, name: str, email: str, tariff: str,
-                lessons: int, timezone: str = "Europe/Paris"):
+                lessons: int, timezone: str = "Europe/Paris",
+                notify: Sequence[Notice] = ()):
     with _conn() as conn:
-        conn.execute("""
-            INSERT INTO students (telegram_id, name, email, tariff, lessons_balance, timezone)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(telegram_id) DO UPDATE SET
-                name=excluded.name, email=excluded.email,
-                tariff=excluded.tariff, lessons_balance=excluded.lessons_balance,
-                timezone=excluded.timezone, status='active'
-        """, (telegram_id, name, email, tariff, lessons, timezone))
-        conn.commit()
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("SELECT lessons_balance FROM students WHERE telegram_id=?", (telegram_id,))
+            row = c.fetchone()
+            before = row[0] if row else 0
+            c.execute("""
+                INSERT INTO students (telegram_id, name, email, tariff, lessons_balance, timezone)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    name=excluded.name, email=excluded.email,
+                    tariff=excluded.tariff, lessons_balance=excluded.lessons_balance,
+                    timezone=excluded.timezone, status='active'
+                RETURNING id, lessons_balance
+            """, (telegram_id, name, email, tariff, lessons, timezone))
+            student_id, after = c.fetchall()[0]
+            _log_balance(c, student_id, after - before, after, "signup", tariff)
+            _enqueue(c, notify)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
 
+def repurchase_tariff(telegram_id: int, tariff: str, extra_lessons: int,
+                      notify: Callable[[int], Sequence[Notice]] = None) -> Optional[int]:
+    """Credit a renewal; returns the new balance (None if the student is unknown).
 
-def repurchase_tariff(telegram_id: int, tariff: str, extra_lessons: int):
+    ``notify`` receives the new balance and its notices are queued in the
+    same transaction.
+    """
     with _conn() as conn:
-        conn.execute("""
-            UPDATE students
-            SET tariff=?, lessons_balance = lessons_balance + ?, status='active'
-            WHERE telegram_id=?
-        """, (tariff, extra_lessons, telegram_id))
-        conn.commit()
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""
+                UPDATE students
+                SET tariff=?, lessons_balance = lessons_balance + ?, status='active'
+                WHERE telegram_id=?
+                RETURNING id, lessons_balance
+            """, (tariff, extra_lessons, telegram_id))
+            rows = c.fetchall()
+            if not rows:
+                conn.rollback()
+                return None
+            student_id, after = rows[0]
+            _log_balance(c, student_id, extra_lessons, after, "renewal", tariff)
+            if notify:
+                _enqueue(c, notify(after))
+            conn.commit()
+            return after
+        except Exception:
+            conn.rollback()
+            raise
 
 
 def get_student(telegram_id: int) -> Optional[Tuple]:
     """0:id 1:telegram_id 2:name 3:email 4:tariff 5:lessons_balance 6:status 7:timezone"""
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM students WHERE telegram_id=?", (telegram_id,))
         return c.fetchone()
 
 
 def get_student_by_id(student_id: int) -> Optional[Tuple]:
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM students WHERE id=?", (student_id,))
         return c.fetchone()
 
 
+def search_students(query: str, limit: int = 10) -> List[Tuple]:
+    """Students whose name, email, Telegram id or payment charge ids contain
+    every word of ``query``, best match first; rows as get_student().
+
+    With the trigram index, words shorter than 3 characters are ignored.
+    """
+    with _read_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT sql FROM sqlite_master WHERE name='student_search'")
+        trigram = "trigram" in c.fetchone()[0]
+        words = [w for w in query.split() if len(w) >= 3 or not trigram]
+        if not words:
+            return []
+        # Each word is a quoted phrase (no FTS syntax from user input); prefix
+        # match when words are whole tokens.
+        match = " ".join('"' + w.replace('"', '""') + '"' + ("" if trigram else "*")
+                         for w in words)
+        c.execute("""
+            SELECT s.* FROM student_search f JOIN students s ON s.id = f.rowid
+            WHERE student_search MATCH ? ORDER BY f.rank LIMIT ?
+        """, (match, limit))
+        return c.fetchall()
+
+
 def get_all_students() -> List[Tuple]:
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM students ORDER BY id")
         return c.fetchall()
 
 
-def update_lessons_balance(student_id: int, delta: int) -> bool:
+def update_lessons_balance(student_id: int, delta: int,
+                           reason: str = "admin", ref: str = None) -> bool:
     with _conn() as conn:
         c = conn.cursor()
-        c.execute("SELECT lessons_balance FROM students WHERE id=?", (student_id,))
-        row = c.fetchone()
-        if row is None:
-            return False
-        if row[0] + delta < 0:
-            return False
-        c.execute("UPDATE students SET lessons_balance=? WHERE id=?", (row[0] + delta, student_id))
-        conn.commit()
-        return True
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            if _apply_balance(c, student_id, delta, reason, ref) is None:
+                conn.rollback()
+                return False
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+
+# ---------------------------------------------------------------------------
+#  Read models (one query per student screen)
+# ---------------------------------------------------------------------------
+# NamedTuples are slotted (no per-instance __dict__), so these are as cheap
+# as the raw rows but read as card.balance instead of student[5].
+
+class StudentCard(NamedTuple):
+    id: int
+    telegram_id: int
+    name: str
+    email: str
+    tariff: str
+    balance: int
+    status: str
+    timezone: str
+
+
+class LessonLine(NamedTuple):
+    slot_id: int
+    teacher: str
+    date: str
+    time: str
+    zoom_link: str
+    starts_at: Optional[int]
+
+
+class MyLessons(NamedTuple):
+    student: StudentCard
+    lessons: List[LessonLine]
+
+
+_CARD_COLS = "s.id, s.telegram_id, s.name, s.email, s.tariff, s.lessons_balance, s.status, s.timezone"
+
+
+def is_registered(telegram_id: int) -> bool:
+    with _read_conn() as conn:
+        return bool(conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM students WHERE telegram_id=?)",
+            (telegram_id,)).fetchone()[0])
+
+
+def get_student_card(telegram_id: int) -> Optional[StudentCard]:
+    with _read_conn() as conn:
+        row = conn.execute(
+            f"SELECT {_CARD_COLS} FROM students s WHERE s.telegram_id=?",
+            (telegram_id,)).fetchone()
+    return StudentCard._make(row) if row else None
+
+
+def get_my_lessons(telegram_id: int) -> Optional[MyLessons]:
+    """Student card plus booked lessons (soonest first) in a single query."""
+    with _read_conn() as conn:
+        rows = conn.execute(f"""
+            SELECT {_CARD_COLS},
+                   sc.id, COALESCE(t.name, sc.teacher), sc.date, sc.time, sc.zoom_link, sc.starts_at
+            FROM students s
+            LEFT JOIN schedule sc ON sc.student_id = s.id
+            LEFT JOIN teachers t  ON t.id = sc.teacher_id
+            WHERE s.telegram_id=?
+            ORDER BY sc.starts_at
+        """, (telegram_id,)).fetchall()
+    if not rows:
+        return None
+    lessons = [LessonLine._make(r[8:]) for r in rows if r[8] is not None]
+    return MyLessons(StudentCard._make(rows[0][:8]), lessons)
+
+
+# ---------------------------------------------------------------------------
+#  Balance ledger
+# ---------------------------------------------------------------------------
+#  students.lessons_balance is a cached snapshot; every change to it goes
+#  through one of the helpers below, inside the caller's transaction, so the
+#  snapshot and the ledger can never disagree.
+
+def _log_balance(c, student_id: int, delta: int, balance_after: int,
+                 reason: str, ref: str = None):
+    c.execute("""
+        INSERT INTO balance_ledger (student_id, delta, balance_after, reason, ref)
+        VALUES (?, ?, ?, ?, ?)
+    """, (student_id, delta, balance_after, reason, ref))
+
+
+def _apply_balance(c, student_id: int, delta: int, reason: str,
+                   ref: str = None) -> Optional[int]:
+    """Conditionally apply ``delta``; returns the new balance or None if it would go negative."""
+    c.execute("""
+        UPDATE students SET lessons_balance = lessons_balance + ?
+        WHERE id=? AND lessons_balance + ? >= 0
+        RETURNING lessons_balance
+    """, (delta, student_id, delta))
+    rows = c.fetchall()
+    if not rows:
+        return None
+    _log_balance(c, student_id, delta, rows[0][0], reason, ref)
+    return rows[0][0]
+
+
+def get_balance_history(student_id: int, limit: int = 20) -> List[Tuple]:
+    """0:id 1:delta 2:balance_after 3:reason 4:ref 5:created_at (newest first)"""
+    with _read_conn() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT id, delta, balance_after, reason, ref, created_at
+            FROM balance_ledger WHERE student_id=?
+            ORDER BY id DESC LIMIT ?
+        """, (student_id, limit))
+        return c.fetchall()
 
 
 def update_student_timezone(telegram_id: int, tz: str):
@@ -264,174 +921,433 @@ def add_teacher(name: str, zoom_link: str = "") -> int:
 
 def get_active_teachers() -> List[Tuple]:
     """0:id 1:name 2:zoom_link 3:active"""
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM teachers WHERE active=1 ORDER BY name")
         return c.fetchall()
 
 
 def get_teacher_by_id(teacher_id: int) -> Optional[Tuple]:
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM teachers WHERE id=?", (teacher_id,))
         return c.fetchone()
 
 
-def remove_teacher(teacher_id: int) -> bool:
-    with _conn() as conn:
-        c = conn.cursor()
-        c.execute("UPDATE teachers SET active=0 WHERE id=? AND active=1", (teacher_id,))
-        conn.commit()
-        return c.rowcount == 1
-
-
-# ---------------------------------------------------------------------------
-#  Schedule / slots
-# ---------------------------------------------------------------------------
+def remove_teacher(teacher_id: int) -> Optional[Tuple[int, int]]:
+    """Deactivate a teacher and delete their future free slots.
 
-def add_slot(teacher: str, date: str, time: str, zoom_link: str) -> int:
+    Returns (free slots deleted, future booked slots left for the admin to
+    handle), or None if there was no such active teacher.
+    """
     with _conn() as conn:
         c = conn.cursor()
-        c.execute(
-            "INSERT INTO schedule (teacher, date, time, zoom_link) VALUES (?, ?, ?, ?)",
-            (teacher, date, time, zoom_link))
-        conn.commit()
-        return c.lastrowid
-
-
-def delete_slot(slot_id: int) -> bool:
-    with _conn() as conn:
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("UPDATE teachers SET active=0 WHERE id=? AND active=1", (teacher_id,))
+            if c.rowcount != 1:
+                conn.rollback()
+                return None
+            now = utc_now()
+            c.execute("""
+                DELETE FROM schedule
+                WHERE teacher_id=? AND starts_at > ? AND student_id IS NULL
+                RETURNING id
+            """, (teacher_id, now))
+            removed = [r[0] for r in c.fetchall()]
+            c.execute("""
+                SELECT COUNT(*) FROM schedule
+                WHERE teacher_id=? AND starts_at > ? AND student_id IS NOT NULL
+            """, (teacher_id, now))
+            booked = c.fetchone()[0]
+            version = _bump_version(c)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    _free_slots.apply(version, remove=removed)
+    return len(removed), booked
+
+
+def ttl_cache(seconds: float):
+    """Memoise a read-only query for ``seconds``; used for admin reports where
+    slightly stale figures are fine and repeated taps should not re-query."""
+    def decorator(fn):
+        cache: dict = {}
+        lock = threading.Lock()
+
+        def wrapper(*args):
+            now = time.monotonic()
+            with lock:
+                hit = cache.get(args)
+                if hit and hit[0] > now:
+                    return hit[1]
+            result = fn(*args)
+            with lock:
+                if len(cache) > 256:
+                    cache.clear()
+                cache[args] = (now + seconds, result)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return decorator
+
+
+REPORT_CACHE_TTL = float(os.environ.get("REPORT_CACHE_TTL", "30"))
+
+
+@ttl_cache(REPORT_CACHE_TTL)
+def get_teacher_agenda(teacher_id: int, start: int, end: int) -> List[Tuple]:
+    """A teacher's slots starting in [start, end), open and done.
+
+    0:id 1:date 2:time 3:starts_at 4:student name (None if free) 5:done (0/1)
+    """
+    with _read_conn() as conn:
         c = conn.cursor()
-        c.execute("DELETE FROM schedule WHERE id=? AND student_id IS NULL", (slot_id,))
-        conn.commit()
-        return c.rowcount == 1
+        c.execute("""
+            SELECT sc.id, sc.date, sc.time, sc.starts_at, s.name, 0
+            FROM schedule sc LEFT JOIN students s ON s.id = sc.student_id
+            WHERE sc.teacher_id=? AND sc.starts_at >= ? AND sc.starts_at < ?
+            UNION ALL
+            SELECT ld.id, ld.date, ld.time, ld.starts_at, s.name, 1
+            FROM lessons_done ld LEFT JOIN students s ON s.id = ld.student_id
+            WHERE ld.teacher_id=? AND ld.starts_at >= ? AND ld.starts_at < ?
+            ORDER BY 4
+        """, (teacher_id, start, end, teacher_id, start, end))
+        return c.fetchall()
 
 
-def get_free_slots() -> List[Tuple]:
-    """0:id 1:teacher 2:date 3:time 4:zoom_link"""
-    with _conn() as conn:
+@ttl_cache(REPORT_CACHE_TTL)
+def get_teacher_utilization(start: int, end: int) -> List[Tuple]:
+    """Per active teacher, slots starting in [start, end).
+
+    0:teacher_id 1:name 2:offered 3:booked (incl. done) 4:done
+    """
+    with _read_conn() as conn:
         c = conn.cursor()
-        c.execute(
-            "SELECT id, teacher, date, time, zoom_link FROM schedule "
-            "WHERE student_id IS NULL ORDER BY date, time")
+        # Each correlated subquery is a range scan on (teacher_id, starts_at).
+        c.execute("""
+            SELECT id, name, offered + done, booked + done, done FROM (
+                SELECT t.id, t.name,
+                       (SELECT COUNT(*) FROM schedule sc
+                        WHERE sc.teacher_id = t.id AND sc.starts_at >= ?1 AND sc.starts_at < ?2)
+                           AS offered,
+                       (SELECT COUNT(sc.student_id) FROM schedule sc
+                        WHERE sc.teacher_id = t.id AND sc.starts_at >= ?1 AND sc.starts_at < ?2)
+                           AS booked,
+                       (SELECT COUNT(*) FROM lessons_done ld
+                        WHERE ld.teacher_id = t.id AND ld.starts_at >= ?1 AND ld.starts_at < ?2)
+                           AS done
+                FROM teachers t WHERE t.active = 1
+            ) ORDER BY name
+        """, (start, end))
         return c.fetchall()
 
 
-def get_free_slots_by_date(date: str) -> List[Tuple]:
-    with _conn() as conn:
+def get_teacher_load(teacher_id: int, start: int, end: int) -> Tuple[int, int]:
+    """(offered, booked) slots of a teacher starting in [start, end) - an index range scan."""
+    with _read_conn() as conn:
         c = conn.cursor()
-        c.execute(
-            "SELECT id, teacher, date, time, zoom_link FROM schedule "
-            "WHERE student_id IS NULL AND date=? ORDER BY time", (date,))
-        return c.fetchall()
+        c.execute("""
+            SELECT COUNT(*), COUNT(student_id) FROM schedule
+            WHERE teacher_id=? AND starts_at >= ? AND starts_at < ?
+        """, (teacher_id, start, end))
+        return c.fetchone()
+
 
+# ---------------------------------------------------------------------------
+#  Schedule / slots
+# ---------------------------------------------------------------------------
 
-def book_slot(slot_id: int, student_id: int) -> bool:
+# Usable both in SELECT ... FROM schedule and in RETURNING; the teacher name
+# always comes from teachers, falling back to the legacy copy.
+_FREE_SLOT_COLS = """
+    schedule.id,
+    COALESCE((SELECT name FROM teachers WHERE id = schedule.teacher_id), schedule.teacher),
+    schedule.date, schedule.time, schedule.zoom_link, schedule.starts_at, schedule.teacher_id
+"""
+
+# How long the snapshot trusts itself before re-reading the version row.  Only
+# writes made by *other* processes can be missed for that long; writes made
+# here patch the snapshot as soon as they commit.
+FREE_SLOTS_RECHECK = float(os.environ.get("FREE_SLOTS_RECHECK", "1"))
+
+
+class _FreeSlotSnapshot:
+    """In-process copy of the free slots, indexed by date and by teacher.
+
+    ``version`` mirrors meta.free_slots_version.  Every write that can change
+    the free set bumps that row in its own transaction and then calls apply();
+    if the snapshot was exactly one version behind it is patched in place,
+    otherwise it is marked stale and rebuilt on the next read.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = -1
+        self._rows: dict = {}
+        self._views = None
+        self._stale = True
+        self._checked_at = 0.0
+
+    def _refresh(self):
+        now = time.monotonic()
+        if not self._stale and now - self._checked_at < FREE_SLOTS_RECHECK:
+            return
+        with _read_conn() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN")
+            version = _read_version(c)
+            if version != self.version:
+                c.execute(f"SELECT {_FREE_SLOT_COLS} FROM schedule WHERE student_id IS NULL")
+                self._rows = {r[0]: r for r in c.fetchall()}
+                self._views = None
+                self.version = version
+                log.debug("Free-slot snapshot rebuilt at v%s (%s slots)", version, len(self._rows))
+            conn.rollback()
+        self._stale = False
+        self._checked_at = now
+
+    def _indexes(self):
+        if self._views is None:
+            ordered = sorted(self._rows.values(),
+                             key=lambda r: (r[5] is not None, r[5] or 0, r[0]))
+            by_date, by_teacher = {}, {}
+            for r in ordered:
+                by_date.setdefault(r[2], []).append(r)
+                by_teacher.setdefault(r[6], []).append(r)
+            self._views = (ordered, by_date, by_teacher)
+        return self._views
+
+    def read(self, view: int, key=None) -> List[Tuple]:
+        with self._lock:
+            self._refresh()
+            index = self._indexes()[view]
+            return list(index if key is None else index.get(key, ()))
+
+    def apply(self, version: int, add: Tuple = None, remove: Sequence[int] = ()):
+        with self._lock:
+            if self.version != version - 1:
+                self._stale = True
+                return
+            if add is not None:
+                self._rows[add[0]] = add
+            for slot_id in remove:
+                self._rows.pop(slot_id, None)
+            if add is not None or remove:
+                self._views = None
+            self.version = version
+
+
+_free_slots = _FreeSlotSnapshot()
+
+
+def _read_version(c) -> int:
+    c.execute("SELECT value FROM meta WHERE key='free_slots_version'")
+    return c.fetchone()[0]
+
+
+def _bump_version(c) -> int:
+    c.execute(
+        "UPDATE meta SET value = value + 1 WHERE key='free_slots_version' RETURNING value")
+    return c.fetchall()[0][0]
+
+
+def add_slot(teacher_id: int, date: str, time: str, zoom_link: str) -> int:
+    """``date``/``time`` are school-timezone wall clock; raises ValueError if
+    unparseable or if the teacher does not exist."""
+    starts_at = slot_to_utc(date, time)
     with _conn() as conn:
         c = conn.cursor()
         try:
             c.execute("BEGIN IMMEDIATE")
-            c.execute("SELECT lessons_balance FROM students WHERE id=?", (student_id,))
-            row = c.fetchone()
-            if not row or row[0] <= 0:
-                conn.rollback()
-                return False
-            c.execute(
-                "UPDATE schedule SET student_id=? WHERE id=? AND student_id IS NULL",
-                (student_id, slot_id))
-            if c.rowcount != 1:
-                conn.rollback()
-                return False
-            c.execute(
-                "UPDATE students SET lessons_balance = lessons_balance - 1 WHERE id=?",
-                (student_id,))
+            c.execute(f"""
+                INSERT INTO schedule (teacher_id, teacher, date, time, zoom_link, starts_at)
+                SELECT id, name, ?, ?, ?, ? FROM teachers WHERE id=?
+                RETURNING {_FREE_SLOT_COLS}
+            """, (date, time, zoom_link, starts_at, teacher_id))
+            rows = c.fetchall()
+            if not rows:
+                raise ValueError(f"teacher #{teacher_id} not found")
+            version = _bump_version(c)
             conn.commit()
-            return True
         except Exception:
             conn.rollback()
             raise
+    _free_slots.apply(version, add=rows[0])
+    return rows[0][0]
 
 
-def cancel_booking(slot_id: int) -> bool:
+def delete_slot(slot_id: int) -> bool:
     with _conn() as conn:
         c = conn.cursor()
         try:
             c.execute("BEGIN IMMEDIATE")
-            c.execute("SELECT student_id FROM schedule WHERE id=?", (slot_id,))
-            row = c.fetchone()
-            if not row or row[0] is None:
+            c.execute("DELETE FROM schedule WHERE id=? AND student_id IS NULL", (slot_id,))
+            if c.rowcount != 1:
                 conn.rollback()
                 return False
-            c.execute(
-                "UPDATE schedule SET student_id=NULL, reminded_24h=0, reminded_2h=0 WHERE id=?",
-                (slot_id,))
-            c.execute(
-                "UPDATE students SET lessons_balance = lessons_balance + 1 WHERE id=?",
-                (row[0],))
+            version = _bump_version(c)
             conn.commit()
-            return True
         except Exception:
             conn.rollback()
             raise
+    _free_slots.apply(version, remove=(slot_id,))
+    return True
+
 
+def get_free_slots() -> List[Tuple]:
+    """0:id 1:teacher 2:date 3:time 4:zoom_link 5:starts_at 6:teacher_id (served from the snapshot)"""
+    return _free_slots.read(0)
 
-def cancel_booking_by_student(slot_id: int, student_db_id: int) -> bool:
+
+def get_free_slots_by_date(date: str) -> List[Tuple]:
+    return _free_slots.read(1, date)
+
+
+def get_free_slots_by_teacher(teacher_id: int) -> List[Tuple]:
+    return _free_slots.read(2, teacher_id)
+
+
+# Free and not started yet (slots with an unparseable date count as future).
+_BOOKABLE = "student_id IS NULL AND (starts_at IS NULL OR starts_at > ?)"
+
+
+def book_slot(slot_id: int, student_id: int,
+              notify_if_empty: Sequence[Notice] = ()) -> bool:
+    """Claim a free, future slot and debit one lesson.
+
+    Lost races are rejected by an unlocked pre-check so they never queue for
+    the write lock; the locked part is two guarded UPDATEs and nothing else.
+    ``notify_if_empty`` is queued in the same transaction when this booking
+    used up the last lesson.
+    """
+    now = utc_now()
+    with _read_conn() as conn:
+        bookable = conn.execute(f"""
+            SELECT EXISTS(SELECT 1 FROM schedule WHERE id=? AND {_BOOKABLE}),
+                   EXISTS(SELECT 1 FROM students WHERE id=? AND lessons_balance > 0)
+        """, (slot_id, now, student_id)).fetchone()
+    if not all(bookable):
+        return False
+    # A stale read is harmless: the guarded UPDATEs below re-check both.
     with _conn() as conn:
         c = conn.cursor()
         try:
             c.execute("BEGIN IMMEDIATE")
-            c.execute("SELECT student_id FROM schedule WHERE id=?", (slot_id,))
-            row = c.fetchone()
-            if not row or row[0] != student_db_id:
+            c.execute(
+                f"UPDATE schedule SET student_id=? WHERE id=? AND {_BOOKABLE} "
+                "RETURNING id", (student_id, slot_id, now))
+            if not c.fetchall():
                 conn.rollback()
                 return False
-            c.execute(
-                "UPDATE schedule SET student_id=NULL, reminded_24h=0, reminded_2h=0 WHERE id=?",
-                (slot_id,))
-            c.execute(
-                "UPDATE students SET lessons_balance = lessons_balance + 1 WHERE id=?",
-                (student_db_id,))
+            balance = _apply_balance(c, student_id, -1, "booking", f"slot:{slot_id}")
+            if balance is None:
+                conn.rollback()
+                return False
+            if balance == 0:
+                _enqueue(c, notify_if_empty)
+            version = _bump_version(c)
             conn.commit()
-            return True
         except Exception:
             conn.rollback()
             raise
+    _free_slots.apply(version, remove=(slot_id,))
+    return True
 
 
-def get_student_slots(student_id: int) -> List[Tuple]:
+def _release_slot(conn, slot_id: int, student_db_id: Optional[int],
+                  notify: Sequence[Notice] = ()) -> bool:
+    """Refund the booked student and free the slot inside one short write lock.
+
+    With ``student_db_id`` the release only succeeds for that student's booking.
+    """
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""
+            UPDATE students SET lessons_balance = lessons_balance + 1
+            WHERE id = (SELECT student_id FROM schedule WHERE id=?)
+              AND (? IS NULL OR id = ?)
+            RETURNING id, lessons_balance
+        """, (slot_id, student_db_id, student_db_id))
+        rows = c.fetchall()
+        if not rows:
+            conn.rollback()
+            return False
+        _log_balance(c, rows[0][0], +1, rows[0][1], "cancel", f"slot:{slot_id}")
+        c.execute(
+            f"UPDATE schedule SET student_id=NULL, reminded_24h=0, reminded_2h=0 WHERE id=? "
+            f"RETURNING {_FREE_SLOT_COLS}", (slot_id,))
+        freed = c.fetchall()[0]
+        _enqueue(c, notify)
+        version = _bump_version(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _free_slots.apply(version, add=freed)
+    return True
+
+
+def cancel_booking(slot_id: int) -> bool:
+    with _conn() as conn:
+        return _release_slot(conn, slot_id, None)
+
+
+def cancel_booking_by_student(slot_id: int, student_db_id: int,
+                              notify: Sequence[Notice] = ()) -> bool:
     with _conn() as conn:
+        return _release_slot(conn, slot_id, student_db_id, notify)
+
+
+def get_student_slots(student_id: int) -> List[Tuple]:
+    """0:id 1:teacher 2:date 3:time 4:zoom_link 5:starts_at 6:teacher_id"""
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute(
-            "SELECT id, teacher, date, time, zoom_link FROM schedule "
-            "WHERE student_id=? ORDER BY date, time", (student_id,))
+            f"SELECT {_FREE_SLOT_COLS} FROM schedule "
+            f"WHERE student_id=? ORDER BY starts_at", (student_id,))
         return c.fetchall()
 
 
 def get_slot_by_id(slot_id: int) -> Optional[Tuple]:
-    with _conn() as conn:
+    """0:id 1:teacher 2:date 3:time 4:zoom_link 5:student_id 6:reminded_24h
+    7:reminded_2h 8:starts_at 9:teacher_id"""
+    with _read_conn() as conn:
         c = conn.cursor()
-        c.execute("SELECT * FROM schedule WHERE id=?", (slot_id,))
+        c.execute("""
+            SELECT sc.id, COALESCE(t.name, sc.teacher), sc.date, sc.time, sc.zoom_link,
+                   sc.student_id, sc.reminded_24h, sc.reminded_2h, sc.starts_at, sc.teacher_id
+            FROM schedule sc LEFT JOIN teachers t ON t.id = sc.teacher_id
+            WHERE sc.id=?
+        """, (slot_id,))
         return c.fetchone()
 
 
 def get_bookings_by_date(date: str) -> List[Tuple]:
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute("""
-            SELECT sc.id, s.name, sc.teacher, sc.date, sc.time, sc.zoom_link
+            SELECT sc.id, s.name, COALESCE(t.name, sc.teacher), sc.date, sc.time, sc.zoom_link
             FROM schedule sc JOIN students s ON sc.student_id = s.id
-            WHERE sc.date = ? ORDER BY sc.time
+            LEFT JOIN teachers t ON t.id = sc.teacher_id
+            WHERE sc.date = ? ORDER BY sc.starts_at
         """, (date,))
         return c.fetchall()
 
 
 def get_all_bookings() -> List[Tuple]:
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute("""
-            SELECT sc.id, s.name, sc.teacher, sc.date, sc.time, sc.zoom_link
+            SELECT sc.id, s.name, COALESCE(t.name, sc.teacher), sc.date, sc.time, sc.zoom_link
             FROM schedule sc JOIN students s ON sc.student_id = s.id
-            ORDER BY sc.date, sc.time
+            LEFT JOIN teachers t ON t.id = sc.teacher_id
+            ORDER BY sc.starts_at
         """)
         return c.fetchall()
 
@@ -442,49 +1358,412 @@ def mark_lesson_done(slot_id: int) -> bool:
         c = conn.cursor()
         try:
             c.execute("BEGIN IMMEDIATE")
-            c.execute(
-                "SELECT student_id, teacher, date, time FROM schedule "
-                "WHERE id=? AND student_id IS NOT NULL", (slot_id,))
+            c.execute("""
+                SELECT sc.student_id, COALESCE(t.name, sc.teacher), sc.date, sc.time,
+                       sc.teacher_id, sc.starts_at
+                FROM schedule sc LEFT JOIN teachers t ON t.id = sc.teacher_id
+                WHERE sc.id=? AND sc.student_id IS NOT NULL
+            """, (slot_id,))
             row = c.fetchone()
             if not row:
                 conn.rollback()
                 return False
             c.execute(
-                "INSERT INTO lessons_done (student_id, teacher, date, time) VALUES (?, ?, ?, ?)",
-                (row[0], row[1], row[2], row[3]))
+                "INSERT INTO lessons_done (student_id, teacher, date, time, teacher_id, starts_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", row)
             c.execute("DELETE FROM schedule WHERE id=?", (slot_id,))
+            version = _bump_version(c)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    _free_slots.apply(version)
+    return True
+
+
+def close_day(before: Optional[int] = None) -> List[Tuple[str, int]]:
+    """Mark every booked lesson starting before ``before`` (default: the start
+    of today in the school timezone) as done in one transaction.  Today's
+    lessons stay bookings so running ones and no-shows can still be handled.
+    Returns (teacher, lessons) pairs, busiest first."""
+    before = period_bounds("day")[0] if before is None else before
+    due = "sc.student_id IS NOT NULL AND sc.starts_at < ?"
+    with _conn() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute(f"""
+                SELECT COALESCE(t.name, sc.teacher), COUNT(*)
+                FROM schedule sc LEFT JOIN teachers t ON t.id = sc.teacher_id
+                WHERE {due} GROUP BY sc.teacher_id ORDER BY 2 DESC
+            """, (before,))
+            counts = c.fetchall()
+            if not counts:
+                conn.rollback()
+                return []
+            c.execute(f"""
+                INSERT INTO lessons_done (student_id, teacher, date, time, teacher_id, starts_at)
+                SELECT sc.student_id, COALESCE(t.name, sc.teacher), sc.date, sc.time,
+                       sc.teacher_id, sc.starts_at
+                FROM schedule sc LEFT JOIN teachers t ON t.id = sc.teacher_id
+                WHERE {due}
+            """, (before,))
+            c.execute(f"DELETE FROM schedule AS sc WHERE {due}", (before,))
+            version = _bump_version(c)
             conn.commit()
-            return True
         except Exception:
             conn.rollback()
             raise
+    _free_slots.apply(version)
+    return counts
 
 
 # ---------------------------------------------------------------------------
 #  Reminders
 # ---------------------------------------------------------------------------
 
-def get_upcoming_unreminded(flag_col: str) -> List[Tuple]:
+def get_upcoming_unreminded(flag_col: str, within_seconds: int) -> List[Tuple]:
+    """Booked, unreminded slots starting within the next ``within_seconds``.
+
+    0:id 1:teacher 2:date 3:time 4:zoom_link 5:telegram_id 6:name 7:timezone 8:starts_at
+    """
     assert flag_col in ("reminded_24h", "reminded_2h")
-    with _conn() as conn:
+    now = utc_now()
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute(f"""
-            SELECT sc.id, sc.teacher, sc.date, sc.time, sc.zoom_link,
-                   s.telegram_id, s.name, s.timezone
+            SELECT sc.id, COALESCE(t.name, sc.teacher), sc.date, sc.time, sc.zoom_link,
+                   s.telegram_id, s.name, s.timezone, sc.starts_at
             FROM schedule sc
             JOIN students s ON sc.student_id = s.id
-            WHERE sc.{flag_col} = 0 AND sc.student_id IS NOT NULL
-        """)
+            LEFT JOIN teachers t ON t.id = sc.teacher_id
+            WHERE sc.starts_at > ? AND sc.starts_at <= ?
+              AND sc.{flag_col} = 0 AND sc.student_id IS NOT NULL
+        """, (now, now + within_seconds))
         return c.fetchall()
 
 
-def mark_reminded(slot_id: int, flag_col: str):
+def claim_reminder(slot_id: int, flag_col: str, notice: Notice) -> bool:
+    """Atomically flip the reminder flag and queue ``notice`` if this call flipped it."""
     assert flag_col in ("reminded_24h", "reminded_2h")
     with _conn() as conn:
-        conn.execute(f"UPDATE schedule SET {flag_col}=1 WHERE id=?", (slot_id,))
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute(
+                f"UPDATE schedule SET {flag_col}=1 "
+                f"WHERE id=? AND {flag_col}=0 AND student_id IS NOT NULL", (slot_id,))
+            if c.rowcount != 1:
+                conn.rollback()
+                return False
+            _enqueue(c, [notice])
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+
+# ---------------------------------------------------------------------------
+#  Outbox
+# ---------------------------------------------------------------------------
+#  Notifications are inserted by the same transaction as the state change that
+#  causes them and delivered later by the bot's sender thread.  A claimed row is
+#  hidden for ``visibility`` seconds, so rows claimed by a process that crashed
+#  before reporting back are simply retried.
+
+def _enqueue(c, notices: Sequence[Notice]):
+    c.executemany(
+        "INSERT INTO outbox (chat_id, text, reply_markup, category, status) VALUES (?, ?, ?, ?, ?)",
+        [(*n, "digest" if n.category else "pending") for n in notices])
+
+
+def enqueue_notifications(*notices: Notice):
+    with _conn() as conn:
+        _enqueue(conn.cursor(), notices)
+        conn.commit()
+
+
+def claim_outbox_batch(limit: int = 20, visibility: float = 60.0) -> List[Tuple]:
+    """0:id 1:chat_id 2:text 3:reply_markup 4:attempts (oldest first)"""
+    now = time.time()
+    with _conn() as conn:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?
+            WHERE id IN (SELECT id FROM outbox
+                         WHERE status='pending' AND next_attempt_at <= ?
+                         ORDER BY id LIMIT ?)
+            RETURNING id, chat_id, text, reply_markup, attempts
+        """, (now + visibility, now, limit))
+        rows = c.fetchall()
+        conn.commit()
+    return sorted(rows)
+
+
+def mark_outbox_sent(outbox_id: int):
+    with _conn() as conn:
+        conn.execute(
+            "UPDATE outbox SET status='sent', sent_at=datetime('now') WHERE id=?",
+            (outbox_id,))
         conn.commit()
 
 
+def mark_outbox_failed(outbox_id: int, error: str, retry_in: Optional[float]):
+    """Schedule a retry in ``retry_in`` seconds, or give up for good when it is None."""
+    with _conn() as conn:
+        if retry_in is None:
+            conn.execute(
+                "UPDATE outbox SET status='failed', last_error=? WHERE id=?",
+                (error, outbox_id))
+        else:
+            conn.execute(
+                "UPDATE outbox SET next_attempt_at=?, last_error=? WHERE id=?",
+                (time.time() + retry_in, error, outbox_id))
+        conn.commit()
+
+
+def release_outbox_rows(outbox_ids: Sequence[int], delay: float):
+    """Hand claimed but unattempted rows back, due in ``delay`` seconds, and
+    refund the attempt their claim counted."""
+    if not outbox_ids:
+        return
+    with _conn() as conn:
+        conn.execute(f"""
+            UPDATE outbox SET attempts = attempts - 1, next_attempt_at = ?
+            WHERE status='pending' AND id IN ({','.join('?' * len(outbox_ids))})
+        """, (time.time() + delay, *outbox_ids))
+        conn.commit()
+
+
+def collapse_digest(chat_id: int, render: Callable[[List[Tuple]], str]) -> int:
+    """Merge held digest rows for ``chat_id`` into one pending message.
+
+    ``render`` gets the rows (0:category 1:text 2:created_at, oldest first)
+    and returns the summary text.  Returns how many events were merged.
+    """
+    with _conn() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""
+                UPDATE outbox SET status='merged'
+                WHERE status='digest' AND chat_id=?
+                RETURNING id, category, text, created_at
+            """, (chat_id,))
+            rows = [r[1:] for r in sorted(c.fetchall())]
+            if not rows:
+                conn.rollback()
+                return 0
+            _enqueue(c, [Notice(chat_id, render(rows))])
+            conn.commit()
+            return len(rows)
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def get_outbox_stats() -> dict:
+    with _read_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+        return dict(c.fetchall())
+
+
+# ---------------------------------------------------------------------------
+#  Broadcasts
+# ---------------------------------------------------------------------------
+#  A broadcast snapshots its recipients when it is created; progress lives in
+#  broadcast_recipients, so a restarted (or newly elected) sender continues
+#  where the previous one stopped.
+
+_BROADCAST_TRANSITIONS = {
+    "paused":    ("running",),
+    "running":   ("paused",),
+    "cancelled": ("running", "paused"),
+}
+
+
+def create_broadcast(text: str) -> Tuple[int, int]:
+    """Returns (broadcast_id, total recipients).  Blocked students are pre-skipped."""
+    with _conn() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("INSERT INTO broadcasts (text) VALUES (?)", (text,))
+            bid = c.lastrowid
+            c.execute("""
+                INSERT INTO broadcast_recipients (broadcast_id, telegram_id, status)
+                SELECT ?, telegram_id, CASE status WHEN 'active' THEN 'pending' ELSE 'skipped' END
+                FROM students
+            """, (bid,))
+            total = c.rowcount
+            c.execute("UPDATE broadcasts SET total=? WHERE id=?", (total, bid))
+            conn.commit()
+            return bid, total
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def set_broadcast_status(broadcast_id: int, status: str) -> bool:
+    allowed = _BROADCAST_TRANSITIONS[status]
+    with _conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            f"UPDATE broadcasts SET status=? WHERE id=? "
+            f"AND status IN ({','.join('?' * len(allowed))})",
+            (status, broadcast_id, *allowed))
+        conn.commit()
+        return c.rowcount == 1
+
+
+def get_running_broadcast() -> Optional[Tuple]:
+    """0:id 1:text (oldest running broadcast)"""
+    with _read_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, text FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1")
+        return c.fetchone()
+
+
+def get_broadcast_batch(broadcast_id: int, limit: int) -> List[int]:
+    with _read_conn() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT telegram_id FROM broadcast_recipients
+            WHERE broadcast_id=? AND status='pending' LIMIT ?
+        """, (broadcast_id, limit))
+        return [r[0] for r in c.fetchall()]
+
+
+def mark_broadcast_recipient(broadcast_id: int, telegram_id: int,
+                             status: str, error: str = None):
+    with _conn() as conn:
+        conn.execute("""
+            UPDATE broadcast_recipients SET status=?, error=?
+            WHERE broadcast_id=? AND telegram_id=? AND status='pending'
+        """, (status, error, broadcast_id, telegram_id))
+        conn.commit()
+
+
+def finish_broadcast(broadcast_id: int, notify: Sequence[Notice] = ()) -> bool:
+    """Mark a running broadcast done once it has no pending recipients."""
+    with _conn() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""
+                UPDATE broadcasts SET status='done', finished_at=datetime('now')
+                WHERE id=? AND status='running' AND NOT EXISTS (
+                    SELECT 1 FROM broadcast_recipients
+                    WHERE broadcast_id=? AND status='pending')
+            """, (broadcast_id, broadcast_id))
+            if c.rowcount != 1:
+                conn.rollback()
+                return False
+            _enqueue(c, notify)
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def get_broadcast_progress(broadcast_id: int) -> Optional[dict]:
+    with _read_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT status, total, created_at FROM broadcasts WHERE id=?", (broadcast_id,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        c.execute("""
+            SELECT status, COUNT(*) FROM broadcast_recipients
+            WHERE broadcast_id=? GROUP BY status
+        """, (broadcast_id,))
+        counts = dict(c.fetchall())
+    return {"id": broadcast_id, "status": row[0], "total": row[1], "created_at": row[2],
+            **{k: counts.get(k, 0) for k in ("pending", "sent", "failed", "skipped")}}
+
+
+# ---------------------------------------------------------------------------
+#  Leases (leader election between bot processes)
+# ---------------------------------------------------------------------------
+
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """Take or renew ``name`` for ``ttl`` seconds; fails while another holder's lease is live."""
+    now = time.time()
+    with _conn() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                holder=excluded.holder, expires_at=excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+            RETURNING holder
+        """, (name, holder, now + ttl, now))
+        acquired = bool(c.fetchall())
+        conn.commit()
+        return acquired
+
+
+def release_lease(name: str, holder: str):
+    with _conn() as conn:
+        conn.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+        conn.commit()
+
+
+# ---------------------------------------------------------------------------
+#  Update de-duplication (polling offset)
+# ---------------------------------------------------------------------------
+
+# Telegram restarts update ids at a random value after a week without
+# updates; older entries are dropped so they cannot shadow the new range.
+SEEN_UPDATES_MAX_AGE = 6 * 86400
+
+
+def get_last_update_id() -> int:
+    """Highest update id already processed, 0 if none (the polling offset).
+
+    Ids older than SEEN_UPDATES_MAX_AGE are ignored: after a week without
+    updates Telegram may restart the sequence below the old offset.
+    """
+    with _read_conn() as conn:
+        return conn.execute("SELECT MAX(update_id) FROM seen_updates WHERE seen_at >= ?",
+                            (time.time() - SEEN_UPDATES_MAX_AGE,)).fetchone()[0] or 0
+
+
+def claim_updates(update_ids: Sequence[int], window: int) -> List[int]:
+    """Record ``update_ids`` as processed and return the ones not seen before.
+
+    Only the newest ``window`` ids are kept; anything older than that is
+    treated as a replay too.
+    """
+    now = time.time()
+    with _conn() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - SEEN_UPDATES_MAX_AGE,))
+            top = c.execute("SELECT MAX(update_id) FROM seen_updates").fetchone()[0]
+            floor = top - window if top is not None else None
+            fresh = []
+            for update_id in update_ids:
+                if floor is not None and update_id <= floor:
+                    continue
+                c.execute("INSERT OR IGNORE INTO seen_updates (update_id, seen_at) VALUES (?, ?)",
+                          (update_id, now))
+                if c.rowcount:
+                    fresh.append(update_id)
+            if fresh:
+                c.execute("DELETE FROM seen_updates WHERE update_id <= ?",
+                          (max(fresh + [top or 0]) - window,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return fresh
+
+
 # ---------------------------------------------------------------------------
 #  Payments
 # ---------------------------------------------------------------------------
@@ -511,7 +1790,7 @@ def complete_payment(payment_id: int, stripe_charge_id: str):
 
 
 def get_payment(payment_id: int) -> Optional[Tuple]:
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         c.execute("SELECT * FROM payments WHERE id=?", (payment_id,))
         return c.fetchone()
@@ -522,7 +1801,7 @@ def get_payment(payment_id: int) -> Optional[Tuple]:
 # ---------------------------------------------------------------------------
 
 def get_statistics() -> dict:
-    with _conn() as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
 
         c.execute("SELECT COUNT(*) FROM students")
@@ -561,4 +1840,95 @@ def get_statistics() -> dict:
 
 
 # ---------------------------------------------------------------------------
-init_db()
\ No newline at end of file
+#  Analytics (daily rollups, see _m011_rollups)
+# ---------------------------------------------------------------------------
+
+_PERIOD_START = {
+    "week": "date(day, 'weekday 0', '-6 days')",     # Monday
+    "month": "strftime('%Y-%m-01', day)",
+}
+
+
+def _period_starts(period: str, periods: int) -> List[str]:
+    """First days (UTC) of the last ``periods`` weeks or months, oldest first."""
+    today = datetime.now(timezone.utc).date()
+    if period == "week":
+        monday = today - timedelta(days=today.weekday())
+        return [(monday - timedelta(weeks=k)).isoformat() for k in range(periods - 1, -1, -1)]
+    year, month = today.year, today.month
+    starts = []
+    for _ in range(periods):
+        starts.append(f"{year:04d}-{month:02d}-01")
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return starts[::-1]
+
+
+def get_analytics(period: str = "week", periods: int = 8) -> dict:
+    """Trend over the last ``periods`` weeks or months plus that window's
+    revenue by tariff and lessons by teacher.
+
+    trend rows: (first day, revenue_cents, payments, signups, renewals, lessons)
+    """
+    bucket = _PERIOD_START[period]
+    starts = _period_starts(period, periods)
+    trend = {s: [s, 0, 0, 0, 0, 0] for s in starts}
+    with _read_conn() as conn:
+        c = conn.cursor()
+        queries = (
+            ((1, 2), f"SELECT {bucket}, SUM(amount_cents), SUM(payments) FROM daily_revenue "
+                     "WHERE day BETWEEN ? AND date('now') GROUP BY 1"),
+            ((3, 4), f"SELECT {bucket}, SUM(signups), SUM(renewals) FROM daily_students "
+                     "WHERE day BETWEEN ? AND date('now') GROUP BY 1"),
+            ((5,), f"SELECT {bucket}, SUM(lessons) FROM daily_lessons "
+                   "WHERE day BETWEEN ? AND date('now') GROUP BY 1"),
+        )
+        for columns, sql in queries:
+            for start, *values in c.execute(sql, (starts[0],)):
+                if start in trend:
+                    for col, value in zip(columns, values):
+                        trend[start][col] = value
+        c.execute("""
+            SELECT tariff, SUM(payments), SUM(amount_cents) FROM daily_revenue
+            WHERE day BETWEEN ? AND date('now') GROUP BY tariff ORDER BY 3 DESC
+        """, (starts[0],))
+        by_tariff = c.fetchall()
+        c.execute("""
+            SELECT COALESCE(t.name, '—'), SUM(d.lessons) FROM daily_lessons d
+            LEFT JOIN teachers t ON t.id = d.teacher_id
+            WHERE d.day BETWEEN ? AND date('now') GROUP BY d.teacher_id ORDER BY 2 DESC
+        """, (starts[0],))
+        by_teacher = c.fetchall()
+    return {
+        "trend": [tuple(trend[s]) for s in starts],
+        "by_tariff": by_tariff,
+        "by_teacher": by_teacher,
+    }
+
+
+def get_cohort_retention(months: int = 6) -> List[Tuple]:
+    """Repurchase retention of the last ``months`` sign-up months, oldest first.
+
+    Rows: (cohort "YYYY-MM", signed_up, [students renewing in month 0, 1, ...])
+    where month 0 is the sign-up month and the list runs to the current month.
+    """
+    current = _period_starts("month", 1)[0][:7]
+    first = _period_starts("month", months)[0][:7]
+
+    def index(month: str) -> int:
+        return int(month[:4]) * 12 + int(month[5:7])
+
+    with _read_conn() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT cohort, month, signed_up, renewed FROM cohort_retention
+            WHERE cohort >= ? ORDER BY cohort, month
+        """, (first,))
+        rows = c.fetchall()
+    cohorts = {}
+    for cohort, month, signed_up, renewed in rows:
+        entry = cohorts.setdefault(cohort, [cohort, 0, [0] * (index(current) - index(cohort) + 1)])
+        entry[1] += signed_up
+        offset = index(month) - index(cohort)
+        if 0 <= offset < len(entry[2]):
+            entry[2][offset] += renewed
+    return [tuple(entry) for entry in cohorts.values()]
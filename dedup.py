@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Sequence, Tuple
+
+PENDING = object()
+
+
+class _Entry:
+    __slots__ = ("result", "expires_at")
+
+    def __init__(self):
+        self.result = PENDING
+        self.expires_at = float("inf")
+
+
+class Deduplicator:
+    """Run an action at most once per key within ``ttl`` seconds.
+
+    An action can be registered under several keys (e.g. the callback id and
+    the (chat, data) pair); a repeat matching any of them is collapsed.
+    run() returns ``(True, result)`` for the call that executed,
+    ``(False, result)`` for a repeat of a finished one, and
+    ``(False, PENDING)`` while the first one is still running.  Failed actions
+    are forgotten so they can be retried.
+    """
+
+    def __init__(self, ttl: float, max_keys: int = 10000):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self.executed = 0
+        self.collapsed = 0
+
+    def _purge(self, now: float):
+        # Oldest first; stop at the first live entry unless over capacity.
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expires_at > now and len(self._entries) <= self.max_keys:
+                break
+            self._entries.popitem(last=False)
+
+    def run(self, keys: Sequence[Hashable], action: Callable[[], Any]) -> Tuple[bool, Any]:
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry.expires_at > now:
+                    self.collapsed += 1
+                    return False, entry.result
+            entry = _Entry()
+            for key in keys:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+            self.executed += 1
+        try:
+            result = action()
+        except BaseException:
+            with self._lock:
+                for key in keys:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+            raise
+        with self._lock:
+            entry.result = result
+            entry.expires_at = time.monotonic() + self.ttl
+        return True, result
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+
+# (tokens per second, burst)
+Limit = Tuple[float, float]
+
+
+class TokenBuckets:
+    """Token buckets keyed by e.g. user id, refilled lazily on access.
+
+    Only the ``max_keys`` most recently seen keys are remembered; a forgotten
+    key simply starts again with a full bucket.  Every operation is O(1).
+    Not thread-safe on its own: FloodGuard holds the lock.
+    """
+
+    def __init__(self, limit: Limit, max_keys: int = 10000):
+        self.rate, self.burst = limit
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, List[float]]" = OrderedDict()
+
+    def level(self, key: Hashable, now: float) -> List[float]:
+        """The refilled [tokens, updated_at] of ``key``; mutate tokens to spend."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+
+class FloodGuard:
+    """Per-user and per-(user, command) token buckets.
+
+    An update is let through only if both the user's bucket and the bucket of
+    the command it triggers have a token; then one is taken from each.
+    Commands without their own limit share ``default_command``.
+    """
+
+    def __init__(self, user: Limit, commands: Dict[str, Limit],
+                 default_command: Limit, max_keys: int = 10000):
+        self._lock = threading.Lock()
+        self._users = TokenBuckets(user, max_keys)
+        self._commands = {name: TokenBuckets(limit, max_keys) for name, limit in commands.items()}
+        self._default = TokenBuckets(default_command, max_keys)
+        self.allowed = 0
+        self.dropped: Counter = Counter()
+
+    def allow(self, user_id: int, command: str, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        per_command = self._commands.get(command, self._default)
+        with self._lock:
+            u = self._users.level(user_id, now)
+            c = per_command.level((user_id, command), now)
+            if u[0] >= 1 and c[0] >= 1:
+                u[0] -= 1
+                c[0] -= 1
+                self.allowed += 1
+                return True
+            self.dropped[command] += 1
+            return False
+
+    def stats(self, top: int = 3) -> dict:
+        with self._lock:
+            return {
+                "allowed": self.allowed,
+                "dropped": sum(self.dropped.values()),
+                "top_dropped": self.dropped.most_common(top),
+            }
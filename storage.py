@@ -0,0 +1,116 @@
+"""Repository interface over the data layer.
+
+Handlers talk to a Storage bundle instead of importing database.py functions
+one by one::
+
+    store = open_storage()              # DB_PATH, as before
+    store = open_storage(MEMORY)        # private in-memory database
+    store.students.get(telegram_id)
+    store.slots.book(slot_id, student_id)
+
+Both backends run the same SQL, so guarded updates, BEGIN IMMEDIATE
+transactions and the outbox behave identically; the in-memory one just never
+touches the disk.  They cannot be open side by side: there is one active
+database per process (connections and the free-slot snapshot are module state
+in database.py).  A Storage is only a view of it; open_storage() is what
+switches the process over.
+
+Outbox, broadcasts, leases and WAL maintenance are infrastructure rather than
+domain data and stay as plain database.py functions.
+"""
+import database as db
+from database import MEMORY
+
+
+class RegistrationRepository:
+    save = staticmethod(db.save_reg_state)
+    get = staticmethod(db.get_reg_state)
+    clear = staticmethod(db.clear_reg_state)
+
+
+class StudentRepository:
+    add = staticmethod(db.add_student)
+    get = staticmethod(db.get_student)
+    get_by_id = staticmethod(db.get_student_by_id)
+    all = staticmethod(db.get_all_students)
+    search = staticmethod(db.search_students)
+    exists = staticmethod(db.is_registered)
+    card = staticmethod(db.get_student_card)
+    my_lessons = staticmethod(db.get_my_lessons)
+    adjust_balance = staticmethod(db.update_lessons_balance)
+    repurchase = staticmethod(db.repurchase_tariff)
+    balance_history = staticmethod(db.get_balance_history)
+    set_timezone = staticmethod(db.update_student_timezone)
+    toggle_status = staticmethod(db.toggle_student_status)
+
+
+class TeacherRepository:
+    add = staticmethod(db.add_teacher)
+    get = staticmethod(db.get_teacher_by_id)
+    active = staticmethod(db.get_active_teachers)
+    remove = staticmethod(db.remove_teacher)
+    agenda = staticmethod(db.get_teacher_agenda)
+    utilization = staticmethod(db.get_teacher_utilization)
+    load = staticmethod(db.get_teacher_load)
+
+
+class SlotRepository:
+    add = staticmethod(db.add_slot)
+    get = staticmethod(db.get_slot_by_id)
+    delete = staticmethod(db.delete_slot)
+    free = staticmethod(db.get_free_slots)
+    free_by_date = staticmethod(db.get_free_slots_by_date)
+    free_by_teacher = staticmethod(db.get_free_slots_by_teacher)
+    for_student = staticmethod(db.get_student_slots)
+    book = staticmethod(db.book_slot)
+    cancel = staticmethod(db.cancel_booking)
+    cancel_by_student = staticmethod(db.cancel_booking_by_student)
+    bookings = staticmethod(db.get_all_bookings)
+    bookings_by_date = staticmethod(db.get_bookings_by_date)
+    mark_done = staticmethod(db.mark_lesson_done)
+    close_day = staticmethod(db.close_day)
+    upcoming_unreminded = staticmethod(db.get_upcoming_unreminded)
+    claim_reminder = staticmethod(db.claim_reminder)
+
+
+class PaymentRepository:
+    create = staticmethod(db.create_payment)
+    complete = staticmethod(db.complete_payment)
+    get = staticmethod(db.get_payment)
+
+
+class Storage:
+    statistics = staticmethod(db.get_statistics)
+    analytics = staticmethod(db.get_analytics)
+    cohort_retention = staticmethod(db.get_cohort_retention)
+
+    def __init__(self):
+        """Repositories over the process's current database (DB_PATH).  Does
+        no I/O and switches nothing; see open_storage()."""
+        self.registration = RegistrationRepository()
+        self.students = StudentRepository()
+        self.teachers = TeacherRepository()
+        self.slots = SlotRepository()
+        self.payments = PaymentRepository()
+
+    @property
+    def path(self) -> str:
+        return db.DB_PATH
+
+    @property
+    def in_memory(self) -> bool:
+        return self.path == MEMORY
+
+
+def open_storage(path: str = None) -> Storage:
+    """Storage over ``path`` (default: DB_PATH) with the schema brought up to
+    date.
+
+    This rebinds global state: database.py keeps one database per process,
+    so every Storage, including ones created earlier, now reads and writes
+    ``path``.
+    """
+    if path and path != db.DB_PATH:
+        db.use_database(path)
+    db.init_db()
+    return Storage()
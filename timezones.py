@@ -0,0 +1,67 @@
+import os
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Slot dates/times typed by the admin are wall-clock times in SCHOOL_TZ.  The
+# schedule also stores them as UTC epoch seconds (schedule.starts_at); every
+# deadline is computed on that, and rendering converts back per student.
+SCHOOL_TZ = os.environ.get("SCHOOL_TZ", "Europe/Paris")
+DATE_FMT = "%d.%m.%Y"
+TIME_FMT = "%H:%M"
+
+log = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def zone(name: Optional[str]) -> ZoneInfo:
+    try:
+        return ZoneInfo(name or SCHOOL_TZ)
+    except (ZoneInfoNotFoundError, ValueError):
+        log.warning("Unknown timezone %r, using %s", name, SCHOOL_TZ)
+        return ZoneInfo(SCHOOL_TZ)
+
+
+def utc_now() -> int:
+    return int(time.time())
+
+
+def slot_to_utc(date_str: str, time_str: str) -> int:
+    """School wall-clock date/time -> UTC epoch seconds.  Raises ValueError on bad input."""
+    naive = datetime.strptime(f"{date_str} {time_str}", f"{DATE_FMT} {TIME_FMT}")
+    return int(naive.replace(tzinfo=zone(SCHOOL_TZ)).timestamp())
+
+
+@lru_cache(maxsize=65536)
+def local_parts(starts_at: int, tz: str) -> Tuple[str, str]:
+    """(DD.MM.YYYY, HH:MM) of ``starts_at`` in ``tz``; cached because the same
+    handful of slots is rendered for every student in the same few zones."""
+    dt = datetime.fromtimestamp(starts_at, timezone.utc).astimezone(zone(tz))
+    return dt.strftime(DATE_FMT), dt.strftime(TIME_FMT)
+
+
+def render_slot(date_str: str, time_str: str, starts_at: Optional[int], tz: str) -> Tuple[str, str]:
+    """Local (date, time) for a schedule row; rows without starts_at keep their school time."""
+    if starts_at is None:
+        return date_str, time_str
+    return local_parts(starts_at, tz)
+
+
+def period_bounds(period: str, tz: str = SCHOOL_TZ, offset: int = 0) -> Tuple[int, int]:
+    """UTC [start, end) of the current ``"day"`` or ``"week"`` (Monday-based) in
+    ``tz``, shifted by ``offset`` periods.  Bounds are aligned, so they make good
+    cache keys."""
+    now = datetime.now(zone(tz))
+    start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    days = 1
+    if period == "week":
+        start -= timedelta(days=start.weekday())
+        days = 7
+    start = (start + timedelta(days=days * offset)).replace(tzinfo=None)
+    end = start + timedelta(days=days)
+    # Re-localise so DST changes inside the period are accounted for.
+    return (int(start.replace(tzinfo=zone(tz)).timestamp()),
+            int(end.replace(tzinfo=zone(tz)).timestamp()))